@@ -1,4 +1,5 @@
-import sys, uuid
+import sys, time, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
@@ -12,6 +13,14 @@ from pyspark.sql.types import DateType, BooleanType
 from pyspark.sql.types import StructType, StructField, StringType
 from pyspark.sql.window import Window
 from pyspark.sql import Row
+from pyspark import StorageLevel
+import json
+from data_quality import observe_quality, report_from_metrics, summarize
+from landing_zone import land_raw_spark, read_landing_spark
+from stats_catalog import CATALOG_FILE, record_tables_spark
+from metrics import FACT_METRICS, ROLLUP_METRICS, with_metrics
+from sketches import SKETCHES, merge_sketch_tables_spark, sketch_table_spark
+from stage_metrics import collect_stage_metrics, heaviest, tagged
 
 # data preprocessing
 def data_preprocessing(df): 
@@ -19,18 +28,57 @@ def data_preprocessing(df):
     print("Data Preprocessing...")
     # Drop rows with null Order_Number
     df = df.filter(df["Order_Number"].isNotNull())
-    # Convert column names to lowercase
-    for col in df.columns:
-        df = df.withColumnRenamed(col, col.lower())
+    # Convert column names to lowercase, one projection for all of them
+    df = df.toDF(*[col.lower() for col in df.columns])
     # Convert order_date to proper date type
     # In PySpark, we use to_date function instead of pandas to_datetime
-    df = df.withColumn("order_date", 
-                      F.to_date(F.col("order_date"), "dd/MM/yyyy"))
-    # Convert back to DynamicFrame and return
+    # the landing zone hands over dates already parsed
+    if dict(df.dtypes)["order_date"] == "string":
+        df = df.withColumn("order_date", 
+                          F.to_date(F.col("order_date"), "dd/MM/yyyy"))
     return df
 
+# assign surrogate keys to a dimension
+# A bare Window.orderBy() pulls every row into a single partition, so keys are
+# built per partition instead: number the rows inside each partition, count
+# the partitions (one small aggregate on the driver) and shift every partition
+# by the running total of the ones before it.
+#   method="ordered": dense 1..n keys in order_cols order (same result as
+#                     row_number over Window.orderBy), via a range partition
+#   method="offset":  dense 1..n keys in whatever order the data is in
+#   method="hash":    stable 64-bit hash of order_cols, no extra job at all
+def assign_surrogate_keys(df, key_col, order_cols, method="ordered"):
+    if method == "hash":
+        return df.withColumn(key_col, F.xxhash64(*order_cols))
+    if method not in ("ordered", "offset"):
+        raise ValueError(f"Unknown surrogate key method: {method}")
+    if method == "ordered":
+        # range partitioning keeps the global order across partitions
+        df = df.repartitionByRange(*order_cols).sortWithinPartitions(*order_cols)
+    # position of each row inside its own partition
+    df = df.withColumn("_pid", F.spark_partition_id()) \
+           .withColumn("_pos", F.monotonically_increasing_id() -
+                       F.shiftLeft(F.col("_pid").cast("long"), 33))
+    # persist so the counts and the keys come from the same rows
+    numbered = df.persist(StorageLevel.MEMORY_AND_DISK)
+    counts = dict(numbered.groupBy("_pid").count().collect())
+    # running offset per partition, empty partitions included
+    offsets, total = [], 0
+    for pid in range(numbered.rdd.getNumPartitions()):
+        offsets.append(total)
+        total += counts.get(pid, 0)
+    offset_col = F.array(*[F.lit(o) for o in offsets]).getItem(F.col("_pid")) \
+        if offsets else F.lit(0)
+    keyed = numbered.withColumn(key_col, (offset_col + F.col("_pos") + 1).cast("int")) \
+                    .drop("_pid", "_pos")
+    # materialize the keys, then release the cache: the checkpoint's blocks
+    # are cleaned up with the returned frame, a persisted frame never is
+    keyed = keyed.localCheckpoint(eager=True)
+    numbered.unpersist()
+    return keyed
+
 # process date dimension
-def proc_date_dim(df, glueContext, spark):
+def proc_date_dim(df, glueContext, spark, stored_path=None):
     # create and process date dimension
     print("Processing date dimension...")
     # Extract unique dates - need to ensure order_date column exists and is a date type
@@ -39,6 +87,11 @@ def proc_date_dim(df, glueContext, spark):
     # Select distinct dates and create a dataframe with just the dates
     dates_df = df.select("order_date").distinct()
     dates_df = dates_df.withColumnRenamed("order_date", "date_full")
+    # only dates that are not stored yet are added
+    existing = read_stored_dim(spark, stored_path, history=False)
+    if existing is not None:
+        dates_df = dates_df.join(existing.select("date_full"), on="date_full", 
+                                 how="left_anti")
     # Add date attributes - similar to pandas operations but using Spark functions
     dates_df = dates_df.withColumn("day_of_week", F.dayofweek("date_full"))
     dates_df = dates_df.withColumn("day_name", F.date_format("date_full", "EEEE"))
@@ -55,29 +108,121 @@ def proc_date_dim(df, glueContext, spark):
         "is_weekend", 
         (F.col("day_of_week") == 1) | (F.col("day_of_week") == 7)
     )
-    # Convert back to DynamicFrame and return
-    return DynamicFrame.fromDF(dates_df, glueContext, "date_dimension")
+    if existing is None:
+        return dates_df
+    # the result overwrites the files it was read from, materialize it first
+    return existing.select(dates_df.columns).unionByName(dates_df) \
+                   .localCheckpoint(eager=True)
+
+# slowly changing dimension, type 2
+# Every member's attributes are hashed and compared to the hash stored on its
+# current version in one join. Members whose hash changed get their current
+# version closed (effective_to, is_current=false) and a new version with a
+# new surrogate key; new members get a first version; unchanged members are
+# carried over untouched. effective_to is null on the current version.
+def read_stored_dim(spark, path, history=True):
+    if path is None:
+        return None
+    try:
+        stored = spark.read.parquet(path)
+    except Exception as e:
+        print(f"No stored dimension at {path} ({e})")
+        return None
+    # a dimension written before the history columns starts over
+    return stored if not history or "row_hash" in stored.columns else None
+
+def apply_scd2(spark, incoming, stored_path, natural_key, attributes, 
+               surrogate_key, key_method="ordered"):
+    run_time = F.current_timestamp()
+    columns = natural_key[:1] + [surrogate_key] + natural_key[1:] + attributes + \
+        ["effective_from", "effective_to", "is_current", "row_hash", 
+         "create_date", "update_date"]
+    incoming = incoming.withColumn("row_hash", F.xxhash64(*attributes))
+    existing = read_stored_dim(spark, stored_path)
+    max_key = 0
+    versions = incoming
+    if existing is not None:
+        current = existing.filter(F.col("is_current")).select(
+            *natural_key, F.col("row_hash").alias("row_hash_stored"), 
+            F.col(surrogate_key).alias("key_stored"))
+        matched = incoming.join(current, on=natural_key, how="left")
+        # new members have no stored hash, changed ones a different hash
+        changed = matched.filter(F.col("row_hash_stored").isNull() | 
+                                 (F.col("row_hash") != F.col("row_hash_stored"))) \
+                         .persist(StorageLevel.MEMORY_AND_DISK)
+        expired = changed.filter(F.col("key_stored").isNotNull()) \
+                         .select(F.col("key_stored").alias(surrogate_key)) \
+                         .withColumn("_expired", F.lit(True))
+        closing = F.coalesce(F.col("_expired"), F.lit(False))
+        existing = existing.join(expired, on=surrogate_key, how="left") \
+            .withColumn("effective_to", 
+                        F.when(closing, run_time).otherwise(F.col("effective_to"))) \
+            .withColumn("is_current", F.when(closing, F.lit(False))
+                                       .otherwise(F.col("is_current"))) \
+            .withColumn("update_date", 
+                        F.when(closing, run_time).otherwise(F.col("update_date")))
+        if key_method != "hash":
+            max_key = existing.agg(F.max(surrogate_key)).collect()[0][0] or 0
+        versions = changed.drop("row_hash_stored", "key_stored")
+    if key_method == "hash":
+        # a hash of the natural key alone would repeat on every version of a
+        # member, so the version's start is hashed too; hashes are no
+        # sequence, there is no offset to add
+        versions = versions.withColumn(surrogate_key, 
+                                       F.xxhash64(*natural_key, run_time))
+    else:
+        versions = assign_surrogate_keys(versions, surrogate_key, natural_key, 
+                                         key_method)
+        versions = versions.withColumn(surrogate_key, 
+                                       F.col(surrogate_key) + F.lit(max_key))
+    versions = versions.withColumn("effective_from", run_time) \
+        .withColumn("effective_to", F.lit(None).cast("timestamp")) \
+        .withColumn("is_current", F.lit(True)) \
+        .withColumn("create_date", run_time) \
+        .withColumn("update_date", run_time)
+    if existing is None:
+        return versions.select(columns)
+    # the result overwrites the files it was read from, materialize it first
+    result = existing.select(columns).unionByName(versions.select(columns)) \
+                     .localCheckpoint(eager=True)
+    changed.unpersist()
+    return result
+
+# dimensions without history: stored members keep their row and key, new
+# members are keyed after the largest stored key (hash keys need no offset)
+def upsert_members(spark, members, stored_path, name_col, key_col, 
+                   key_method="ordered"):
+    columns = [name_col, key_col] + \
+        [c for c in members.columns if c != name_col]
+    existing = read_stored_dim(spark, stored_path, history=False)
+    if existing is not None:
+        members = members.join(existing.select(name_col), on=name_col, 
+                               how="left_anti")
+    added = assign_surrogate_keys(members, key_col, [name_col], key_method)
+    if existing is None:
+        return added.select(columns)
+    if key_method != "hash":
+        max_key = existing.agg(F.max(key_col)).collect()[0][0] or 0
+        added = added.withColumn(key_col, F.col(key_col) + F.lit(max_key))
+    # the result overwrites the files it was read from, materialize it first
+    return existing.select(columns).unionByName(added.select(columns)) \
+                   .localCheckpoint(eager=True)
 
 # process customer dimension 
-def proc_cust_dim(df, glueContext):
+def proc_cust_dim(df, glueContext, key_method="ordered", stored_path=None):
     print("Processing customer dimension...")
     # Extract unique customer names
     customers_df = df.select("customer_name").distinct()
-    # Create surrogate keys using row_number() window function
-    window_spec = Window.orderBy("customer_name")
-    customers_df = customers_df.withColumn("customer_id", 
-                                          F.row_number().over(window_spec))
     # Split customer name into first and last name
     customers_df = customers_df.withColumn("first_name", 
                                           F.split(F.col("customer_name"), " ").getItem(0))
     customers_df = customers_df.withColumn("last_name", 
                                           F.expr("split(customer_name, ' ')[size(split(customer_name, ' '))-1]"))
-    # Add metadata columns with current timestamp
-    current_timestamp = F.current_timestamp()
-    customers_df = customers_df.withColumn("create_date", current_timestamp)
-    customers_df = customers_df.withColumn("update_date", current_timestamp)
-    # Convert back to DynamicFrame and return
-    return DynamicFrame.fromDF(customers_df, glueContext, "customer_dimension")
+    # Add surrogate keys and history against the stored dimension
+    customers_df = apply_scd2(glueContext.spark_session, customers_df, stored_path, 
+                              ["customer_name"], ["first_name", "last_name"], 
+                              "customer_id", key_method)
+    return customers_df
 
 # process geo dimensions 
 def generate_india_states_list(spark):
@@ -187,7 +332,6 @@ def generate_india_states_list(spark):
     columns_order = ['state_id', 'state_code', 'country', 'state_name', 
                      'capital_city', 'status', 'iso_code']
     india_state_df = india_state_df.select(columns_order)
-    # Convert to DynamicFrame and return
     return india_state_df
 
 # generate a list of U.S. states
@@ -390,7 +534,6 @@ def generate_canadian_provinces_list(spark):
     columns_order = ['state_id', 'state_code', 'country', 'state_name', 
                      'capital_city', 'status', 'iso_code']
     canada_provinces_df = canada_provinces_df.select(columns_order)
-    # Convert to DynamicFrame and return
     return canada_provinces_df
 
 # based on the list generated above
@@ -406,17 +549,13 @@ def proc_geo_dim(spark, glueContext):
     # add metadata
     geographys = geographys.withColumn("created_at", F.current_timestamp())
     # Cache the result to improve performance
-    geographys_df = geographys.cache()
-    return DynamicFrame.fromDF(geographys_df, glueContext, "geography_dimension")
+    return geographys.cache()
 
 # process product dimension
-def proc_prod_dim(df, glueContext):
+def proc_prod_dim(df, glueContext, key_method="ordered", stored_path=None):
     print('Processing product dimension...')
     # Extract unique product information
     products = df.select('product', 'category', 'brand').distinct()
-    # Add surrogate key using row_number window function
-    window_spec = Window.orderBy('product', 'category', 'brand')
-    products = products.withColumn('product_id', F.row_number().over(window_spec))
     # Get unique product-cost combinations
     pc = df.select('product', 'category', 'brand', 'cost').distinct()
     # Ensure there is only one cost associated with each product
@@ -440,20 +579,19 @@ def proc_prod_dim(df, glueContext):
     products = products.withColumnRenamed('cost', 'standard_cost')
     # Fill null values with 0 for standard_cost
     products = products.na.fill({'standard_cost': 0})
-    # Add metadata columns
-    current_timestamp = F.current_timestamp()
-    products = products.withColumn('create_date', current_timestamp)
-    products = products.withColumn('update_date', current_timestamp)
-    return DynamicFrame.fromDF(products, glueContext, "product_dimension")
+    # a fixed type keeps the attribute hash stable between runs
+    products = products.withColumn('standard_cost', F.col('standard_cost').cast('double'))
+    # Add surrogate keys and history against the stored dimension
+    products = apply_scd2(glueContext.spark_session, products, stored_path, 
+                          ['product_name', 'category', 'brand'], ['standard_cost'], 
+                          'product_id', key_method)
+    return products
 
 
-def proc_ostatus_dim(df, glueContext): 
+def proc_ostatus_dim(df, glueContext, key_method="ordered", stored_path=None): 
     print('Processing order status dimension...')
     # Extract unique statuses
     status = df.select('status').distinct()
-    # Add surrogate key 
-    window_spec = Window.orderBy('status')
-    status = status.withColumn('status_id', F.row_number().over(window_spec))
     # Rename columns
     status = status.withColumnRenamed('status', 'status_name')
     
@@ -471,16 +609,15 @@ def proc_ostatus_dim(df, glueContext):
     current_timestamp = F.current_timestamp()
     status = status.withColumn('create_date', current_timestamp)
     status = status.withColumn('update_date', current_timestamp)
-    return DynamicFrame.fromDF(status, glueContext, "status_dimension")
+    # Add surrogate keys against the stored dimension
+    return upsert_members(glueContext.spark_session, status, stored_path, 
+                          'status_name', 'status_id', key_method)
 
 # process employee/supervisor dimension
-def proc_emp_dim(df, glueContext): 
+def proc_emp_dim(df, glueContext, key_method="ordered", stored_path=None): 
     print('Processing employee/supervisor dimension...')
     # Extract unique supervisor names
     employee = df.select('assigned supervisor').distinct()
-    # Add surrogate key
-    window_spec = Window.orderBy('assigned supervisor')
-    employee = employee.withColumn('employee_id', F.row_number().over(window_spec))
     # Rename columns
     employee = employee.withColumnRenamed('assigned supervisor', 'employee_name')
     # Split names to get first and last names
@@ -492,23 +629,117 @@ def proc_emp_dim(df, glueContext):
     current_timestamp = F.current_timestamp()
     employee = employee.withColumn('create_date', current_timestamp)
     employee = employee.withColumn('update_date', current_timestamp)
-    # Convert back to DynamicFrame and return
-    return DynamicFrame.fromDF(employee, glueContext, "employee_dimension")
+    # Add surrogate keys against the stored dimension
+    return upsert_members(glueContext.spark_session, employee, stored_path, 
+                          'employee_name', 'employee_id', key_method)
+
+
+# measure the dimensions: row count times the schema's default row width
+# all dimensions are counted in one job
+def measure_dims_bytes(dims):
+    counted = None
+    for key, dim_df in dims.items():
+        labels = dim_df.select(F.lit(key).alias("_dim"))
+        counted = labels if counted is None else counted.unionByName(labels)
+    counts = dict(counted.groupBy("_dim").count().collect())
+    return {key: (counts.get(key, 0), 
+                  counts.get(key, 0) * dim_df._jdf.schema().defaultSize())
+            for key, dim_df in dims.items()}
+
+# find the hot keys of one join key in the sampled orders
+# A key is hot when its share of the sampled rows is above hot_key_share.
+def hot_keys_in_sample(sample, key, hot_key_share=0.01, max_hot_keys=100):
+    # the frequencies are cached for reuse
+    freq = sample.groupBy(key).count().cache()
+    totals = freq.agg(F.sum("count").alias("rows"), 
+                      F.count(F.lit(1)).alias("keys")).collect()[0]
+    sample_rows = totals["rows"] or 0
+    top = freq.orderBy(F.desc("count")).limit(max_hot_keys).collect()
+    freq.unpersist()
+    hot_rows = [r for r in top 
+                if r[key] is not None and sample_rows 
+                and r["count"] / sample_rows > hot_key_share]
+    hot = [r[key] for r in hot_rows]
+    stats = {
+        "key": key,
+        "sample_rows": sample_rows,
+        "distinct_keys": totals["keys"],
+        "top_key_share": round(top[0]["count"] / sample_rows, 4) 
+                         if top and sample_rows else 0.0,
+        "hot_keys": len(hot),
+        "hot_key_share": round(sum(r["count"] for r in hot_rows) / sample_rows, 4) 
+                         if sample_rows else 0.0,
+    }
+    return hot, stats
 
+# sample the join key frequencies of the orders and find the hot keys of
+# every join key, from one sampled scan of the orders
+def detect_hot_keys(orders_df, keys, sample_fraction=0.01, hot_key_share=0.01, 
+                    max_hot_keys=100, seed=42):
+    sample = orders_df.select(*keys).sample(False, sample_fraction, seed) \
+                      .persist(StorageLevel.MEMORY_AND_DISK)
+    found = {key: hot_keys_in_sample(sample, key, hot_key_share, max_hot_keys) 
+             for key in keys}
+    sample.unpersist()
+    return found
 
-def fact_table(df, dates, customers, geographys, products, status, employee, glueContext, spark): 
+# pick the join of the orders to every dimension, once per run
+#   join_mode="broadcast": always broadcast the dimension
+#   join_mode="shuffle":   plain shuffle join
+#   join_mode="auto":      broadcast when the measured dimension fits under
+#                          broadcast_mb, otherwise sample the key frequencies
+#                          and isolate the hot keys: their orders are joined
+#                          to a broadcast slice of the dimension, the rest
+#                          goes through the shuffle join
+# Returns the hot keys per join key: None to broadcast the whole dimension,
+# an empty list for a plain shuffle join.
+def plan_joins(orders_df, dims, join_mode="auto", broadcast_mb=64, 
+               sample_fraction=0.01, hot_key_share=0.01):
+    if join_mode == "broadcast":
+        return {key: None for key in dims}
+    if join_mode == "shuffle":
+        return {key: [] for key in dims}
+    if join_mode != "auto":
+        raise ValueError(f"Unknown join mode: {join_mode}")
+    plan, large = {}, []
+    for key, (dim_rows, dim_bytes) in measure_dims_bytes(dims).items():
+        size = f"{dim_rows} rows, ~{dim_bytes / 1024 / 1024:.1f} MB"
+        if dim_bytes <= broadcast_mb * 1024 * 1024:
+            print(f"Join on {key}: broadcast ({size})")
+            plan[key] = None
+        else:
+            print(f"Join on {key}: dimension too large to broadcast ({size})")
+            large.append(key)
+    if large:
+        found = detect_hot_keys(orders_df, large, sample_fraction, hot_key_share)
+        for key, (hot, stats) in found.items():
+            print(f"Join on {key}: skew stats {stats}")
+            plan[key] = hot
+    return plan
+
+# join the orders to one dimension, as planned by plan_joins
+def join_dimension(orders_df, dim_df, key, hot=None):
+    if hot is None:
+        return orders_df.join(F.broadcast(dim_df), on=key, how="left")
+    if not hot:
+        return orders_df.join(dim_df, on=key, how="left")
+    is_hot = F.col(key).isin(hot)
+    hot_orders = orders_df.filter(is_hot)
+    # null keys never match the hot list, keep them on the shuffle side
+    cold_orders = orders_df.filter(~is_hot | F.col(key).isNull())
+    hot_dim = dim_df.filter(is_hot)
+    joined_hot = hot_orders.join(F.broadcast(hot_dim), on=key, how="left")
+    joined_cold = cold_orders.join(dim_df.filter(~is_hot), on=key, how="left")
+    return joined_hot.unionByName(joined_cold)
+
+def fact_table(df, dates, customers, geographys, products, status, employee, glueContext, spark, 
+               join_mode="auto"): 
     print("Creating fact table...")
-    # First check what we're working with
-    # Use the DataFrame directly without trying to convert it
-    print("Using orders DataFrame directly")
-    orders_df = df  # Already a DataFrame, no conversion needed
-    # Only convert the dimension DynamicFrames to DataFrames
-    print("Converting dimension DynamicFrames to DataFrames")
-    customers_df = customers.toDF()
-    geo_df = geographys.toDF()
-    products_df = products.toDF()
-    status_df = status.toDF()
-    employee_df = employee.toDF()
+    # the orders and the dimensions are all DataFrames, so preprocessing,
+    # dimensions and joins stay one plan for Catalyst to optimize
+    orders_df = df
+    customers_df, geo_df, products_df = customers, geographys, products
+    status_df, employee_df = status, employee
 
     # Pre-filter and select only needed columns from geo dimension
     print("Filtering geography to India")
@@ -516,32 +747,35 @@ def fact_table(df, dates, customers, geographys, products, status, employee, glu
     
     # Prepare all dimension DataFrames with only the columns needed for joining
     print("Preparing dimension tables for joins")
-    customers_join_df = customers_df.select("customer_name", "customer_id")
-    products_join_df = products_df.select(F.col("product_name").alias("product"), "product_id")
+    # only the current version of a changing dimension receives new facts
+    customers_join_df = customers_df.filter(F.col("is_current")) \
+                                    .select("customer_name", "customer_id")
+    products_join_df = products_df.filter(F.col("is_current")) \
+                                  .select(F.col("product_name").alias("product"), "product_id")
     status_join_df = status_df.select(F.col("status_name").alias("status"), "status_id")
     employee_join_df = employee_df.select(F.col("employee_name").alias("assigned supervisor"), "employee_id")
     
-    # Perform joins - use broadcast for smaller dimension tables
+    # Perform joins - broadcast small dimensions, isolate hot keys otherwise
+    # the sizes and hot keys of all dimensions are resolved up front
     print("Joining fact table with dimensions")
-    orders_df = orders_df.join(F.broadcast(customers_join_df), on="customer_name", how="left")
-    orders_df = orders_df.join(F.broadcast(geo_india_df), on="state_code", how="left")
-    orders_df = orders_df.join(F.broadcast(products_join_df), on="product", how="left")
-    orders_df = orders_df.join(F.broadcast(status_join_df), on="status", how="left")
-    orders_df = orders_df.join(F.broadcast(employee_join_df), on="assigned supervisor", how="left")
+    join_dims = {
+        "customer_name": customers_join_df,
+        "state_code": geo_india_df,
+        "product": products_join_df,
+        "status": status_join_df,
+        "assigned supervisor": employee_join_df,
+    }
+    plan = plan_joins(orders_df, join_dims, join_mode)
+    for key, dim_df in join_dims.items():
+        orders_df = join_dimension(orders_df, dim_df, key, plan[key])
     
     # Rename columns
     orders_df = orders_df.withColumnRenamed("cost", "unit_cost") \
                          .withColumnRenamed("sales", "unit_sales")
     
-    # Calculate derived columns in one step when possible
+    # Calculate the derived columns of metrics.py in one select
     print("Calculating derived columns")
-    orders_df = orders_df.withColumn("profit", F.col("total_sales") - F.col("total_cost"))
-    orders_df = orders_df.withColumn(
-        "profit_margin", 
-        F.when(F.col("total_sales") > 0, 
-              (F.col("total_sales") - F.col("total_cost")) / F.col("total_sales")
-        ).otherwise(F.lit(0))
-    )
+    orders_df = with_metrics(orders_df, FACT_METRICS)
     
     # Select required columns
     required_columns = [
@@ -550,6 +784,9 @@ def fact_table(df, dates, customers, geographys, products, status, employee, glu
         'unit_sales', 'quantity', 'total_cost', 'total_sales', 
         'profit', 'profit_margin'
     ]
+    # the read order of incremental runs goes on to split_new_orders
+    if INGEST_ORDER in orders_df.columns:
+        required_columns.append(INGEST_ORDER)
     orders_df = orders_df.select(required_columns)
     
     # Handle missing values in one operation
@@ -560,32 +797,254 @@ def fact_table(df, dates, customers, geographys, products, status, employee, glu
         "unit_sales": 0, "total_cost": 0, "total_sales": 0,
         "profit": 0, "profit_margin": 0
     }
-    orders_df = orders_df.na.fill(null_defaults)
-    
-    # Convert to DynamicFrame after all DataFrame operations are complete
-    print("Converting to DynamicFrame")
-    return DynamicFrame.fromDF(orders_df, glueContext, "orders_fact_table")
+    return orders_df.na.fill(null_defaults)
+
+# rollup tables for the dashboards, built from the fact table
+# the measures are additive, so a rollup of new orders can be merged into
+# the stored rollup by summing per key
+ROLLUPS = {
+    'agg_daily_product': ['order_date', 'product_id'],
+    'agg_daily_state': ['order_date', 'state_id'],
+    'agg_monthly_supervisor_category': ['order_month', 'employee_id', 'category'],
+}
+ROLLUP_MEASURES = ['order_count', 'quantity', 'total_cost', 'total_sales', 'profit']
+
+def aggregate_rollup(df, keys):
+    rollup = df.groupBy(*keys).agg(*[F.sum(m).alias(m) for m in ROLLUP_MEASURES])
+    # profit margin is not additive, derive it after summing
+    return with_metrics(rollup, ROLLUP_METRICS)
+
+# one narrow projection of the fact table feeds all rollups
+# with sign=-1 the measures are negated, summing the rows takes the orders out
+def rollup_orders(fact_df, products_df, sign=1):
+    return fact_df.select('order_date', 'product_id', 'state_id', 'employee_id', 
+                          *[(F.col(m) * sign).alias(m) 
+                            for m in ROLLUP_MEASURES[1:]]) \
+        .join(F.broadcast(products_df.select('product_id', 'category')), 
+              on='product_id', how='left') \
+        .withColumn('order_month', F.trunc('order_date', 'month')) \
+        .withColumn('order_count', F.lit(sign).cast('long'))
+
+# replaced_df holds the stored versions of the orders that fact_df sends
+# again (on_duplicate="update"), they are retracted from the rollups
+def proc_rollups(fact_df, products_df, glueContext, spark, 
+                 existing_path=None, replaced_df=None):
+    print('Processing rollup tables...')
+    orders = rollup_orders(fact_df, products_df)
+    if replaced_df is not None:
+        orders = orders.unionByName(rollup_orders(replaced_df, products_df, -1))
+    rollups = {}
+    for name, keys in ROLLUPS.items():
+        rollup = aggregate_rollup(orders, keys)
+        if existing_path is not None:
+            rollup = merge_rollup(spark, rollup, name, f"{existing_path}{name}")
+        rollups[name] = rollup
+    # mergeable sketches per day and key, built by the same pandas code as
+    # the local pipeline so the stored bytes match, see sketches.py; they
+    # cannot remove the replaced values
+    for name, keys in SKETCHES.items():
+        sketch = sketch_table_spark(fact_df, keys)
+        if existing_path is not None:
+            sketch = merge_rollup(spark, sketch, name, f"{existing_path}{name}")
+        rollups[name] = sketch
+    return rollups
+
+# add the rollup of the new orders to the stored rollup, or merge the
+# sketches of the new orders into the stored sketches
+def merge_rollup(spark, delta, name, path):
+    try:
+        existing = spark.read.parquet(path)
+    except Exception as e:
+        print(f"No stored rollup for {name}, starting a new one ({e})")
+        return delta
+    if name in SKETCHES:
+        merged = merge_sketch_tables_spark(
+            existing.unionByName(delta.select(*existing.columns)), 
+            SKETCHES[name])
+    else:
+        keys = ROLLUPS[name]
+        merged = aggregate_rollup(
+            existing.select(*keys, *ROLLUP_MEASURES)
+                    .unionByName(delta.select(*keys, *ROLLUP_MEASURES)), keys)
+        # keys whose orders were all replaced drop out
+        merged = merged.filter(F.col('order_count') != 0)
+    # the merged rollup overwrites the files it was read from, so it is
+    # materialized before the write
+    return merged.localCheckpoint(eager=True)
+
+# membership index of the loaded order numbers
+# The index is a Parquet folder with one order_number column. A batch is
+# checked against it with anti and semi joins; with the runtime Bloom filter
+# enabled, Spark builds a Bloom filter from the index and applies it to the
+# batch before the join, so most new orders never reach the shuffle.
+def read_order_index(spark, path):
+    try:
+        return spark.read.parquet(path).select("order_number")
+    except Exception as e:
+        print(f"No order index at {path} ({e})")
+        return None
+
+# the read order of the preprocessed rows, numbered in incremental runs
+# the last row read wins for an order repeated inside the batch, like
+# drop_duplicates(keep='last') in the local pipeline
+INGEST_ORDER = "_ingest_order"
+
+def split_new_orders(spark, fact_df, index_path):
+    spark.conf.set("spark.sql.optimizer.runtime.bloomFilter.enabled", "true")
+    last_read = Window.partitionBy("order_number") \
+                      .orderBy(F.col(INGEST_ORDER).desc())
+    fact_df = fact_df.withColumn("_rank", F.row_number().over(last_read)) \
+                     .filter(F.col("_rank") == 1).drop("_rank", INGEST_ORDER)
+    index = read_order_index(spark, index_path)
+    if index is None:
+        return fact_df, None
+    new_orders = fact_df.join(index, on="order_number", how="left_anti")
+    loaded_orders = fact_df.join(index, on="order_number", how="left_semi")
+    return new_orders, loaded_orders
+
+# the stored version of every order sent again: its last update, or the
+# row it was first loaded with
+def stored_versions(spark, loaded_df, facts_path, updates_path):
+    orders = loaded_df.select("order_number")
+    stored = spark.read.parquet(facts_path) \
+                  .join(orders, on="order_number", how="left_semi")
+    try:
+        updated = spark.read.parquet(updates_path) \
+                       .join(orders, on="order_number", how="left_semi")
+        stored = stored.join(updated.select("order_number"), 
+                             on="order_number", how="left_anti") \
+                       .unionByName(updated.select(*stored.columns))
+    except Exception as e:
+        print(f"No stored order updates at {updates_path} ({e})")
+    # read before fact_orders_updates is overwritten
+    return stored.localCheckpoint(eager=True)
+
+# fact_orders_updates keeps the latest version of every order sent again,
+# so the next update finds the version it replaces
+def latest_updates(spark, loaded_df, updates_path):
+    try:
+        previous = spark.read.parquet(updates_path)
+    except Exception as e:
+        print(f"No stored order updates at {updates_path} ({e})")
+        return loaded_df
+    # the result overwrites the files it was read from, materialize it first
+    return previous.join(loaded_df.select("order_number"), 
+                         on="order_number", how="left_anti") \
+                   .unionByName(loaded_df.select(*previous.columns)) \
+                   .localCheckpoint(eager=True)
+
+def save_order_index(new_orders, path):
+    new_orders.select(F.col("order_number").cast("long")) \
+              .coalesce(1).write.mode("append").parquet(path)
+    print(f"Order index updated at {path}")
+
+# estimate the output size of a dataframe from the optimized plan
+# This is Catalyst's own estimate, no Spark job is run. It tends to
+# overestimate after aggregations, so it is only used to size files.
+def estimate_size_bytes(df):
+    try:
+        stats = df._jdf.queryExecution().optimizedPlan().stats()
+        return int(str(stats.sizeInBytes()))
+    except Exception as e:
+        print(f"Could not estimate size: {e}")
+        return None
+
+# pick the number of output files for one table
+def output_file_count(file_name, size_bytes, target_file_mb=128, 
+                      single_file_tables=()):
+    if file_name in single_file_tables:
+        return 1
+    if size_bytes is None:
+        return None
+    target_bytes = target_file_mb * 1024 * 1024
+    return max(1, -(-size_bytes // target_bytes))
+
+# write one table, with its file count sized from the estimated size
+# The data quality aggregates are attached with observe() and computed by the
+# write itself, returns the observation holding them
+def write_table(spark_df, file_name, s3_path, format="parquet", 
+                target_file_mb=128, single_file_tables=(), mode="overwrite"):
+    size_bytes = estimate_size_bytes(spark_df)
+    num_files = output_file_count(file_name, size_bytes, target_file_mb, 
+                                  single_file_tables)
+    current = spark_df.rdd.getNumPartitions()
+    if num_files is not None and num_files < current:
+        # narrow dependency, no shuffle
+        spark_df = spark_df.coalesce(num_files)
+    elif num_files is not None and num_files > current:
+        spark_df = spark_df.repartition(num_files)
+    spark_df, observation = observe_quality(spark_df, file_name)
+    # the jobs of this write, in the Spark UI and the stage metrics
+    with tagged(spark_df.sparkSession.sparkContext, f"save {file_name}"):
+        spark_df.write.mode(mode).format(format).save(s3_path)
+    print(f"Successfully saved {file_name} to {s3_path} "
+          f"(~{(size_bytes or 0) / 1024 / 1024:.1f} MB, "
+          f"{num_files or current} files)")
+    return observation
 
 def save_dfs_to_s3(glueContext, dataframes, file_names, 
-bucket_name, folder_path, format="parquet"):
+bucket_name, folder_path, format="parquet", target_file_mb=128, 
+max_workers=4, single_file_tables=('dim_date', 'dim_geo', 'dim_ostatus', 
+                                   'dim_emp'), write_modes=None):
     print('Saving Data to S3...')
     # Verify inputs are valid
     if len(dataframes) != len(file_names):
         raise ValueError(f"""Number of dataframes ({len(dataframes)}) \
         must match number of file names ({len(file_names)})""")
-    # Loop through dataframes and save each one
-    for i, (df, file_name) in enumerate(zip(dataframes, file_names)):
-        print(f"Saving {file_name} to S3 ({i+1}/{len(dataframes)})...")
-        # Create S3 path
-        s3_path = f"s3://{bucket_name}/{folder_path}{file_name}"
-        
-        # Convert to regular DataFrame and write using Spark's write method
-        spark_df = df.toDF()
-        spark_df.write.mode("overwrite").parquet(s3_path)
-        
-        print(f"Successfully saved {file_name} to {s3_path}")
+    # The tables do not depend on each other, so each write is submitted
+    # from its own driver thread and the Spark jobs overlap on the cluster
+    errors, reports = [], []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i, (df, file_name) in enumerate(zip(dataframes, file_names)):
+            print(f"Saving {file_name} to S3 ({i+1}/{len(dataframes)})...")
+            # Create S3 path
+            s3_path = f"s3://{bucket_name}/{folder_path}{file_name}"
+            # tables are DataFrames, a DynamicFrame from a Glue source is
+            # converted once here
+            spark_df = df.toDF() if isinstance(df, DynamicFrame) else df
+            mode = (write_modes or {}).get(file_name, "overwrite")
+            future = executor.submit(write_table, spark_df, file_name, 
+                                     s3_path, format, target_file_mb, 
+                                     single_file_tables, mode)
+            futures[future] = file_name
+        for future in as_completed(futures):
+            try:
+                observation = future.result()
+                reports.append(report_from_metrics(futures[future], 
+                                                   observation.get))
+            except Exception as e:
+                print(f"Error saving {futures[future]}: {e}")
+                errors.append(futures[future])
+    if errors:
+        raise RuntimeError(f"Failed to save tables: {', '.join(errors)}")
+    # file statistics for readers, loaders and incremental runs to skip files
+    with tagged(glueContext.spark_session.sparkContext, "stats_catalog"):
+        record_tables_spark(
+            glueContext.spark_session, 
+            f"s3://{bucket_name}/{folder_path}{CATALOG_FILE}", 
+            {name: f"s3://{bucket_name}/{folder_path}{name}" 
+             for name in file_names}, 
+            write_modes)
     print(f"""All {len(dataframes)} dataframes saved successfully \
     to s3://{bucket_name}/{folder_path}""")
+    return reports
+
+# write the data quality report as a single JSON file
+def save_report_to_s3(spark, report, s3_path):
+    spark.createDataFrame([(json.dumps(report, indent=2, default=str),)], 
+                          ["value"]) \
+         .coalesce(1).write.mode("overwrite").text(s3_path)
+    print(f"Report saved to {s3_path}")
+
+# the plan of one table as Spark would run it
+# The dimensions and the fact table are plain DataFrames, so the plan of the
+# fact table covers the raw read, the preprocessing, the dimensions and all
+# joins. mode is one of Spark's explain modes, "formatted" lists the physical
+# operators with their details.
+def explain_plan(df, mode="formatted"):
+    return df._sc._jvm.PythonSQLUtils.explainString(
+        df._jdf.queryExecution(), mode)
 
 def main(): 
     print("Starting ETL job...")
@@ -602,51 +1061,178 @@ def main():
     source_table = "online_ecommerce_csv"
     target_bucket = "aws-bucket-ecommerce"
     target_folder = "processed/"
+    # raw source: "landing" converts new CSV drops under raw_path once into
+    # typed Parquet under landing_path and reads only that; "catalog" parses
+    # the CSV catalog table on every run
+    source = "landing"
+    raw_path = f"s3://{target_bucket}/raw/"
+    landing_path = f"s3://{target_bucket}/landing/orders/"
+    # surrogate key assignment: "ordered", "offset" or "hash"
+    key_method = "ordered"
+    # fact joins: "auto" (broadcast or skew-aware shuffle), "broadcast", "shuffle"
+    join_mode = "auto"
+    # merge the rollups into the ones of the previous run instead of replacing
+    incremental = False
+    # incremental runs: orders loaded before are skipped ("skip") or written
+    # to fact_orders_updates for the Redshift loader to upsert ("update")
+    on_duplicate = "skip"
+    # stage timings and the fact table plan, saved next to the tables
+    timings = {}
+    start = time.perf_counter()
     
-    print(f"Reading data from {source_database}.{source_table}...")
-    # Read data from catalog
     try:
-        raw_order = glueContext.create_dynamic_frame.from_catalog(
-            database=source_database,
-            table_name=source_table,
-            transformation_ctx="source_data"
-        )
-        
-        # convert to dataframe
-        raw_order_df = raw_order.toDF()
-        print(f"Successfully read data: {raw_order_df.count()} rows")
+        if source == "landing":
+            with tagged(sc, "land_raw"):
+                land_raw_spark(spark, raw_path, landing_path)
+            print(f"Reading data from {landing_path}...")
+            raw_order_df = read_landing_spark(spark, landing_path)
+        else:
+            print(f"Reading data from {source_database}.{source_table}...")
+            # Read data from catalog
+            raw_order = glueContext.create_dynamic_frame.from_catalog(
+                database=source_database,
+                table_name=source_table,
+                transformation_ctx="source_data"
+            )
+            # the only DynamicFrame of the job, everything after is a DataFrame
+            raw_order_df = raw_order.toDF()
+        # profile the raw data, computed by the count below
+        raw_order_df, raw_quality = observe_quality(raw_order_df, 'raw')
+        with tagged(sc, "read"):
+            raw_rows = raw_order_df.count()
+        print(f"Successfully read data: {raw_rows} rows")
         
         # preprocessing 
+        # the dimensions, the join sample and both sides of every hot key
+        # split read the preprocessed orders, the count below caches them
         df = data_preprocessing(raw_order_df)
-        print(f"Preprocessed data: {df.count()} rows")
+        if incremental:
+            # numbered in read order, the last row of a repeated order wins
+            df = df.withColumn(INGEST_ORDER, F.monotonically_increasing_id())
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
+        with tagged(sc, "data_preprocessing"):
+            preprocessed_rows = df.count()
+        print(f"Preprocessed data: {preprocessed_rows} rows")
         print(f"Columns: {df.columns}")
+        timings['read_and_preprocess'] = time.perf_counter() - start
+        start = time.perf_counter()
         
         # transform and create dimensions
-        dim_date = proc_date_dim(df, glueContext, spark)
-        dim_cust = proc_cust_dim(df, glueContext)
-        dim_geo = proc_geo_dim(spark, glueContext)
-        dim_prod = proc_prod_dim(df, glueContext)
-        dim_ostatus = proc_ostatus_dim(df, glueContext)
-        dim_emp = proc_emp_dim(df, glueContext)
+        # each function's own Spark jobs are grouped under its name
+        # stored members keep their keys, so stored facts stay valid
+        with tagged(sc, "proc_date_dim"):
+            dim_date = proc_date_dim(
+                df, glueContext, spark, 
+                f"s3://{target_bucket}/{target_folder}dim_date")
+        with tagged(sc, "proc_cust_dim"):
+            dim_cust = proc_cust_dim(
+                df, glueContext, key_method, 
+                f"s3://{target_bucket}/{target_folder}dim_cust")
+        with tagged(sc, "proc_geo_dim"):
+            dim_geo = proc_geo_dim(spark, glueContext)
+        with tagged(sc, "proc_prod_dim"):
+            dim_prod = proc_prod_dim(
+                df, glueContext, key_method, 
+                f"s3://{target_bucket}/{target_folder}dim_prod")
+        with tagged(sc, "proc_ostatus_dim"):
+            dim_ostatus = proc_ostatus_dim(
+                df, glueContext, key_method, 
+                f"s3://{target_bucket}/{target_folder}dim_ostatus")
+        with tagged(sc, "proc_emp_dim"):
+            dim_emp = proc_emp_dim(
+                df, glueContext, key_method, 
+                f"s3://{target_bucket}/{target_folder}dim_emp")
         
         # transform fact table, orders
-        fact_orders = fact_table(df, dim_date, dim_cust, dim_geo, 
-             dim_prod, dim_ostatus, dim_emp, glueContext, spark)
+        with tagged(sc, "fact_table"):
+            fact_orders = fact_table(df, dim_date, dim_cust, dim_geo, 
+                 dim_prod, dim_ostatus, dim_emp, glueContext, spark, join_mode)
+        
+        fact_plan = explain_plan(fact_orders)
+        # only orders that were not loaded before are appended
+        fact_df = fact_orders
+        write_modes, extra_files = {}, {}
+        order_index_path = f"s3://{target_bucket}/{target_folder}order_index"
+        # the orders sent again and the stored versions they replace
+        loaded_df = replaced_df = None
+        if incremental:
+            with tagged(sc, "split_new_orders"):
+                fact_df, loaded_df = split_new_orders(spark, fact_df, 
+                                                      order_index_path)
+            write_modes['fact_orders'] = "append"
+            if on_duplicate != "update":
+                loaded_df = None
+        # the fact write, the rollups, the sketches and the order index all
+        # read the facts, the dimension joins run once for all of them
+        fact_df = fact_df.persist(StorageLevel.MEMORY_AND_DISK)
+        fact_orders = fact_df
+        rollup_df = fact_df
+        if loaded_df is not None:
+            loaded_df = loaded_df.persist(StorageLevel.MEMORY_AND_DISK)
+            updates_path = f"s3://{target_bucket}/{target_folder}fact_orders_updates"
+            with tagged(sc, "stored_versions"):
+                replaced_df = stored_versions(
+                    spark, loaded_df, 
+                    f"s3://{target_bucket}/{target_folder}fact_orders", 
+                    updates_path)
+                extra_files['fact_orders_updates'] = latest_updates(
+                    spark, loaded_df, updates_path)
+            # the rollups take the replaced versions out, the new ones in
+            rollup_df = fact_df.unionByName(loaded_df)
+        
+        # pre-aggregate the fact table for the dashboards
+        with tagged(sc, "proc_rollups"):
+            rollups = proc_rollups(
+                rollup_df, dim_prod, glueContext, spark, 
+                f"s3://{target_bucket}/{target_folder}" if incremental else None, 
+                replaced_df)
         
         # Prepare for saving
         files = [dim_date, dim_cust, dim_geo, dim_prod, dim_ostatus, 
-                 dim_emp, fact_orders]
+                 dim_emp, fact_orders] + list(rollups.values()) + \
+            list(extra_files.values())
         file_names = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 
-                      'dim_ostatus', 'dim_emp', 'fact_orders']
+                      'dim_ostatus', 'dim_emp', 'fact_orders'] + list(rollups) + \
+            list(extra_files)
+        # the dimensions and joins run lazily, most of their cost is in the save
+        timings['transform'] = time.perf_counter() - start
+        start = time.perf_counter()
         # Save all dataframes to S3
-        save_dfs_to_s3(
+        reports = save_dfs_to_s3(
             glueContext=glueContext,  # This is now correctly passed
             dataframes=files,         # Changed from dfs1 to dataframes
             file_names=file_names,
             bucket_name=target_bucket,
             folder_path=target_folder,
-            format="parquet"
+            format="parquet",
+            write_modes=write_modes
         )
+        # the index is updated last, it only lists orders that were written
+        with tagged(sc, "save order_index"):
+            if incremental:
+                save_order_index(fact_df, order_index_path)
+            else:
+                fact_df.select(F.col("order_number").cast("long")).distinct() \
+                       .write.mode("overwrite").parquet(order_index_path)
+        fact_df.unpersist()
+        if loaded_df is not None:
+            loaded_df.unpersist()
+        df.unpersist()
+        # Save the data quality report next to the tables
+        raw_report = report_from_metrics('raw', raw_quality.get)
+        report = summarize([raw_report] + reports, raw_rows - preprocessed_rows)
+        print(f"Data quality failed checks: {report['failed_checks']}")
+        save_report_to_s3(spark, report, 
+                          f"s3://{target_bucket}/{target_folder}dq_report")
+        timings['save'] = time.perf_counter() - start
+        print(f"Stage timings (s): {timings}")
+        save_report_to_s3(spark, {'timings': timings, 'fact_plan': fact_plan}, 
+                          f"s3://{target_bucket}/{target_folder}run_profile")
+        # task metrics of every Spark stage, by pipeline stage
+        stage_report = collect_stage_metrics(sc)
+        print(f"Executor run time by stage (ms): {heaviest(stage_report)}")
+        save_report_to_s3(spark, stage_report, 
+                          f"s3://{target_bucket}/{target_folder}stage_metrics")
         
     except Exception as e:
         print(f"Error in ETL process: {str(e)}")
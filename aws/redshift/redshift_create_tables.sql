@@ -10,6 +10,10 @@ CREATE TABLE dim_cust (
     customer_name VARCHAR(100),
     first_name VARCHAR(50),
     last_name VARCHAR(50),
+    effective_from TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    effective_to TIMESTAMP,
+    is_current BOOLEAN NOT NULL DEFAULT TRUE,
+    row_hash BIGINT,
     create_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     update_date TIMESTAMP
 )
@@ -77,6 +81,10 @@ CREATE TABLE dim_prod (
     category VARCHAR(15) NOT NULL,
     brand VARCHAR(20) NOT NULL,
     standard_cost FLOAT NOT NULL,
+    effective_from TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    effective_to TIMESTAMP,
+    is_current BOOLEAN NOT NULL DEFAULT TRUE,
+    row_hash BIGINT,
     create_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     update_date TIMESTAMP
 )
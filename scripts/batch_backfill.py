@@ -0,0 +1,208 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from local_etl_test import (data_preprocessing, fact_table, merge_rollup,
+                            proc_cust_dim, proc_date_dim, proc_emp_dim,
+                            proc_geo_dim, proc_ostatus_dim, proc_prod_dim,
+                            proc_rollups, read_stored_dim, save_order_index,
+                            ROLLUPS)
+from sketches import SKETCHES
+from raw_cache import read_frame, write_frame
+from stats_catalog import STATS_COLUMNS, record_frames
+
+# Batch mode of the local pipeline for backfills of many export files.
+# 1. Worker processes read and preprocess the files in parallel. Each one
+#    stages its frame as a Feather file and hands back only the distinct
+#    members of every dimension and the order numbers of its file.
+# 2. The driver builds every dimension once from the members of all files,
+#    on top of the stored dimensions, so all files share one keyspace and
+#    keys stay stable between runs.
+# 3. The workers build the fact rows and partial rollups of their files
+#    with the shared dimensions, in parallel again.
+# 4. The driver writes the fact parts into one fact_orders.parquet (a row
+#    group per input file), sums the partial rollups, and swaps all tables
+#    in at once, the order index last.
+# The backfill replaces the fact table, the rollups and the order index;
+# the stored dimensions are extended. Orders found in more than one file
+# stop the backfill before any fact is built.
+#   python etl_cli.py backfill 'exports/2023-*.csv' --workers 8
+
+# dimension: the columns its builder reads, distinct per dimension (all
+# columns together would be distinct for almost every order)
+MEMBER_COLUMNS = {
+    'dim_date': ['order_date'],
+    'dim_cust': ['customer_name'],
+    'dim_prod': ['product', 'category', 'brand', 'cost'],
+    'dim_ostatus': ['status'],
+    'dim_emp': ['assigned supervisor'],
+}
+DIMENSIONS = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 'dim_ostatus',
+              'dim_emp']
+
+
+def expand_inputs(patterns):
+    "Files of the given paths and glob patterns, in sorted order per pattern"
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) \
+            else [pattern]
+        if not matches:
+            raise FileNotFoundError(f"No input files match {pattern}")
+        files += [m for m in matches if m not in files]
+    return files
+
+
+# worker stages
+def _prepare(i, path, stage_dir):
+    "Preprocess one file, returns its members and order numbers"
+    raw = pd.read_csv(path)
+    df = data_preprocessing(raw)
+    staged = os.path.join(stage_dir, f"pre-{i:05d}.feather")
+    write_frame(df, staged)
+    return {'path': path, 'staged': staged, 'raw_rows': len(raw),
+            'rows': len(df),
+            'members': {name: df[columns].drop_duplicates()
+                        for name, columns in MEMBER_COLUMNS.items()},
+            'orders': df['order_number'].to_numpy(dtype='int64')}
+
+
+def _build_facts(i, staged, dims, stage_dir):
+    "Fact rows and partial rollups of one preprocessed file"
+    df = read_frame(staged)
+    facts = fact_table(df, *(dims[name] for name in DIMENSIONS))
+    part = os.path.join(stage_dir, f"fact-{i:05d}.parquet")
+    facts.to_parquet(part, compression='snappy', index=False)
+    csv_part = os.path.join(stage_dir, f"fact-{i:05d}.csv")
+    facts.to_csv(csv_part, index=False)
+    stats = facts[[c for c in STATS_COLUMNS if c in facts.columns]]
+    return {'part': part, 'csv': csv_part, 'stats': stats,
+            'rollups': proc_rollups(facts, dims['dim_prod'])}
+
+
+# driver stages
+def build_dimensions(members):
+    "Every dimension once over the members of all files, {dim: frame}"
+    dims = {
+        'dim_date': proc_date_dim(members['dim_date'],
+                                  read_stored_dim('dim_date')),
+        'dim_cust': proc_cust_dim(members['dim_cust'],
+                                  read_stored_dim('dim_cust')),
+        'dim_geo': read_stored_dim('dim_geo'),
+        'dim_prod': proc_prod_dim(members['dim_prod'],
+                                  read_stored_dim('dim_prod')),
+        'dim_ostatus': proc_ostatus_dim(members['dim_ostatus'],
+                                        read_stored_dim('dim_ostatus')),
+        'dim_emp': proc_emp_dim(members['dim_emp'],
+                                read_stored_dim('dim_emp')),
+    }
+    if dims['dim_geo'] is None:
+        dims['dim_geo'] = proc_geo_dim()
+    return dims
+
+
+def _combine_parquet(parts, path):
+    "One Parquet file with a row group per part, no pandas round trip"
+    import pyarrow.parquet as pq
+    writer = None
+    try:
+        for part in parts:
+            table = pq.read_table(part)
+            if writer is not None and table.schema != writer.schema:
+                # e.g. a key column with nulls in one part only
+                table = table.cast(writer.schema)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema,
+                                          compression='snappy')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _combine_csv(parts, path):
+    with open(path, 'wb') as out:
+        for i, part in enumerate(parts):
+            with open(part, 'rb') as f:
+                if i:
+                    # the header is written once
+                    f.readline()
+                shutil.copyfileobj(f, out)
+
+
+def run_backfill(patterns, workers=None):
+    """Build one star schema from many export files, returns the tables.
+
+    workers defaults to the number of cores.
+    """
+    start = time.perf_counter()
+    files = expand_inputs(patterns)
+    workers = workers or os.cpu_count()
+    print(f"Backfilling {len(files)} files with {workers} workers")
+    with tempfile.TemporaryDirectory(prefix='.backfill-', dir='.') \
+            as stage_dir, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        prepared = list(pool.map(_prepare, range(len(files)), files,
+                                 [stage_dir] * len(files)))
+        orders = np.concatenate([p['orders'] for p in prepared])
+        index, counts = np.unique(orders, return_counts=True)
+        if (counts > 1).any():
+            raise ValueError(f"{int((counts > 1).sum())} order numbers appear "
+                             f"more than once in the input files")
+        # in file order, so members keep the order they first appear in
+        members = {name: pd.concat([p['members'][name] for p in prepared],
+                                   ignore_index=True).drop_duplicates()
+                   for name in MEMBER_COLUMNS}
+        dims = build_dimensions(members)
+        print(f"Shared dimensions built from "
+              f"{sum(len(m) for m in members.values())} members in "
+              f"{time.perf_counter() - start:.1f}s")
+        built = list(pool.map(_build_facts, range(len(files)),
+                              [p['staged'] for p in prepared],
+                              [dims] * len(files), [stage_dir] * len(files)))
+        rollups = {}
+        for name in list(ROLLUPS) + list(SKETCHES):
+            partials = [b['rollups'][name] for b in built]
+            # the measures are additive and the sketches mergeable, the
+            # partials combine to the rollup
+            rollups[name] = merge_rollup(pd.concat(partials[1:]),
+                                         partials[0], name) \
+                if len(partials) > 1 else partials[0]
+        tables = dict(dims, **rollups)
+        # every file is written aside first and renamed once all are
+        staged = []
+        try:
+            for name, df in tables.items():
+                staged.append((f".{name}.parquet.tmp", f"{name}.parquet"))
+                df.to_parquet(staged[-1][0], compression='snappy')
+                # binary sketches have no CSV form
+                if name not in SKETCHES:
+                    staged.append((f".{name}.csv.tmp", f"{name}.csv"))
+                    df.to_csv(staged[-1][0], index=False)
+            staged += [('.fact_orders.parquet.tmp', 'fact_orders.parquet'),
+                       ('.fact_orders.csv.tmp', 'fact_orders.csv')]
+            _combine_parquet([b['part'] for b in built], staged[-2][0])
+            _combine_csv([b['csv'] for b in built], staged[-1][0])
+        except Exception:
+            for tmp, _ in staged:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+        for tmp, path in staged:
+            os.replace(tmp, path)
+        # the index is saved last, it only lists orders that were written
+        save_order_index(index)
+        tables['fact_orders'] = pd.concat([b['stats'] for b in built],
+                                          ignore_index=True)
+    # the fact statistics come from its key columns, kept by the workers
+    record_frames({name: (f"{name}.parquet", df)
+                   for name, df in tables.items()})
+    print(f"Backfill of {sum(p['rows'] for p in prepared)} orders from "
+          f"{len(files)} files done in {time.perf_counter() - start:.1f}s")
+    return list(dims) + ['fact_orders'] + list(rollups)
@@ -0,0 +1,164 @@
+import hashlib
+import inspect
+import os
+import pickle
+import time
+from pathlib import Path
+
+# Stage checkpoints of the local pipeline.
+# Every transform stage saves its output under a key derived from the
+# fingerprints of its inputs and the source code of the stage: the module
+# of the stage function and every module of the pipeline it imports from,
+# so a change to a helper (apply_scd2, metrics.py, ...) reruns the stage. A
+# rerun computes the same keys first and loads the output of every stage
+# whose key is still on disk, so a run that failed late (e.g. while saving)
+# resumes at the failed stage instead of building every dimension again.
+# Outputs of stages are fingerprinted by their key, stored tables by their
+# files' names, sizes and modification times, other inputs by their
+# content, once per run. The checkpoints of a run are removed once the run
+# completed,
+# its saved tables are then the inputs of the next run.
+
+CHECKPOINT_DIR = os.environ.get('ETL_CHECKPOINT_DIR', '.etl_checkpoints')
+# rows of a frame hashed at a time
+HASH_ROWS = 1 << 16
+
+
+def fingerprint(value):
+    "Content hash of a stage input"
+    import numpy as np
+    import pandas as pd
+    h = hashlib.sha256()
+    if value is None:
+        h.update(b'none')
+    elif isinstance(value, pd.DataFrame):
+        h.update(repr(list(zip(value.columns, value.dtypes.astype(str))))
+                 .encode())
+        # hashed in slices, the row hashes of a slice are all that is held
+        for start in range(0, len(value), HASH_ROWS):
+            h.update(pd.util.hash_pandas_object(
+                value.iloc[start:start + HASH_ROWS], index=True)
+                .to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(str(value.dtype).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for k in sorted(value):
+            h.update(repr(k).encode())
+            h.update(fingerprint(value[k]).encode())
+    else:
+        h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+def file_fingerprint(path):
+    "Hash of the name, size and mtime of a file or of every file in a folder"
+    path = Path(path)
+    files = sorted(p for p in path.rglob('*') if p.is_file()) \
+        if path.is_dir() else [path]
+    h = hashlib.sha256(b'files')
+    for p in files:
+        stat = p.stat()
+        h.update(f"{p.name}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def code_fingerprint(fn):
+    "Hash of the sources of fn's module and the pipeline modules it uses"
+    module = inspect.getmodule(fn)
+    root = Path(module.__file__).resolve().parent
+    seen, pending = {}, [module]
+    while pending:
+        module = pending.pop()
+        path = Path(module.__file__).resolve()
+        if path in seen:
+            continue
+        seen[path] = path.read_bytes()
+        # modules imported by name, or through the functions and classes
+        # imported from them, next to the stage module
+        for value in vars(module).values():
+            used = value if inspect.ismodule(value) else inspect.getmodule(value)
+            source = getattr(used, '__file__', None)
+            if source and Path(source).resolve().parent == root:
+                pending.append(used)
+    h = hashlib.sha256()
+    for path in sorted(seen):
+        h.update(path.name.encode())
+        h.update(seen[path])
+    return h.hexdigest()
+
+
+class Checkpoints:
+    "Run pipeline stages, loading the outputs of unchanged ones"
+
+    def __init__(self, directory=CHECKPOINT_DIR, enabled=True):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        # (object, key) of every stage output and input of this run, by
+        # object identity; the object is kept so its id cannot be reused
+        self._keys = {}
+        # code fingerprint of every stage function
+        self._code = {}
+
+    def _known(self, value):
+        entry = self._keys.get(id(value))
+        return entry[1] if entry is not None and entry[0] is value else None
+
+    def remember(self, value, key):
+        "Use key as the fingerprint of value for the rest of the run"
+        self._keys[id(value)] = (value, key)
+        return value
+
+    def _fingerprint(self, value):
+        key = self._known(value)
+        if key is None:
+            # an input is hashed once per run, however many stages read it
+            key = fingerprint(value)
+            self.remember(value, key)
+        return key
+
+    def key(self, name, fn, args):
+        h = hashlib.sha256(name.encode())
+        if fn not in self._code:
+            self._code[fn] = code_fingerprint(fn)
+        h.update(self._code[fn].encode())
+        for arg in args:
+            h.update(self._fingerprint(arg).encode())
+        return h.hexdigest()
+
+    def run(self, name, fn, *args):
+        "fn(*args), or its checkpointed output when the inputs are unchanged"
+        if not self.enabled:
+            return fn(*args)
+        key = self.key(name, fn, args)
+        path = self.directory / f"{name}-{key[:24]}.pkl"
+        if path.exists():
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            print(f"Stage {name}: inputs unchanged, checkpoint reused")
+        else:
+            start = time.perf_counter()
+            result = fn(*args)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # written then renamed, a crash never leaves a partial checkpoint
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            print(f"Stage {name}: ran in {time.perf_counter() - start:.2f}s")
+        self.remember(result, key)
+        # the parts of a tuple or dict output are inputs of later stages
+        parts = result.values() if isinstance(result, dict) else \
+            result if isinstance(result, tuple) else ()
+        for i, part in enumerate(parts):
+            if self._known(part) is None:
+                self.remember(part, f"{key}:{i}")
+        return result
+
+    def complete(self):
+        "The run was saved, its checkpoints are not needed any more"
+        if not self.enabled or not self.directory.exists():
+            return
+        for path in self.directory.glob('*.pkl'):
+            path.unlink(missing_ok=True)
+        self._keys.clear()
@@ -0,0 +1,179 @@
+import json
+
+# Data quality profile shared by the local (pandas) and the Glue (PySpark)
+# pipelines. The checks mirror the constraints in
+# aws/redshift/redshift_create_tables.sql, so a failing check here is a row
+# that Redshift would reject on load.
+# In PySpark the aggregates are attached to the dataframe with observe(), so
+# they are computed while the table is written instead of by a second scan.
+# The Glue job imports this file through --extra-py-files.
+
+# columns whose null count must be reported before preprocessing
+RAW_COLUMNS = ['Order_Number', 'Order_Date', 'Customer_Name', 'Product',
+               'Status', 'State_Code', 'Assigned Supervisor']
+
+# range checks: (constraint name, column, lower bound, upper bound)
+# the bounds are inclusive, None means unbounded, nulls pass like in SQL
+RANGE_CHECKS = {
+    'fact_orders': [
+        # quantity > 0 on an integer column
+        ('check_quantity_positive', 'quantity', 1, None),
+        ('check_profit_margin', 'profit_margin', -1, 1),
+    ],
+    'dim_date': [
+        ('check_day_of_week', 'day_of_week', 1, 7),
+        ('check_month_num', 'month_num', 1, 12),
+        ('check_quarter', 'quarter', 1, 4),
+    ],
+}
+
+# foreign keys of the fact table and the dimension they reference
+# a key that did not resolve is null locally and -1 in the Glue job
+REFERENCES = {
+    'customer_id': 'dim_cust',
+    'state_id': 'dim_geo',
+    'product_id': 'dim_prod',
+    'status_id': 'dim_ostatus',
+    'employee_id': 'dim_emp',
+}
+
+# columns to profile per table, None means every column
+PROFILE_COLUMNS = {
+    'raw': RAW_COLUMNS,
+}
+
+
+def _columns(table, columns):
+    wanted = PROFILE_COLUMNS.get(table)
+    if wanted is None:
+        return list(columns)
+    # the Glue catalog lower-cases the raw column names
+    by_name = {c.lower(): c for c in columns}
+    return [by_name[c.lower()] for c in wanted if c.lower() in by_name]
+
+
+def _build_report(table, rows, stats):
+    "Shape the per-column and per-check counters into the report layout"
+    report = {'table': table, 'rows': rows, 'columns': {}, 'checks': {},
+              'references': {}}
+    for col, (nulls, distinct) in stats['columns'].items():
+        report['columns'][col] = {
+            'null_count': nulls,
+            'null_rate': round(nulls / rows, 6) if rows else 0.0,
+            'distinct_count': distinct,
+        }
+    for name, (col, violations) in stats['checks'].items():
+        report['checks'][name] = {'column': col, 'violations': violations,
+                                  'passed': violations == 0}
+    for col, (dim, misses) in stats['references'].items():
+        report['references'][col] = {'dimension': dim, 'misses': misses,
+                                     'passed': misses == 0}
+    return report
+
+
+# pandas
+def profile_frame(df, table):
+    "Profile a pandas DataFrame in one vectorized pass per column"
+    import numpy as np
+    stats = {'columns': {}, 'checks': {}, 'references': {}}
+    for col in _columns(table, df.columns):
+        series = df[col]
+        stats['columns'][col] = (int(series.isna().sum()),
+                                 int(series.nunique(dropna=True)))
+    for name, col, low, high in RANGE_CHECKS.get(table, []):
+        if col not in df.columns:
+            continue
+        values = df[col].to_numpy(dtype='float64', na_value=np.nan)
+        bad = np.zeros(len(values), dtype=bool)
+        if low is not None:
+            bad |= values < low
+        if high is not None:
+            bad |= values > high
+        stats['checks'][name] = (col, int(bad.sum()))
+    if table == 'fact_orders':
+        for col, dim in REFERENCES.items():
+            if col not in df.columns:
+                continue
+            series = df[col]
+            misses = series.isna() | (series == -1)
+            stats['references'][col] = (dim, int(misses.sum()))
+    return _build_report(table, len(df), stats)
+
+
+# PySpark
+def quality_exprs(table, columns):
+    "Aggregate expressions for one table, usable in agg() or observe()"
+    from pyspark.sql import functions as F
+    exprs = [F.count(F.lit(1)).alias('rows')]
+    for col in _columns(table, columns):
+        c = F.col(f"`{col}`")
+        exprs.append(F.sum(c.isNull().cast('long')).alias(f"{col}|nulls"))
+        # exact distinct aggregates are not allowed in observe()
+        exprs.append(F.approx_count_distinct(c).alias(f"{col}|distinct"))
+    for name, col, low, high in RANGE_CHECKS.get(table, []):
+        if col not in columns:
+            continue
+        c = F.col(col)
+        bad = F.lit(False)
+        if low is not None:
+            bad = bad | (c < low)
+        if high is not None:
+            bad = bad | (c > high)
+        exprs.append(F.sum(F.when(bad, 1).otherwise(0)).alias(f"{name}|check"))
+    if table == 'fact_orders':
+        for col in REFERENCES:
+            if col not in columns:
+                continue
+            c = F.col(col)
+            miss = c.isNull() | (c.cast('string') == '-1')
+            exprs.append(F.sum(miss.cast('long')).alias(f"{col}|ref"))
+    return exprs
+
+
+def observe_quality(df, table):
+    "Attach the profile to a Spark DataFrame, returns (df, observation)"
+    from pyspark.sql import Observation
+    observation = Observation(f"dq_{table}")
+    return df.observe(observation, *quality_exprs(table, df.columns)), observation
+
+
+def report_from_metrics(table, metrics):
+    "Build the report from the collected aggregates of quality_exprs()"
+    stats = {'columns': {}, 'checks': {}, 'references': {}}
+    checks = {name: col for name, col, _, _ in RANGE_CHECKS.get(table, [])}
+    for key, value in metrics.items():
+        if '|' not in key:
+            continue
+        col, kind = key.rsplit('|', 1)
+        value = int(value or 0)
+        if kind == 'nulls':
+            stats['columns'].setdefault(col, [0, 0])[0] = value
+        elif kind == 'distinct':
+            stats['columns'].setdefault(col, [0, 0])[1] = value
+        elif kind == 'check':
+            stats['checks'][col] = (checks[col], value)
+        elif kind == 'ref':
+            stats['references'][col] = (REFERENCES[col], value)
+    stats['columns'] = {k: tuple(v) for k, v in stats['columns'].items()}
+    return _build_report(table, int(metrics.get('rows') or 0), stats)
+
+
+# report
+def summarize(reports, dropped_rows=0):
+    "Combine the table reports into one JSON-serializable document"
+    failed = [f"{r['table']}.{name}"
+              for r in reports
+              for section in ('checks', 'references')
+              for name, result in r[section].items() if not result['passed']]
+    return {
+        'dropped_null_order_number': int(dropped_rows),
+        'tables': {r['table']: r for r in reports},
+        'failed_checks': failed,
+    }
+
+
+def write_report(report, path):
+    "Write the report as JSON"
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Data quality report saved to {path}")
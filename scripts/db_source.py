@@ -0,0 +1,440 @@
+import argparse
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from landing_zone import (LANDING_DIR, PARTITION, QUARANTINE_DIR, RAW_SCHEMA,
+                          REQUIRED, enforce_schema, load_manifest,
+                          save_manifest)
+
+# Database source of the local pipeline.
+# The orders are read from a table of the OLTP database with the columns of
+# RAW_SCHEMA (landing_zone.py). The range of the split column (order_number
+# or order_date) is cut into contiguous ranges that are read in parallel,
+# each over a connection of a small pool and through a server-side cursor
+# in fetchmany batches. Every batch is turned into typed Arrow columns right
+# away, so a reader never holds more than one batch as Python rows and the
+# result set never exists as rows at all. iter_batches hands the batches
+# over in range order, every reader at most QUEUE_BATCHES ahead of the
+# consumer, so an extract can be written to the landing zone batch by batch
+# without the whole result set in memory; read_orders builds one frame.
+# Drivers: sqlite:///<path> (the standard library, the local stand-in for
+# the OLTP database) and postgresql://... (psycopg2, named cursors keep the
+# result set on the server).
+#   python db_source.py sample orders.db ../data/raw/Online-eCommerce.csv
+#   python db_source.py read sqlite:///orders.db --partitions 4
+#   python db_source.py land sqlite:///orders.db --landing-dir landing
+#   python etl_cli.py run --db-url sqlite:///orders.db
+
+DB_TABLE = 'orders'
+SPLIT_COLUMNS = {'order_number': 'Order_Number', 'order_date': 'Order_Date'}
+PARTITIONS = 4
+BATCH_ROWS = 10000
+# batches a range reader may read ahead of the consumer
+QUEUE_BATCHES = 2
+
+
+# connections
+def _connector(url):
+    "(driver name, function opening one connection) of a database url"
+    if url.startswith('sqlite:///'):
+        import sqlite3
+        path = url[len('sqlite:///'):]
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No SQLite database at {path}")
+        # the readers run in threads, each connection in one at a time
+        return 'sqlite', lambda: sqlite3.connect(path,
+                                                 check_same_thread=False)
+    if url.startswith(('postgresql://', 'postgres://')):
+        import psycopg2
+        return 'postgresql', lambda: psycopg2.connect(url)
+    raise ValueError(f"Unsupported database url: {url}")
+
+
+class ConnectionPool:
+    "At most size connections, opened on first use and reused"
+
+    def __init__(self, connect, size=PARTITIONS):
+        self._connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = self._connect() if len(self._opened) < self.size \
+                    else None
+                if conn is not None:
+                    self._opened.append(conn)
+            if conn is None:
+                # every connection is in use, wait for one
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            # a read only transaction, nothing to keep
+            conn.rollback()
+            self._idle.put(conn)
+
+    def close(self):
+        for conn in self._opened:
+            conn.close()
+        self._opened = []
+
+
+# ranges
+def split_ranges(low, high, parts):
+    """parts contiguous [start, end) ranges covering low to high.
+
+    Works on ints and on timestamps (split by whole days).
+    """
+    import pandas as pd
+    if isinstance(low, pd.Timestamp):
+        days = split_ranges(0, (high - low).days, parts)
+        return [(low + pd.Timedelta(days=a), low + pd.Timedelta(days=b))
+                for a, b in days]
+    step = max(1, -(-(high - low + 1) // parts))
+    return [(start, min(start + step, high + 1))
+            for start in range(low, high + 1, step)]
+
+
+def _typed(values, kind):
+    "One column of a batch as a typed Arrow array"
+    import pyarrow as pa
+    types = {'long': pa.int64(), 'double': pa.float64(),
+             'date': pa.date32(), 'string': pa.string()}
+    # the driver's types (str, date, Decimal, ...) are inferred, then cast
+    array = pa.array(values, from_pandas=True)
+    if array.type == types[kind]:
+        return array
+    return array.cast(types[kind], safe=(kind != 'date'))
+
+
+def _batch_table(rows, columns):
+    import pyarrow as pa
+    values = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [_typed(list(v), RAW_SCHEMA[c]) for c, v in zip(columns, values)],
+        names=columns)
+
+
+class DatabaseSource:
+    "The orders table of a database, read in parallel ranges"
+
+    def __init__(self, url, table=DB_TABLE, split='order_number',
+                 partitions=PARTITIONS, batch_rows=BATCH_ROWS):
+        if split not in SPLIT_COLUMNS:
+            raise ValueError(f"Unknown split column: {split}")
+        self.url = url
+        self.table = table
+        self.split = SPLIT_COLUMNS[split]
+        self.partitions = partitions
+        self.batch_rows = batch_rows
+        self.driver, connect = _connector(url)
+        self.pool = ConnectionPool(connect, partitions)
+        # sqlite3 takes ?, psycopg2 %s
+        self._param = '?' if self.driver == 'sqlite' else '%s'
+
+    def _cursor(self, conn):
+        if self.driver == 'postgresql':
+            # a named cursor streams the rows from the server
+            cursor = conn.cursor(name=f"etl_{uuid.uuid4().hex[:12]}")
+            cursor.itersize = self.batch_rows
+            return cursor
+        # sqlite3 steps through the result as it is fetched
+        return conn.cursor()
+
+    def _where(self, start=None, end=None):
+        "Order date filters as (SQL, parameters)"
+        clauses, params = [], []
+        if start is not None:
+            clauses.append(f'"Order_Date" >= {self._param}')
+            params.append(str(start.date()))
+        if end is not None:
+            clauses.append(f'"Order_Date" <= {self._param}')
+            params.append(str(end.date()))
+        return clauses, params
+
+    def bounds(self, start=None, end=None):
+        "Lowest and highest value of the split column"
+        import pandas as pd
+        clauses, params = self._where(start, end)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT MIN("{self.split}"), MAX("{self.split}") '
+                           f'FROM {self.table}{where}', params)
+            low, high = cursor.fetchone()
+            cursor.close()
+        if low is None:
+            return None
+        if self.split == 'Order_Date':
+            return pd.Timestamp(low), pd.Timestamp(high)
+        return int(low), int(high)
+
+    def ranges(self, start=None, end=None):
+        limits = self.bounds(start, end)
+        if limits is None:
+            return []
+        return split_ranges(*limits, self.partitions)
+
+    def read_range(self, low, high, first=False, start=None, end=None):
+        "Typed Arrow batches of one range, read in fetchmany batches"
+        return list(self.range_batches(low, high, first, start, end))
+
+    def range_batches(self, low, high, first=False, start=None, end=None):
+        "Typed Arrow batches of one range, one fetchmany batch at a time"
+        import pandas as pd
+        clauses, params = self._where(start, end)
+        if isinstance(low, pd.Timestamp):
+            low, high = str(low.date()), str(high.date())
+        split = f'"{self.split}" >= {self._param} AND ' \
+                f'"{self.split}" < {self._param}'
+        if first:
+            # rows without a split value are read with the first range
+            split = f'({split} OR "{self.split}" IS NULL)'
+        columns = list(RAW_SCHEMA)
+        select = ', '.join(f'"{c}"' for c in columns)
+        sql = f'SELECT {select} FROM {self.table} ' \
+              f'WHERE {" AND ".join([split] + clauses)} ' \
+              f'ORDER BY "{self.split}"'
+        with self.pool.connection() as conn:
+            cursor = self._cursor(conn)
+            try:
+                cursor.execute(sql, [low, high] + params)
+                while True:
+                    rows = cursor.fetchmany(self.batch_rows)
+                    if not rows:
+                        break
+                    yield _batch_table(rows, columns)
+            finally:
+                cursor.close()
+
+    def iter_batches(self, start=None, end=None):
+        """Typed Arrow batches of the orders, in range order.
+
+        The ranges are read in parallel, each reader at most QUEUE_BATCHES
+        batches ahead of the consumer. start and end limit the order dates.
+        """
+        import pandas as pd
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+        ranges = self.ranges(start, end)
+        queues = [queue.Queue(QUEUE_BATCHES) for _ in ranges]
+        stop = threading.Event()
+        done = object()
+
+        def put(q, item):
+            # gives up once the consumer stopped reading
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read(i):
+            q = queues[i]
+            try:
+                for batch in self.range_batches(*ranges[i], i == 0, start,
+                                                end):
+                    if not put(q, batch):
+                        return
+            except Exception as e:
+                put(q, e)
+                return
+            put(q, done)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as pool:
+            for i in range(len(ranges)):
+                pool.submit(read, i)
+            try:
+                for q in queues:
+                    while True:
+                        item = q.get()
+                        if item is done:
+                            break
+                        if isinstance(item, Exception):
+                            raise item
+                        yield item
+            finally:
+                stop.set()
+
+    def read_orders(self, start=None, end=None):
+        """The orders as one typed frame, like read_landing returns them.
+
+        start and end limit the order dates.
+        """
+        import pyarrow as pa
+        import pandas as pd
+        started = time.perf_counter()
+        batches = list(self.iter_batches(start, end))
+        count = len(batches)
+        if batches:
+            table = pa.concat_tables(batches)
+            del batches
+            # the Arrow buffers are released column by column as they are
+            # converted, the orders never exist twice in full
+            df = table.to_pandas(self_destruct=True, split_blocks=True)
+            del table
+        else:
+            df = pd.DataFrame(columns=list(RAW_SCHEMA))
+        for col, kind in RAW_SCHEMA.items():
+            if kind == 'date':
+                df[col] = pd.to_datetime(df[col])
+        print(f"Read {len(df)} rows from {self.table} by {self.split} "
+              f"in {count} batches in "
+              f"{time.perf_counter() - started:.1f}s")
+        return df
+
+    def land(self, landing_dir=LANDING_DIR, start=None, end=None):
+        """Write the orders into the landing zone batch by batch.
+
+        Every batch is split by order month into part files like a landed
+        CSV drop, rows missing a required value go to the quarantine; at
+        most one batch per reader is in memory. Returns the manifest entry
+        of the extract.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        landing = Path(landing_dir)
+        landing.mkdir(parents=True, exist_ok=True)
+        extract = f"db-{uuid.uuid4().hex[:16]}"
+        staged, rows, quarantined = [], 0, 0
+        try:
+            for n, batch in enumerate(self.iter_batches(start, end)):
+                name = f"part-{extract[3:]}-{n:05d}"
+                missing = pc.is_null(batch[REQUIRED[0]])
+                for col in REQUIRED[1:]:
+                    missing = pc.or_(missing, pc.is_null(batch[col]))
+                bad = batch.filter(missing)
+                if len(bad):
+                    folder = landing / QUARANTINE_DIR
+                    folder.mkdir(exist_ok=True)
+                    tmp = folder / f".{name}.csv.tmp"
+                    bad.to_pandas().assign(
+                        _error='a required value is missing').to_csv(
+                            tmp, index=False)
+                    staged.append((tmp, folder / f"{name}.csv"))
+                    quarantined += len(bad)
+                good = batch.filter(pc.invert(missing))
+                rows += len(good)
+                months = pc.strftime(pc.cast(good['Order_Date'],
+                                             pa.timestamp('s')), '%Y-%m')
+                for month in pc.unique(months).to_pylist():
+                    folder = landing / f"{PARTITION}={month}"
+                    folder.mkdir(exist_ok=True)
+                    # dot files are ignored by readers until they are renamed
+                    tmp = folder / f".{name}.parquet.tmp"
+                    pq.write_table(good.filter(pc.equal(months, month)), tmp,
+                                   compression='snappy')
+                    staged.append((tmp, folder / f"{name}.parquet"))
+        except Exception:
+            for tmp, _ in staged:
+                tmp.unlink(missing_ok=True)
+            raise
+        for tmp, path in staged:
+            os.replace(tmp, path)
+        manifest = load_manifest(landing_dir)
+        # the url without its credentials
+        entry = {'source': f"{self.url.split('@')[-1]}/{self.table}",
+                 'rows': rows, 'quarantined': quarantined,
+                 'files': [str(p) for _, p in staged],
+                 'landed_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+        manifest[extract] = entry
+        save_manifest(manifest, landing_dir)
+        print(f"Landed {rows} rows of {self.table} in {len(staged)} files, "
+              f"{quarantined} rows quarantined")
+        return entry
+
+    def close(self):
+        self.pool.close()
+
+
+# local stand-in
+def make_sqlite(db_path, csv_paths, table=DB_TABLE):
+    "A SQLite orders table from raw CSV exports, indexed like the OLTP one"
+    import sqlite3
+    import pandas as pd
+    types = {'long': 'INTEGER', 'double': 'REAL', 'date': 'DATE',
+             'string': 'TEXT'}
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = ', '.join(f'"{c}" {types[k]}' for c, k in RAW_SCHEMA.items())
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+        for column in SPLIT_COLUMNS.values():
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} '
+                         f'ON {table} ("{column}")')
+        rows = 0
+        for path in csv_paths:
+            good, _ = enforce_schema(pd.read_csv(path, dtype=str))
+            # dates are stored as ISO text, SQLite's date format
+            good['Order_Date'] = good['Order_Date'].dt.strftime('%Y-%m-%d')
+            good = good.astype(object).where(good.notna(), None)
+            marks = ', '.join('?' * len(RAW_SCHEMA))
+            conn.executemany(f'INSERT INTO {table} VALUES ({marks})',
+                             good.itertuples(index=False, name=None))
+            rows += len(good)
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Loaded {rows} orders into {table} of {db_path}")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Read the orders from a database, or build a local one")
+    commands = parser.add_subparsers(dest='command', required=True)
+    sample = commands.add_parser(
+        'sample', help="load raw CSV exports into a SQLite orders table")
+    sample.add_argument('db_path')
+    sample.add_argument('files', nargs='+')
+    sample.add_argument('--table', default=DB_TABLE)
+    read = commands.add_parser('read', help="read the orders table")
+    read.add_argument('url')
+    read.add_argument('--table', default=DB_TABLE)
+    read.add_argument('--split', choices=list(SPLIT_COLUMNS),
+                      default='order_number')
+    read.add_argument('--partitions', type=int, default=PARTITIONS)
+    read.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    land = commands.add_parser(
+        'land', help="write the orders table into the landing "
+                                 "zone batch by batch")
+    land.add_argument('url')
+    land.add_argument('--landing-dir', default=LANDING_DIR)
+    land.add_argument('--table', default=DB_TABLE)
+    land.add_argument('--split', choices=list(SPLIT_COLUMNS),
+                      default='order_number')
+    land.add_argument('--partitions', type=int, default=PARTITIONS)
+    land.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    args = parser.parse_args(argv)
+    if args.command == 'sample':
+        make_sqlite(args.db_path, args.files, args.table)
+        return 0
+    source = DatabaseSource(args.url, args.table, args.split,
+                            args.partitions, args.batch_rows)
+    try:
+        if args.command == 'land':
+            source.land(args.landing_dir)
+        else:
+            print(source.read_orders().dtypes.to_string())
+    finally:
+        source.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,404 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+# Benchmark and output equivalence of the two pipeline engines.
+# The sample export is repeated at several scales (memory_guard.make_input)
+# and each engine builds the star schema from the same CSV in its own fresh
+# interpreter: the pandas stages of local_etl_test.py, and the Glue job
+# functions of aws/glue/glue_etl_job.py on a local-mode SparkSession, with
+# small stand-ins for the awsglue wrappers when the Glue libraries are not
+# installed. Both write Parquet, and the outputs are compared table by
+# table after the surrogate keys are resolved to natural keys through each
+# engine's own dimensions, since the keys themselves are engine specific.
+# The report has the seconds, rows per second and peak memory per engine
+# and scale, the column mismatches per table, and the row counts at which
+# the faster engine changes.
+# The Spark run also leaves the task metrics of its stages, by pipeline
+# stage, in stage_metrics.json next to its tables (see stage_metrics.py).
+#   python engine_benchmark.py --scales 1 10 50 --cores 4
+
+SCRIPTS = Path(__file__).resolve().parent
+GLUE_DIR = SCRIPTS.parent / 'aws' / 'glue'
+SCALES = [1, 10, 50]
+
+# table: (natural key, {foreign key: (dimension, key, natural attribute)},
+#         columns that differ by design and are not compared)
+SURROGATE = ['create_date', 'update_date', 'effective_from', 'effective_to',
+             'row_hash']
+TABLES = {
+    'dim_date': (['date_full'], {}, []),
+    'dim_cust': (['customer_name'], {}, ['customer_id'] + SURROGATE),
+    'dim_geo': (['country', 'state_code'], {}, ['state_id', 'created_at']),
+    'dim_prod': (['product_name', 'category', 'brand'], {},
+                 ['product_id'] + SURROGATE),
+    'dim_ostatus': (['status_name'], {}, ['status_id'] + SURROGATE),
+    'dim_emp': (['employee_name'], {}, ['employee_id'] + SURROGATE),
+    'fact_orders': (['order_number'], {
+        'customer_id': ('dim_cust', 'customer_id', 'customer_name'),
+        'state_id': ('dim_geo', 'state_id', 'state_code'),
+        'product_id': ('dim_prod', 'product_id', 'product_name'),
+        'status_id': ('dim_ostatus', 'status_id', 'status_name'),
+        'employee_id': ('dim_emp', 'employee_id', 'employee_name'),
+    }, []),
+    'agg_daily_product': (['order_date', 'product_id'], {
+        'product_id': ('dim_prod', 'product_id', 'product_name'),
+    }, []),
+    'agg_daily_state': (['order_date', 'state_id'], {
+        'state_id': ('dim_geo', 'state_id', 'state_code'),
+    }, []),
+    'agg_monthly_supervisor_category': (
+        ['order_month', 'employee_id', 'category'], {
+            'employee_id': ('dim_emp', 'employee_id', 'employee_name'),
+        }, []),
+}
+DIMENSIONS = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 'dim_ostatus',
+              'dim_emp']
+
+
+# Glue stand-ins
+def install_glue_standins():
+    "Register minimal awsglue modules when the Glue libraries are missing"
+    try:
+        import awsglue  # noqa: F401
+        return False
+    except ImportError:
+        pass
+    from pyspark.sql import SparkSession
+
+    class DynamicFrame:
+        def __init__(self, df, glue_ctx=None, name=None):
+            self._df, self.glue_ctx, self.name = df, glue_ctx, name
+
+        @classmethod
+        def fromDF(cls, df, glue_ctx, name):
+            return cls(df, glue_ctx, name)
+
+        def toDF(self):
+            return self._df
+
+    class GlueContext:
+        def __init__(self, sc):
+            self.spark_session = SparkSession(sc)
+
+    modules = {
+        'awsglue': {},
+        'awsglue.transforms': {'Join': object, '__all__': []},
+        'awsglue.utils': {'getResolvedOptions': lambda argv, names: {}},
+        'awsglue.context': {'GlueContext': GlueContext,
+                            'DynamicFrameCollection': dict},
+        'awsglue.job': {'Job': object},
+        'awsglue.dynamicframe': {'DynamicFrame': DynamicFrame},
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+    return True
+
+
+def _to_df(frame):
+    # older revisions of the Glue job return DynamicFrames, so the same
+    # harness times the job before and after it became DataFrame native
+    from pyspark.sql import DataFrame
+    return frame if isinstance(frame, DataFrame) else frame.toDF()
+
+
+# engines, each run in a fresh interpreter
+def run_pandas(csv_path, out_dir):
+    import pandas as pd
+    import local_etl_test as etl
+    from memory_guard import current_rss, peak_rss, reset_peak_rss
+    baseline = current_rss()
+    reset_peak_rss()
+    start = time.perf_counter()
+    df = etl.data_preprocessing(pd.read_csv(csv_path))
+    tables = {
+        'dim_date': etl.proc_date_dim(df),
+        'dim_cust': etl.proc_cust_dim(df),
+        'dim_geo': etl.proc_geo_dim(),
+        'dim_prod': etl.proc_prod_dim(df),
+        'dim_ostatus': etl.proc_ostatus_dim(df),
+        'dim_emp': etl.proc_emp_dim(df),
+    }
+    tables['fact_orders'] = etl.fact_table(
+        df, *(tables[name] for name in DIMENSIONS))
+    tables.update(etl.proc_rollups(tables['fact_orders'], tables['dim_prod']))
+    for name, table in tables.items():
+        table.to_parquet(Path(out_dir) / f"{name}.parquet",
+                         compression='snappy')
+    return {'seconds': time.perf_counter() - start, 'startup_seconds': 0.0,
+            'peak_bytes': peak_rss() - baseline}
+
+
+def run_spark(csv_path, out_dir, cores=4, key_method='ordered',
+              join_mode='auto'):
+    sys.path.insert(0, str(GLUE_DIR))
+    install_glue_standins()
+    from pyspark import SparkContext
+    from pyspark.conf import SparkConf
+    from memory_guard import peak_rss, reset_peak_rss
+    from stage_metrics import collect_stage_metrics, tagged
+    start = time.perf_counter()
+    conf = SparkConf().setMaster(f"local[{cores}]") \
+        .setAppName('engine_benchmark') \
+        .set('spark.sql.shuffle.partitions', str(cores * 2)) \
+        .set('spark.ui.enabled', 'false')
+    sc = SparkContext(conf=conf)
+    import glue_etl_job as g
+    from awsglue.context import GlueContext
+    glue_context = GlueContext(sc)
+    spark = glue_context.spark_session
+    startup = time.perf_counter() - start
+    # the JVM does the work, its peak is the one that counts
+    jvm_pid = sc._gateway.proc.pid
+    reset_peak_rss(jvm_pid)
+    baseline = peak_rss(jvm_pid)
+    start = time.perf_counter()
+    with tagged(sc, 'read'):
+        df = g.data_preprocessing(
+            spark.read.csv(str(csv_path), header=True, inferSchema=True))
+    stages = {
+        'dim_date': lambda: g.proc_date_dim(df, glue_context, spark),
+        'dim_cust': lambda: g.proc_cust_dim(df, glue_context, key_method),
+        'dim_geo': lambda: g.proc_geo_dim(spark, glue_context),
+        'dim_prod': lambda: g.proc_prod_dim(df, glue_context, key_method),
+        'dim_ostatus': lambda: g.proc_ostatus_dim(df, glue_context,
+                                                  key_method),
+        'dim_emp': lambda: g.proc_emp_dim(df, glue_context, key_method),
+    }
+    tables = {}
+    for name, stage in stages.items():
+        # the same job groups as the Glue job
+        with tagged(sc, f"proc_{name}"):
+            tables[name] = stage()
+    with tagged(sc, 'fact_table'):
+        tables['fact_orders'] = g.fact_table(
+            df, *(tables[name] for name in DIMENSIONS), glue_context, spark,
+            join_mode)
+    with tagged(sc, 'proc_rollups'):
+        tables.update(g.proc_rollups(_to_df(tables['fact_orders']),
+                                     _to_df(tables['dim_prod']), glue_context,
+                                     spark))
+    for name, table in tables.items():
+        with tagged(sc, f"save {name}"):
+            _to_df(table).write.mode('overwrite') \
+                .parquet(str(Path(out_dir) / name))
+    seconds = time.perf_counter() - start
+    with open(Path(out_dir) / 'stage_metrics.json', 'w') as f:
+        json.dump(collect_stage_metrics(sc), f, indent=2)
+    result = {'seconds': seconds, 'startup_seconds': startup,
+              'peak_bytes': peak_rss(jvm_pid) - baseline}
+    sc.stop()
+    return result
+
+
+def run_engine(engine, csv_path, out_dir, cores=4):
+    "Run one engine in a subprocess, returns its timings or the error"
+    cmd = [sys.executable, __file__, '--engine', engine, '--input',
+           str(csv_path), '--out', str(out_dir), '--cores', str(cores)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(SCRIPTS), os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    if out.returncode != 0:
+        error = (out.stderr.strip().splitlines() or ['failed'])[-1]
+        return {'error': error}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+# output comparison
+def _read(out_dir, table):
+    import pandas as pd
+    path = Path(out_dir) / f"{table}.parquet"
+    return pd.read_parquet(path if path.exists() else Path(out_dir) / table)
+
+
+def _resolve(df, out_dir, foreign_keys, dims):
+    "Replace surrogate keys by the natural attribute they stand for"
+    df = df.copy()
+    for column, (dim, key, attribute) in foreign_keys.items():
+        if dim not in dims:
+            dims[dim] = _read(out_dir, dim)
+        d = dims[dim]
+        if 'is_current' in d.columns:
+            d = d[d['is_current'].astype(bool)]
+        if dim == 'dim_geo':
+            d = d[d['country'] == 'India']
+        # an unresolved key is null in pandas and -1 in the Glue job
+        df[column] = df[column].map(d.set_index(key)[attribute])
+    return df
+
+
+def _normalize(series):
+    import pandas as pd
+    if series.dtype == object:
+        first = series.dropna().head(1)
+        if len(first) and hasattr(first.iloc[0], 'year'):
+            return pd.to_datetime(series).dt.normalize()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.to_datetime(series).dt.tz_localize(None).dt.normalize() \
+            if getattr(series.dt, 'tz', None) else series.dt.normalize()
+    return series
+
+
+def _equal(a, b):
+    import numpy as np
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b) \
+            and not pd.api.types.is_bool_dtype(a):
+        x = a.to_numpy(dtype='float64', na_value=np.nan)
+        y = b.to_numpy(dtype='float64', na_value=np.nan)
+        return np.isclose(x, y, rtol=1e-9, atol=1e-9, equal_nan=True)
+    same = a.astype(str).to_numpy() == b.astype(str).to_numpy()
+    return same | (a.isna().to_numpy() & b.isna().to_numpy())
+
+
+def compare_outputs(left_dir, right_dir, tables=TABLES):
+    "Per table: row counts, unmatched keys and mismatched values per column"
+    import pandas as pd
+    dims = {'left': {}, 'right': {}}
+    report = {}
+    for table, (key, foreign_keys, ignored) in tables.items():
+        try:
+            left = _resolve(_read(left_dir, table), left_dir, foreign_keys,
+                            dims['left'])
+            right = _resolve(_read(right_dir, table), right_dir,
+                             foreign_keys, dims['right'])
+        except Exception as e:
+            report[table] = {'error': str(e)}
+            continue
+        for df in (left, right):
+            for column in df.columns:
+                df[column] = _normalize(df[column])
+        columns = [c for c in left.columns
+                   if c in right.columns and c not in key + ignored]
+        merged = left.merge(right, on=key, how='outer',
+                            suffixes=('_l', '_r'), indicator=True)
+        both = merged[merged['_merge'] == 'both']
+        mismatches = {}
+        for column in columns:
+            bad = int((~_equal(both[f"{column}_l"],
+                               both[f"{column}_r"])).sum())
+            if bad:
+                mismatches[column] = bad
+        report[table] = {
+            'rows': [len(left), len(right)],
+            'only_left': int((merged['_merge'] == 'left_only').sum()),
+            'only_right': int((merged['_merge'] == 'right_only').sum()),
+            'columns_only_left': sorted(set(left.columns) - set(right.columns)
+                                        - set(ignored)),
+            'columns_only_right': sorted(set(right.columns) -
+                                         set(left.columns) - set(ignored)),
+            'mismatched_columns': mismatches,
+        }
+        report[table]['equivalent'] = not (
+            report[table]['only_left'] or report[table]['only_right'] or
+            mismatches or report[table]['columns_only_left'] or
+            report[table]['columns_only_right'])
+    return report
+
+
+def crossovers(results):
+    "Rows at which the faster engine changes, interpolated between scales"
+    points = [r for r in results
+              if 'error' not in r['pandas'] and 'error' not in r['spark']]
+    found = []
+    for a, b in zip(points, points[1:]):
+        da = a['pandas']['total_seconds'] - a['spark']['total_seconds']
+        db = b['pandas']['total_seconds'] - b['spark']['total_seconds']
+        if (da < 0) != (db < 0):
+            rows = a['rows'] + (b['rows'] - a['rows']) * (-da) / (db - da)
+            found.append({'rows': int(rows),
+                          'faster_above': 'spark' if db > 0 else 'pandas'})
+    return found
+
+
+def benchmark(raw_path, scales=SCALES, cores=4, out_file=None):
+    from memory_guard import make_input
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            csv_path = Path(tmp) / f"orders_x{scale}.csv"
+            make_input(raw_path, scale, csv_path)
+            with open(csv_path) as f:
+                rows = sum(1 for _ in f) - 1
+            entry = {'scale': scale, 'rows': rows}
+            for engine in ('pandas', 'spark'):
+                out_dir = Path(tmp) / f"{engine}_x{scale}"
+                out_dir.mkdir()
+                result = run_engine(engine, csv_path, out_dir, cores)
+                if 'error' not in result:
+                    result['total_seconds'] = result['seconds'] + \
+                        result['startup_seconds']
+                    result['rows_per_second'] = round(
+                        rows / result['seconds']) if result['seconds'] else None
+                entry[engine] = result
+            if 'error' not in entry['spark']:
+                entry['comparison'] = compare_outputs(
+                    Path(tmp) / f"pandas_x{scale}",
+                    Path(tmp) / f"spark_x{scale}")
+            results.append(entry)
+            _print_entry(entry)
+    report = {'cores': cores, 'results': results,
+              'crossovers': crossovers(results)}
+    print(f"Crossover points: {report['crossovers'] or 'none in range'}")
+    if out_file:
+        with open(out_file, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Benchmark report saved to {out_file}")
+    return report
+
+
+def _print_entry(entry):
+    print(f"scale {entry['scale']}: {entry['rows']} rows")
+    for engine in ('pandas', 'spark'):
+        r = entry[engine]
+        if 'error' in r:
+            print(f"  {engine}: failed, {r['error']}")
+            continue
+        print(f"  {engine}: {r['seconds']:.2f}s (+{r['startup_seconds']:.1f}s "
+              f"startup), {r['rows_per_second']} rows/s, peak "
+              f"{r['peak_bytes'] / 1e6:.0f} MB")
+    for table, result in entry.get('comparison', {}).items():
+        if not result.get('equivalent'):
+            print(f"  {table} differs: {result}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pandas and Spark pipelines and compare "
+                    "their outputs")
+    parser.add_argument('--raw', default=str(
+        SCRIPTS.parent / 'data' / 'raw' / 'Online-eCommerce.csv'))
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--cores', type=int, default=4)
+    parser.add_argument('--report', default='engine_benchmark.json')
+    # one engine run, used by the subprocesses
+    parser.add_argument('--engine', choices=['pandas', 'spark'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--input', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.engine:
+        # quiet the stage progress output, only the result goes to stdout
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        if args.engine == 'pandas':
+            result = run_pandas(args.input, args.out)
+        else:
+            result = run_spark(args.input, args.out, args.cores)
+        sys.stdout = stdout
+        print(json.dumps(result))
+        return 0
+    benchmark(args.raw, args.scales, args.cores, args.report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
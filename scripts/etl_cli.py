@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+# Command line for scheduled runs of the local pipeline.
+#   python etl_cli.py land <csv files> [--landing-zone landing]
+#   python etl_cli.py extract --url <csv link> [--staged staged.feather]
+#   python etl_cli.py extract --landing-zone landing
+#   python etl_cli.py extract --db-url sqlite:///orders.db [--db-partitions 4]
+#   python etl_cli.py transform [--staged staged.feather] [--incremental]
+#   python etl_cli.py upload --cred-file aws.json --bucket <bucket>
+#   python etl_cli.py run --url <csv link> [--bucket <bucket> ...]
+#   python etl_cli.py stream --landing-dir <folder> [--batch-interval 30]
+#   python etl_cli.py backfill '<glob>' [<glob> ...] [--workers 8]
+# Options can also come from a JSON file (--config, or ETL_CONFIG), keyed on
+# the option names with dashes replaced by underscores; flags given on the
+# command line win. numpy, pandas, requests and boto3 are only imported by
+# the command that needs them, so --help and argument errors return at
+# interpreter startup speed.
+
+# exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+
+def _staged_profile(staged):
+    return Path(staged).with_suffix('.json')
+
+
+def _database(args):
+    "The database source of --db-url, or None"
+    if not args.db_url:
+        return None
+    from db_source import DatabaseSource
+    return DatabaseSource(args.db_url, args.db_table, args.db_split,
+                          args.db_partitions, args.db_batch_rows)
+
+
+# commands
+def cmd_extract(args):
+    from local_etl_test import extract_data
+    from raw_cache import write_frame
+    database = _database(args)
+    try:
+        df, raw_report = extract_data(args.url, not args.no_cache,
+                                      args.landing_zone, database)
+    finally:
+        if database is not None:
+            database.close()
+    write_frame(df, args.staged)
+    with open(_staged_profile(args.staged), 'w') as f:
+        json.dump(raw_report, f, default=str)
+    print(f"Staged {df.shape[0]} preprocessed rows in {args.staged}")
+
+
+def cmd_transform(args):
+    from local_etl_test import transform_data
+    from raw_cache import read_frame
+    with open(_staged_profile(args.staged)) as f:
+        raw_report = json.load(f)
+    transform_data(read_frame(args.staged), raw_report, args.incremental,
+                   args.on_duplicate, not args.no_checkpoints)
+
+
+def cmd_upload(args):
+    from upload_to_s3 import files_upload
+    missing = files_upload(args.cred_file, args.bucket,
+                           file_names=args.files, prefix=args.prefix)
+    if missing:
+        raise RuntimeError(f"Files not found: {', '.join(missing)}")
+
+
+def cmd_run(args):
+    from local_etl_test import run_etl_github
+    database = _database(args)
+    try:
+        file_names = run_etl_github(args.url, args.incremental,
+                                    args.on_duplicate, not args.no_cache,
+                                    args.landing_zone,
+                                    not args.no_checkpoints, database)
+    finally:
+        if database is not None:
+            database.close()
+    if args.bucket:
+        if not args.cred_file:
+            raise ValueError("--bucket needs --cred-file")
+        if not args.files:
+            args.files = [f"{name}.parquet" for name in file_names]
+        cmd_upload(args)
+
+
+def cmd_land(args):
+    from landing_zone import land_file
+    for path in args.files:
+        land_file(path, args.landing_zone)
+
+
+def cmd_stream(args):
+    from stream_batches import LandingDirectory, run_stream
+    run_stream(LandingDirectory(args.landing_dir), args.output_dir,
+               args.batch_interval, args.max_files,
+               int(args.max_mb * 1024 ** 2), args.poll_interval,
+               args.on_duplicate, args.max_batches, args.idle_exit)
+
+
+def cmd_backfill(args):
+    from batch_backfill import run_backfill
+    run_backfill(args.files, args.workers)
+
+
+# arguments
+def _add_extract(parser):
+    # one of --url, --landing-zone and --db-url, checked after parsing
+    parser.add_argument('--url', nargs='+',
+                        help="raw CSV link(s), GitHub blob links are "
+                             "converted to raw links")
+    parser.add_argument('--landing-zone',
+                        help="read the typed Parquet of this landing zone "
+                             "instead of --url")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always download and preprocess again")
+    parser.add_argument('--db-url',
+                        help="read the orders table of this database "
+                             "(sqlite:///<path> or postgresql://...)")
+    parser.add_argument('--db-table', default='orders')
+    parser.add_argument('--db-split', choices=['order_number', 'order_date'],
+                        default='order_number',
+                        help="column whose ranges are read in parallel")
+    parser.add_argument('--db-partitions', type=int, default=4)
+    parser.add_argument('--db-batch-rows', type=int, default=10000)
+
+
+def _add_transform(parser):
+    parser.add_argument('--incremental', action='store_true',
+                        help="skip or route orders that were loaded before")
+    parser.add_argument('--on-duplicate', choices=['skip', 'update'],
+                        default='skip')
+    parser.add_argument('--no-checkpoints', action='store_true',
+                        help="run every stage, even after a failed run")
+
+
+def _add_upload(parser, required=True):
+    parser.add_argument('--cred-file', required=required,
+                        help="JSON file with the AWS access keys")
+    parser.add_argument('--bucket', required=required)
+    parser.add_argument('--prefix', default='',
+                        help="S3 key prefix of the uploaded files")
+    parser.add_argument('--files', nargs='+',
+                        help="files to upload, defaults to the tables")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='etl_cli.py',
+        description="Run the local payment ETL pipeline")
+    parser.add_argument('--config', default=os.environ.get('ETL_CONFIG'),
+                        help="JSON file with default option values")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    staged = dict(default='staged.feather',
+                  help="preprocessed data handed from extract to transform")
+
+    land = commands.add_parser(
+        'land', help="convert raw CSV files into the typed landing zone")
+    land.add_argument('files', nargs='+')
+    land.add_argument('--landing-zone', default='landing')
+    land.set_defaults(handler=cmd_land)
+
+    extract = commands.add_parser(
+        'extract', help="download and preprocess the raw data")
+    _add_extract(extract)
+    extract.add_argument('--staged', **staged)
+    extract.set_defaults(handler=cmd_extract)
+
+    transform = commands.add_parser(
+        'transform', help="build and save the star schema")
+    transform.add_argument('--staged', **staged)
+    _add_transform(transform)
+    transform.set_defaults(handler=cmd_transform)
+
+    upload = commands.add_parser('upload', help="upload the tables to S3")
+    _add_upload(upload)
+    upload.set_defaults(handler=cmd_upload)
+
+    run = commands.add_parser(
+        'run', help="extract and transform, then upload when --bucket is set")
+    _add_extract(run)
+    _add_transform(run)
+    _add_upload(run, required=False)
+    run.set_defaults(handler=cmd_run)
+
+    stream = commands.add_parser(
+        'stream', help="process new files of a landing folder in micro-batches")
+    stream.add_argument('--landing-dir', required=True)
+    stream.add_argument('--output-dir', default='.')
+    stream.add_argument('--batch-interval', type=float, default=30.0,
+                        help="seconds the oldest waiting file may wait")
+    stream.add_argument('--max-files', type=int, default=100,
+                        help="files that trigger a batch right away")
+    stream.add_argument('--max-mb', type=float, default=64.0,
+                        help="waiting megabytes that trigger a batch")
+    stream.add_argument('--poll-interval', type=float, default=1.0)
+    stream.add_argument('--on-duplicate', choices=['skip', 'update'],
+                        default='skip')
+    stream.add_argument('--max-batches', type=int,
+                        help="stop after this many batches")
+    stream.add_argument('--idle-exit', type=float,
+                        help="stop after this many seconds without files")
+    stream.set_defaults(handler=cmd_stream)
+
+    backfill = commands.add_parser(
+        'backfill', help="build the star schema from many CSV files in "
+                         "parallel")
+    backfill.add_argument('files', nargs='+',
+                          help="CSV files or glob patterns")
+    backfill.add_argument('--workers', type=int,
+                          help="worker processes, defaults to the cores")
+    backfill.set_defaults(handler=cmd_backfill)
+    parser.commands = commands.choices
+    return parser
+
+
+def _apply_config(parser, path):
+    "Use the values of a JSON config file as option defaults"
+    with open(path) as f:
+        config = json.load(f)
+    commands = parser.commands
+    for sub in commands.values():
+        known = {a.dest for a in sub._actions}
+        values = {k: v for k, v in config.items() if k in known}
+        # config values satisfy required options too
+        for action in sub._actions:
+            if action.dest in values:
+                action.required = False
+        sub.set_defaults(**values)
+    unknown = set(config) - {a.dest for sub in commands.values()
+                             for a in sub._actions}
+    if unknown:
+        parser.error(f"unknown option(s) in {path}: {', '.join(sorted(unknown))}")
+
+
+def main(argv=None):
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # the config file only changes defaults, so it is read before parsing;
+    # --config is accepted before or after the command
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument('--config', default=parser.get_default('config'))
+    try:
+        known, argv = pre.parse_known_args(argv)
+        if known.config:
+            _apply_config(parser, known.config)
+        args = parser.parse_args(argv)
+        if args.command in ('extract', 'run') and not (
+                args.url or args.landing_zone or args.db_url):
+            parser.commands[args.command].error(
+                "one of --url, --landing-zone or --db-url is required")
+    except SystemExit as e:
+        return e.code
+    except (OSError, ValueError) as e:
+        print(f"Cannot read the config file: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        args.handler(args)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
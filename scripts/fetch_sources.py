@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Concurrent download of raw export files.
+# Every file is probed with a HEAD request. When the server accepts byte
+# ranges and the file is larger than part_size, it is split into ranges that
+# are fetched in parallel, each with its own retries and exponential
+# backoff. Finished parts are handed to the consumer in order as soon as all
+# earlier parts are in, so parsing starts while later parts are still on
+# the wire. Blocking requests calls run in worker threads driven by asyncio,
+# which keeps requests as the only HTTP dependency. Parsers block until their
+# download feeds them, so they get a pool of their own: downloads never
+# queue behind waiting parsers, and at most max_concurrency files are parsed
+# at once (later files are buffered until a parser is free).
+#   python fetch_sources.py <folder of raw CSV files>   # local check
+
+PART_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+MAX_CONCURRENCY = 8
+RETRIES = 4
+BACKOFF = 0.5
+TIMEOUT = 30
+# answers worth retrying, anything else fails the file
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    pass
+
+
+class RangeNotHonoured(FetchError):
+    "The server ignored the byte range, asking again cannot help"
+
+
+# byte pipe between the download and the parser
+class StreamPipe(io.RawIOBase):
+    "Raw stream read by the parser while the download writes to it"
+
+    def __init__(self, digest=None):
+        super().__init__()
+        # optional hashlib object updated with every byte that goes through
+        self.digest = digest
+        # ETag/Last-Modified the file was served with, set by fetch_to_pipe
+        self.validators = {}
+        self._buffer = bytearray()
+        self._finished = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        if self.digest is not None:
+            self.digest.update(data)
+        with self._cond:
+            self._buffer.extend(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def finish(self, error=None):
+        "End of the data, or the error that stopped the download"
+        with self._cond:
+            self._finished = True
+            self._error = error
+            self._cond.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self._cond:
+            while not self._buffer and not self._finished:
+                self._cond.wait()
+            if not self._buffer and self._error is not None:
+                raise self._error
+            n = min(len(b), len(self._buffer))
+            b[:n] = self._buffer[:n]
+            del self._buffer[:n]
+            return n
+
+
+def _backoff(attempt, backoff):
+    # exponential with jitter, so parallel parts do not retry in lockstep
+    return backoff * (2 ** attempt) * (0.5 + random.random())
+
+
+def _probe(url, timeout):
+    "Size, range support and validators of a remote file"
+    response = requests.head(url, allow_redirects=True, timeout=timeout)
+    if response.status_code >= 400:
+        # some servers refuse HEAD, fall back to a plain GET later
+        return None, False, {}
+    size = response.headers.get('Content-Length')
+    ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    validators = {k: response.headers[k]
+                  for k in ('ETag', 'Last-Modified') if k in response.headers}
+    return (int(size) if size else None), ranges, validators
+
+
+def _get_range(url, start, end, timeout):
+    "Download bytes start..end (inclusive) of a file"
+    response = requests.get(url, headers={'Range': f"bytes={start}-{end}"},
+                            timeout=timeout)
+    if response.status_code in RETRY_STATUS:
+        raise FetchError(f"HTTP {response.status_code} for {url}")
+    if response.status_code != 206:
+        raise RangeNotHonoured(f"Range request not honoured for {url}: "
+                         f"HTTP {response.status_code}")
+    if len(response.content) != end - start + 1:
+        raise FetchError(f"Short range {start}-{end} for {url}")
+    return response.content
+
+
+def _get_stream(url, write, timeout, offset=0):
+    "Stream a whole file (or its tail from offset) into write()"
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with requests.get(url, headers=headers, stream=True,
+                      timeout=timeout) as response:
+        if response.status_code in RETRY_STATUS:
+            raise FetchError(f"HTTP {response.status_code} for {url}")
+        if response.status_code >= 400:
+            raise requests.HTTPError(
+                f"HTTP {response.status_code} for {url}", response=response)
+        if offset:
+            # a server ignoring the range sends the whole file again, which
+            # would be appended after the bytes already handed over
+            served = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or \
+                    not served.startswith(f"bytes {offset}-"):
+                raise RangeNotHonoured(
+                    f"Resume at byte {offset} not honoured for {url}: "
+                    f"HTTP {response.status_code} {served}".rstrip())
+        written = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            write(chunk)
+            written += len(chunk)
+        return written
+
+
+def _in_thread(executor, call, *args):
+    "Run a blocking call in executor (None: asyncio's default one)"
+    return asyncio.get_running_loop().run_in_executor(executor,
+                                                      partial(call, *args))
+
+
+async def _retry(call, retries, backoff, what, executor=None):
+    for attempt in range(retries + 1):
+        try:
+            return await _in_thread(executor, call)
+        except RangeNotHonoured:
+            raise
+        except (FetchError, requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise FetchError(f"{what} failed after {retries + 1} "
+                                 f"attempts: {e}") from e
+            delay = _backoff(attempt, backoff)
+            print(f"{what}: {e}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def fetch_to_pipe(url, pipe, limiter, part_size=PART_SIZE,
+                        retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT,
+                        executor=None):
+    """Download one file into a StreamPipe, range-split when possible
+
+    The blocking calls run in executor, asyncio's default one if None.
+    """
+    try:
+        size, ranges, validators = await _in_thread(executor, _probe, url,
+                                                    timeout)
+        pipe.validators = validators
+        if ranges and size and size > part_size:
+            bounds = [(start, min(start + part_size, size) - 1)
+                      for start in range(0, size, part_size)]
+
+            async def part(start, end):
+                async with limiter:
+                    return await _retry(
+                        lambda: _get_range(url, start, end, timeout),
+                        retries, backoff, f"{url} [{start}-{end}]",
+                        executor)
+
+            tasks = [asyncio.create_task(part(*b)) for b in bounds]
+            try:
+                # hand the parts over in order as they complete
+                for task in tasks:
+                    pipe.write(await task)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        else:
+            written = 0
+
+            def write(chunk):
+                nonlocal written
+                pipe.write(chunk)
+                written += len(chunk)
+
+            async with limiter:
+                for attempt in range(retries + 1):
+                    try:
+                        await _in_thread(executor, _get_stream, url, write,
+                                         timeout, written)
+                        break
+                    except RangeNotHonoured:
+                        raise
+                    except (FetchError, requests.ConnectionError,
+                            requests.Timeout) as e:
+                        # bytes already handed over cannot be taken back,
+                        # resuming needs a range request
+                        if attempt == retries or (written and not ranges):
+                            raise FetchError(f"{url} failed: {e}") from e
+                        delay = _backoff(attempt, backoff)
+                        print(f"{url}: {e}, retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+        pipe.finish()
+        return validators
+    except BaseException as e:
+        pipe.finish(e if isinstance(e, Exception) else FetchError(str(e)))
+        raise
+
+
+async def fetch_and_parse(urls, parse, max_concurrency=MAX_CONCURRENCY,
+                          digest=None, **options):
+    """Download many files concurrently and parse each while it downloads.
+
+    parse is called in a worker thread with a file-like object per url,
+    e.g. pandas.read_csv, at most max_concurrency at a time. Returns the parse results in url order. With
+    digest (a hashlib name), the content hash of the file is available to
+    parse as file.raw.digest once it has read to the end; the validators
+    the file was served with are in file.raw.validators.
+    """
+    limiter = asyncio.Semaphore(max_concurrency)
+    # a parser blocks its thread until the download feeds it, the downloads
+    # get their own threads so they never wait behind parsers
+    parsers = ThreadPoolExecutor(max_concurrency, thread_name_prefix='parse')
+    downloads = ThreadPoolExecutor(max_concurrency,
+                                   thread_name_prefix='download')
+
+    async def one(url):
+        pipe = StreamPipe(hashlib.new(digest) if digest else None)
+        reader = io.BufferedReader(pipe, CHUNK_SIZE)
+        parsed = _in_thread(parsers, parse, reader)
+        try:
+            await fetch_to_pipe(url, pipe, limiter, executor=downloads,
+                                **options)
+        except Exception:
+            # the parser sees the error on its next read
+            await asyncio.gather(parsed, return_exceptions=True)
+            raise
+        return await parsed
+
+    try:
+        return await asyncio.gather(*(one(url) for url in urls))
+    finally:
+        parsers.shutdown(wait=False)
+        downloads.shutdown(wait=False)
+
+
+def fetch_many(urls, parse, **options):
+    "Blocking entry point for fetch_and_parse"
+    start = time.perf_counter()
+    results = asyncio.run(fetch_and_parse(list(urls), parse, **options))
+    print(f"Fetched {len(results)} files in "
+          f"{time.perf_counter() - start:.1f}s")
+    return results
+
+
+# local stand-in server for offline runs
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    "Static file handler that also answers single byte-range requests"
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, _, end = range_header.replace('bytes=', '').partition('-')
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+        if start >= size:
+            self.send_error(416)
+            return None
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def end_headers(self):
+        if not self.headers.get('Range'):
+            self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory, port=0):
+    "Serve a folder on localhost in a background thread, returns the server"
+    handler = partial(RangeRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    import pandas as pd
+    parser = argparse.ArgumentParser(
+        description="Serve a folder of raw CSV files locally and fetch them")
+    parser.add_argument('folder')
+    parser.add_argument('--part-size', type=int, default=64 * 1024)
+    parser.add_argument('--max-concurrency', type=int,
+                        default=MAX_CONCURRENCY)
+    args = parser.parse_args(argv)
+    server = serve_directory(args.folder)
+    try:
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        names = [n for n in sorted(os.listdir(args.folder))
+                 if n.endswith('.csv')]
+        frames = fetch_many([f"{base}/{n}" for n in names], pd.read_csv,
+                            part_size=args.part_size,
+                            max_concurrency=args.max_concurrency)
+    finally:
+        server.shutdown()
+    for name, frame in zip(names, frames):
+        print(f"{name}: {frame.shape[0]} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
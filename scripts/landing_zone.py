@@ -0,0 +1,316 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+# Columnar landing zone of the raw order exports, shared by the local
+# (pandas) and the Glue (PySpark) pipelines.
+# Every raw CSV drop is parsed once, checked against RAW_SCHEMA and written
+# as typed Parquet partitioned by order month (order_month=YYYY-MM). Rows
+# that do not parse, or miss a required value, go to _quarantine/ with the
+# reason, as the original text. _manifest.json remembers the drops that were
+# landed, keyed on their content hash (locally) or their path and size (in
+# Spark), so a drop is never parsed twice. The pipelines then read the
+# Parquet files with only the columns they need, and date filters skip
+# whole month folders and row groups instead of parsing text.
+# The Glue job imports this file through --extra-py-files.
+#   python landing_zone.py land ../data/raw/Online-eCommerce.csv
+#   python landing_zone.py list
+
+LANDING_DIR = os.environ.get('ETL_LANDING_DIR', 'landing')
+MANIFEST_FILE = '_manifest.json'
+QUARANTINE_DIR = '_quarantine'
+PARTITION = 'order_month'
+DATE_FORMAT = '%d/%m/%Y'
+
+# raw column: type of the landed column
+RAW_SCHEMA = {
+    'Order_Number': 'long',
+    'State_Code': 'string',
+    'Customer_Name': 'string',
+    'Order_Date': 'date',
+    'Status': 'string',
+    'Product': 'string',
+    'Category': 'string',
+    'Brand': 'string',
+    'Cost': 'double',
+    'Sales': 'double',
+    'Quantity': 'long',
+    'Total_Cost': 'double',
+    'Total_Sales': 'double',
+    'Assigned Supervisor': 'string',
+}
+# a row without these is quarantined, the others may be null
+REQUIRED = ['Order_Number', 'Order_Date', 'Quantity']
+
+
+def _partition_value(month):
+    return f"{month.year:04d}-{month.month:02d}"
+
+
+# pandas
+def enforce_schema(raw):
+    """Type a frame of raw strings, returns (typed rows, quarantined rows).
+
+    Quarantined rows keep their original text and get an _error column
+    naming every value that failed.
+    """
+    import numpy as np
+    import pandas as pd
+    missing = [c for c in RAW_SCHEMA if c not in raw.columns]
+    if missing:
+        raise ValueError(f"Raw data is missing columns: {', '.join(missing)}")
+    typed, errors = {}, []
+    for col, kind in RAW_SCHEMA.items():
+        text = raw[col]
+        if kind == 'string':
+            typed[col] = text
+            bad = pd.Series(False, index=raw.index)
+        elif kind == 'date':
+            typed[col] = pd.to_datetime(text, format=DATE_FORMAT,
+                                        errors='coerce')
+            bad = text.notna() & typed[col].isna()
+        else:
+            values = pd.to_numeric(text, errors='coerce')
+            bad = text.notna() & values.isna()
+            if kind == 'long':
+                bad |= values.notna() & (values != np.floor(values))
+            typed[col] = values
+        if col in REQUIRED:
+            errors.append(np.where(text.isna(), f"{col} is missing", ''))
+        errors.append(np.where(bad, f"{col} is not a {kind}", ''))
+    reasons = pd.Series(['; '.join(filter(None, parts))
+                         for parts in zip(*errors)], index=raw.index)
+    failed = (reasons != '').to_numpy()
+    good = pd.DataFrame(typed, copy=False)[~failed]
+    for col, kind in RAW_SCHEMA.items():
+        if kind == 'long':
+            good[col] = good[col].astype('int64')
+    quarantined = raw[failed].assign(_error=reasons[failed])
+    return good.reset_index(drop=True), quarantined
+
+
+def load_manifest(landing_dir=LANDING_DIR):
+    "Return {content hash: landed drop}"
+    path = Path(landing_dir) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, landing_dir=LANDING_DIR):
+    # written last and renamed into place, like the files of the drop
+    path = Path(landing_dir) / MANIFEST_FILE
+    tmp = path.with_name(f".{MANIFEST_FILE}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def land_file(csv_path, landing_dir=LANDING_DIR):
+    "Convert one raw CSV drop, a drop that was landed before is skipped"
+    import pandas as pd
+    landing = Path(landing_dir)
+    landing.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(landing_dir)
+    digest = _file_digest(csv_path)
+    if digest in manifest:
+        print(f"{csv_path} was landed on {manifest[digest]['landed_at']}, "
+              f"skipped")
+        return manifest[digest]
+    # every value is read as text, the schema decides what parses
+    raw = pd.read_csv(csv_path, dtype=str)
+    good, bad = enforce_schema(raw)
+    name = f"part-{digest[:16]}.parquet"
+    staged = []
+    months = good['Order_Date'].dt.to_period('M')
+    for month, rows in good.groupby(months, sort=True):
+        folder = landing / f"{PARTITION}={_partition_value(month)}"
+        folder.mkdir(exist_ok=True)
+        # dot files are ignored by readers until they are renamed
+        tmp = folder / f".{name}.tmp"
+        # dates are stored as dates, the type Spark reads them as
+        rows.assign(Order_Date=rows['Order_Date'].dt.date) \
+            .to_parquet(tmp, index=False, compression='snappy')
+        staged.append((tmp, folder / name))
+    if len(bad):
+        folder = landing / QUARANTINE_DIR
+        folder.mkdir(exist_ok=True)
+        tmp = folder / f".{digest[:16]}.csv.tmp"
+        bad.to_csv(tmp, index=False)
+        staged.append((tmp, folder / f"{digest[:16]}.csv"))
+    for tmp, path in staged:
+        os.replace(tmp, path)
+    entry = {'source': str(csv_path), 'rows': len(good),
+             'quarantined': len(bad), 'files': [str(p) for _, p in staged],
+             'landed_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    manifest[digest] = entry
+    save_manifest(manifest, landing_dir)
+    months = len(staged) - (1 if len(bad) else 0)
+    print(f"Landed {len(good)} rows of {csv_path} in {months} month "
+          f"partitions, {len(bad)} rows quarantined")
+    return entry
+
+
+def date_filters(start=None, end=None):
+    "Filters on Order_Date that also prune the month partitions"
+    import pandas as pd
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [(PARTITION, '>=', _partition_value(start)),
+                    ('Order_Date', '>=', start.date())]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [(PARTITION, '<=', _partition_value(end)),
+                    ('Order_Date', '<=', end.date())]
+    return filters or None
+
+
+def read_landing(landing_dir=LANDING_DIR, columns=None, start=None,
+                 end=None):
+    """Landed rows, only the given columns and order dates.
+
+    Only the month folders in the date range are opened, and inside them
+    row groups are skipped on their Order_Date statistics.
+    """
+    import pandas as pd
+    columns = list(columns or RAW_SCHEMA)
+    df = pd.read_parquet(landing_dir, engine='pyarrow', columns=columns,
+                         filters=date_filters(start, end))
+    for col, kind in RAW_SCHEMA.items():
+        if kind == 'date' and col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    print(f"Read {df.shape[0]} rows, {df.shape[1]} columns from the "
+          f"landing zone")
+    return df
+
+
+# PySpark
+def spark_schema():
+    "RAW_SCHEMA as a Spark schema of the landed columns"
+    from pyspark.sql.types import (DateType, DoubleType, LongType,
+                                   StringType, StructField, StructType)
+    types = {'long': LongType(), 'double': DoubleType(), 'date': DateType(),
+             'string': StringType()}
+    return StructType([StructField(c, types[k]) for c, k in RAW_SCHEMA.items()])
+
+
+def _list_drops(spark, raw_path):
+    "(path, size) of the CSV files under raw_path"
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(raw_path)
+    fs = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    if not fs.exists(path):
+        return []
+    return [(s.getPath().toString(), s.getLen()) for s in fs.listStatus(path)
+            if s.isFile() and s.getPath().getName().lower().endswith('.csv')]
+
+
+def land_raw_spark(spark, raw_path, landing_path):
+    """Convert the CSV drops under raw_path that were not landed before.
+
+    Returns the number of (landed, quarantined) rows of the new drops.
+    """
+    from pyspark.sql import functions as F
+    manifest_path = f"{landing_path.rstrip('/')}/_manifest"
+    try:
+        landed = {(r['source'], r['size']) for r in
+                  spark.read.parquet(manifest_path).collect()}
+    except Exception:
+        landed = set()
+    drops = [d for d in _list_drops(spark, raw_path) if d not in landed]
+    if not drops:
+        print(f"No new raw drops under {raw_path}")
+        return 0, 0
+    # every value is read as text, the schema decides what parses
+    raw = spark.read.option("header", True) \
+        .option("inferSchema", False).csv([p for p, _ in drops])
+    typed, errors = [], []
+    for col, kind in RAW_SCHEMA.items():
+        text = F.col(f"`{col}`")
+        if kind == 'date':
+            value = F.to_date(text, "dd/MM/yyyy")
+        elif kind == 'long':
+            number = text.cast('double')
+            value = F.when(number == F.floor(number), number.cast('long'))
+        else:
+            value = text.cast(kind)
+        typed.append(value.alias(col))
+        if col in REQUIRED:
+            errors.append(F.when(text.isNull(), F.lit(f"{col} is missing")))
+        errors.append(F.when(text.isNotNull() & value.isNull(),
+                             F.lit(f"{col} is not a {kind}")))
+    checked = raw.withColumn("_error", F.concat_ws("; ", *errors)) \
+        .persist()
+    good = checked.filter(F.col("_error") == "") \
+        .select(*typed) \
+        .withColumn(PARTITION, F.date_format("Order_Date", "yyyy-MM"))
+    bad = checked.filter(F.col("_error") != "")
+    good.write.mode("append").partitionBy(PARTITION).parquet(landing_path)
+    bad.write.mode("append").option("header", True) \
+        .csv(f"{landing_path.rstrip('/')}/{QUARANTINE_DIR}")
+    counts = checked.groupBy((F.col("_error") == "").alias("ok")).count() \
+        .collect()
+    checked.unpersist()
+    rows = {r['ok']: r['count'] for r in counts}
+    # the manifest is written last, it only lists drops that were landed
+    spark.createDataFrame(
+        [(p, s, time.strftime('%Y-%m-%d %H:%M:%S')) for p, s in drops],
+        "source string, size long, landed_at string") \
+        .coalesce(1).write.mode("append").parquet(manifest_path)
+    print(f"Landed {len(drops)} raw drops: {rows.get(True, 0)} rows, "
+          f"{rows.get(False, 0)} quarantined")
+    return rows.get(True, 0), rows.get(False, 0)
+
+
+def read_landing_spark(spark, landing_path, start=None, end=None):
+    "Landed rows as a DataFrame, date filters prune the month folders"
+    from pyspark.sql import functions as F
+    df = spark.read.schema(spark_schema().add(PARTITION, "string")) \
+        .parquet(landing_path)
+    if start is not None:
+        df = df.filter((F.col(PARTITION) >= str(start)[:7]) &
+                       (F.col("Order_Date") >= F.lit(str(start)).cast("date")))
+    if end is not None:
+        df = df.filter((F.col(PARTITION) <= str(end)[:7]) &
+                       (F.col("Order_Date") <= F.lit(str(end)).cast("date")))
+    # the columns each stage selects are the only ones read from Parquet
+    return df.drop(PARTITION)
+
+
+# command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert raw CSV drops into the typed landing zone")
+    parser.add_argument('--landing-dir', default=LANDING_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    land = commands.add_parser('land', help="Land raw CSV files once")
+    land.add_argument('files', nargs='+')
+    commands.add_parser('list', help="List the landed drops")
+    args = parser.parse_args(argv)
+    if args.command == 'land':
+        for path in args.files:
+            land_file(path, args.landing_dir)
+    else:
+        manifest = load_manifest(args.landing_dir)
+        for digest, e in manifest.items():
+            print(f"{digest[:12]}  {e['landed_at']}  {e['rows']:>8} rows  "
+                  f"{e['quarantined']:>6} quarantined  {e['source']}")
+        print(f"{len(manifest)} drops landed")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,345 @@
+import argparse
+import getpass
+import json
+import os
+import re
+from pathlib import Path
+
+# Bulk load the processed tables into Redshift.
+# Each table is COPYed from a manifest into a staging table, rows that are
+# identical to the target are dropped from the stage, and the rest are
+# upserted into the target by primary key. All tables are upserted in one
+# transaction, so a failed load leaves the warehouse untouched.
+# The SQL is plain text and the orchestration only needs a DB-API
+# connection, so everything except the COPY itself runs against sqlite3
+# (dialect="sqlite") or Postgres (dialect="postgres") for local testing.
+# A Parquet COPY maps the file columns to the table columns by position, so
+# the tables are exported for the COPY first: the DDL columns in DDL order
+# and types, split into a multiple of the slice count.
+#   python load_to_redshift.py export --slices 4
+#   python load_to_redshift.py load --upload-dir redshift --bucket <bucket> ...
+
+DDL_FILE = Path(__file__).resolve().parent.parent / 'aws' / 'redshift' / \
+    'redshift_create_tables.sql'
+EXPORT_DIR = 'redshift'
+# pandas type of the exported column per DDL type, nullable where needed
+COPY_TYPES = {'INTEGER': 'Int32', 'BIGINT': 'Int64', 'FLOAT': 'float64',
+              'BOOLEAN': 'boolean', 'TIMESTAMP': 'datetime64[us]'}
+
+# dimensions first, the fact table references them
+# fact_orders_updates holds the latest version of orders that were sent
+# again (Glue job with on_duplicate="update") and is upserted last
+LOAD_ORDER = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 'dim_ostatus',
+              'dim_emp', 'fact_orders', 'fact_orders_updates']
+# output folders loaded into a table with another name
+SOURCE_TABLES = {'fact_orders_updates': 'fact_orders'}
+
+
+# read the table layouts from the Redshift DDL
+def read_table_layouts(ddl_file=DDL_FILE):
+    "Return {table: {'columns': [...], 'primary_key': column, 'definitions': {...}}}"
+    sql = Path(ddl_file).read_text()
+    layouts = {}
+    for name, body in re.findall(r'CREATE TABLE (\w+) \((.*?)\n\)', sql, re.S):
+        columns, primary_key, definitions = [], None, {}
+        for line in body.strip().splitlines():
+            line = line.strip().rstrip(',')
+            if not line or line.startswith('--'):
+                continue
+            column = line.split()[0]
+            columns.append(column)
+            definitions[column] = line[len(column):].strip()
+            if 'PRIMARY KEY' in line:
+                primary_key = column
+        layouts[name] = {'columns': columns, 'primary_key': primary_key,
+                         'definitions': definitions}
+    return layouts
+
+
+# COPY manifest
+def build_manifest(files):
+    "Build a COPY manifest from (s3 url, size in bytes) pairs"
+    # content_length is required when COPYing columnar files from a manifest
+    return {'entries': [{'url': url, 'mandatory': True,
+                         'meta': {'content_length': size}}
+                        for url, size in files]}
+
+
+def list_s3_files(s3_client, bucket, prefix, suffix='.parquet'):
+    "List the data files of one table as (s3 url, size) pairs"
+    paginator = s3_client.get_paginator('list_objects_v2')
+    files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix) and obj['Size'] > 0:
+                files.append((f"s3://{bucket}/{obj['Key']}", obj['Size']))
+    return files
+
+
+def upload_export(s3_client, out_dir, bucket, prefix):
+    "Upload the files of export_tables() under prefix, keeping the folders"
+    for path in sorted(Path(out_dir).rglob('*.parquet')):
+        key = f"{prefix}{path.relative_to(out_dir).as_posix()}"
+        s3_client.upload_file(str(path), bucket, key)
+    print(f"Uploaded {out_dir} to s3://{bucket}/{prefix}")
+
+
+def put_manifest(s3_client, bucket, key, manifest):
+    s3_client.put_object(Bucket=bucket, Key=key,
+                         Body=json.dumps(manifest).encode('utf-8'))
+    return f"s3://{bucket}/{key}"
+
+
+# files for the COPY
+def copy_frame(df, layout):
+    "The DDL columns of a table in DDL order and types, as COPY reads them"
+    import pandas as pd
+    missing = [c for c in layout['columns'] if c not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns for the COPY: {', '.join(missing)}")
+    out = {}
+    for column in layout['columns']:
+        kind = layout['definitions'][column].split()[0].split('(')[0]
+        values = df[column]
+        if kind == 'DATE':
+            # written as a Parquet DATE, not a timestamp
+            values = pd.to_datetime(values).dt.date
+        elif kind in COPY_TYPES:
+            values = values.astype(COPY_TYPES[kind])
+        out[column] = values
+    return pd.DataFrame(out)
+
+
+# split a table into a multiple of the slice count
+def write_sliced_parquet(df, out_dir, table, slices, files_per_slice=1):
+    "Write df as slices * files_per_slice equally sized Parquet files"
+    # Redshift loads one file per slice at a time, so a file count that is a
+    # multiple of the slice count keeps every slice busy until the end
+    out_dir = Path(out_dir) / table
+    out_dir.mkdir(parents=True, exist_ok=True)
+    num_files = max(1, slices * files_per_slice)
+    rows = len(df)
+    paths = []
+    for i in range(num_files):
+        start, stop = rows * i // num_files, rows * (i + 1) // num_files
+        path = out_dir / f"part-{i:05d}.parquet"
+        df.iloc[start:stop].to_parquet(path, compression='snappy', index=False)
+        paths.append(path)
+    return paths
+
+
+def export_tables(tables_dir='.', out_dir=EXPORT_DIR, slices=1,
+                  tables=LOAD_ORDER, layouts=None):
+    """Write the processed tables as COPY input, returns {table: paths}.
+
+    A table is read from <table>.parquet or a <table>/ folder of tables_dir
+    and written to out_dir/<table>/, the layout load_from_s3 expects.
+    """
+    import pandas as pd
+    layouts = layouts or read_table_layouts()
+    exported = {}
+    for name in tables:
+        path = Path(tables_dir) / f"{name}.parquet"
+        if not path.exists():
+            path = Path(tables_dir) / name
+        if not path.exists():
+            print(f"No {name} table in {tables_dir}, skipping")
+            continue
+        layout = layouts[SOURCE_TABLES.get(name, name)]
+        df = copy_frame(pd.read_parquet(path), layout)
+        exported[name] = write_sliced_parquet(df, out_dir, name, slices)
+        print(f"Exported {len(df)} rows of {name} in "
+              f"{len(exported[name])} files")
+    return exported
+
+
+# SQL generation
+def stage_name(table):
+    return f"stage_{table}"
+
+
+def create_stage_sql(table, dialect='redshift'):
+    if dialect == 'redshift':
+        return f"CREATE TEMP TABLE {stage_name(table)} (LIKE {table});"
+    # sqlite and postgres: an empty copy of the target's columns
+    return (f"CREATE TEMP TABLE {stage_name(table)} AS "
+            f"SELECT * FROM {table} WHERE 1 = 0;")
+
+
+def copy_sql(table, manifest_url, iam_role):
+    return (f"COPY {stage_name(table)} FROM '{manifest_url}' "
+            f"IAM_ROLE '{iam_role}' FORMAT AS PARQUET MANIFEST;")
+
+
+def _same(column, left, right):
+    # null-safe equality, Redshift has no IS NOT DISTINCT FROM
+    return (f"({left}.{column} = {right}.{column} OR "
+            f"({left}.{column} IS NULL AND {right}.{column} IS NULL))")
+
+
+def prune_unchanged_sql(table, layout):
+    "Drop staged rows that already exist unchanged in the target"
+    stage = stage_name(table)
+    same = ' AND '.join(_same(c, 't', stage) for c in layout['columns'])
+    return (f"DELETE FROM {stage} WHERE EXISTS "
+            f"(SELECT 1 FROM {table} t WHERE {same});")
+
+
+def upsert_sql(table, layout, dialect='redshift'):
+    "Statements that upsert the staged rows into the target by primary key"
+    stage = stage_name(table)
+    key = layout['primary_key']
+    columns = layout['columns']
+    others = [c for c in columns if c != key]
+    if dialect == 'redshift':
+        updates = ', '.join(f"{c} = s.{c}" for c in others)
+        values = ', '.join(f"s.{c}" for c in columns)
+        return [f"MERGE INTO {table} USING {stage} s "
+                f"ON {table}.{key} = s.{key} "
+                f"WHEN MATCHED THEN UPDATE SET {updates} "
+                f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) "
+                f"VALUES ({values});"]
+    # sqlite (3.33+) and postgres have no MERGE on every version, the same
+    # upsert as an UPDATE ... FROM followed by an anti-join INSERT
+    updates = ', '.join(f"{c} = {stage}.{c}" for c in others)
+    column_list = ', '.join(columns)
+    return [f"UPDATE {table} SET {updates} FROM {stage} "
+            f"WHERE {table}.{key} = {stage}.{key};",
+            f"INSERT INTO {table} ({column_list}) "
+            f"SELECT {column_list} FROM {stage} WHERE NOT EXISTS "
+            f"(SELECT 1 FROM {table} t WHERE t.{key} = {stage}.{key});"]
+
+
+def drop_stage_sql(table):
+    return f"DROP TABLE IF EXISTS {stage_name(table)};"
+
+
+# orchestration
+def stage_rows(cursor, table, df, dialect='sqlite'):
+    "Stand-in for COPY: insert a frame into the staging table"
+    import pandas as pd
+    marker = '?' if dialect == 'sqlite' else '%s'
+    columns = list(df.columns)
+    sql = (f"INSERT INTO {stage_name(table)} ({', '.join(columns)}) "
+           f"VALUES ({', '.join([marker] * len(columns))})")
+    values = df.astype(object).where(df.notna(), None)
+    for column in columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            # no driver binds a pandas Timestamp; sqlite3 keeps dates as
+            # ISO text, Postgres takes datetime objects
+            values[column] = [
+                None if v is None else
+                v.isoformat(sep=' ') if dialect == 'sqlite' else
+                v.to_pydatetime() for v in values[column]]
+    cursor.executemany(sql, list(values.itertuples(index=False, name=None)))
+
+
+def load_tables(conn, sources, dialect='redshift', iam_role=None,
+                layouts=None):
+    """Stage and upsert several tables in one transaction.
+
+    sources maps a table or output folder name to a COPY manifest url (redshift) or to a
+    pandas DataFrame (sqlite/postgres stand-in). Returns the number of
+    changed rows per table.
+    """
+    layouts = layouts or read_table_layouts()
+    ordered = [t for t in LOAD_ORDER if t in sources] + \
+              [t for t in sources if t not in LOAD_ORDER]
+    changed = {}
+    cursor = conn.cursor()
+    try:
+        for source in ordered:
+            table = SOURCE_TABLES.get(source, source)
+            layout = layouts[table]
+            cursor.execute(drop_stage_sql(table))
+            cursor.execute(create_stage_sql(table, dialect))
+            if dialect == 'redshift':
+                cursor.execute(copy_sql(table, sources[source], iam_role))
+            else:
+                stage_rows(cursor, table, sources[source][layout['columns']],
+                           dialect)
+            # only new and changed rows are left in the stage
+            cursor.execute(prune_unchanged_sql(table, layout))
+            cursor.execute(f"SELECT COUNT(*) FROM {stage_name(table)};")
+            changed[source] = cursor.fetchone()[0]
+            for statement in upsert_sql(table, layout, dialect):
+                cursor.execute(statement)
+            cursor.execute(drop_stage_sql(table))
+            print(f"Upserted {changed[source]} changed rows into {table}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return changed
+
+
+def load_from_s3(conn, s3_client, bucket, folder_path, iam_role,
+                 tables=LOAD_ORDER):
+    "Write a manifest per table from its S3 files and load them all"
+    sources = {}
+    for table in tables:
+        files = list_s3_files(s3_client, bucket, f"{folder_path}{table}/")
+        if not files:
+            print(f"No files found for {table}, skipping")
+            continue
+        sources[table] = put_manifest(
+            s3_client, bucket, f"{folder_path}manifests/{table}.manifest",
+            build_manifest(files))
+    return load_tables(conn, sources, 'redshift', iam_role)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the processed tables for COPY, or load them into "
+                    "Redshift")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser(
+        'export', help="write the tables in the column order COPY needs")
+    export.add_argument('--tables-dir', default='.')
+    export.add_argument('--out-dir', default=EXPORT_DIR)
+    export.add_argument('--slices', type=int, default=1,
+                        help="slice count of the cluster")
+    load = commands.add_parser(
+        'load', help="COPY and upsert the exported tables from S3")
+    load.add_argument('--cred-file', required=True)
+    load.add_argument('--bucket', required=True)
+    load.add_argument('--prefix', default=f"{EXPORT_DIR}/",
+                      help="S3 folder of the exported tables")
+    load.add_argument('--upload-dir',
+                      help="upload this export folder to --prefix first")
+    load.add_argument('--iam-role', required=True,
+                      help="IAM role ARN for COPY")
+    load.add_argument('--host', required=True)
+    load.add_argument('--database', required=True)
+    load.add_argument('--user', required=True)
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        export_tables(args.tables_dir, args.out_dir, args.slices)
+        return 0
+    import boto3
+    import redshift_connector
+    from upload_to_s3 import read_cred
+    # never on the command line, where it would end up in the shell history
+    password = os.environ.get('REDSHIFT_PASSWORD') or \
+        getpass.getpass("Redshift password: ")
+    credentials = read_cred(args.cred_file)
+    s3_client = boto3.client(
+        "s3",
+        aws_access_key_id=credentials['aws_access_key_id'],
+        aws_secret_access_key=credentials['aws_secret_access_key']
+    )
+    conn = redshift_connector.connect(host=args.host, database=args.database,
+                                      user=args.user, password=password)
+    if args.upload_dir:
+        upload_export(s3_client, args.upload_dir, args.bucket, args.prefix)
+    try:
+        load_from_s3(conn, s3_client, args.bucket, args.prefix, args.iam_role)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,9 +1,15 @@
 import numpy as np
 import pandas as pd
-import sys, io, uuid
+import sys, io, os, uuid
 from datetime import datetime
-import requests
-from io import StringIO
+from checkpoints import Checkpoints, file_fingerprint
+from data_quality import profile_frame, summarize, write_report
+from fetch_sources import fetch_many
+from landing_zone import read_landing
+from metrics import FACT_METRICS, ROLLUP_METRICS, evaluate
+from raw_cache import cached_extract
+from sketches import SKETCHES, merge_sketch_frames, sketch_frame
+from stats_catalog import record_frames
 
 # This is a sample ETL implementation to process the datafile
 # from the database using Python files. 
@@ -13,50 +19,59 @@ from io import StringIO
 
 
 # load raw data from github
-def load_data_from_github(github_url):
-    """Load data from GitHub"""
-    print(f"Loading data from GitHub: {github_url}")
+def raw_urls(github_url):
+    "Download urls of one GitHub link or a list of export files"
+    urls = [github_url] if isinstance(github_url, str) else list(github_url)
     # For raw GitHub content, convert from regular GitHub URL to raw URL
-    if 'github.com' in github_url and '/blob/' in github_url:
-        github_url = github_url.replace('github.com', 
-                     'raw.githubusercontent.com').replace('/blob/', '/')
-    # Download the CSV file from GitHub
-    response = requests.get(github_url)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Convert the content to a StringIO object
-        data_string = StringIO(response.text)
-        
-        # Read the CSV into a pandas DataFrame
-        df = pd.read_csv(data_string)
-        print(f"""Successfully loaded data: 
-        {df.shape[0]} rows and {df.shape[1]} columns""")
-        return df
-    else: 
-        raise Exception(f"""Failed to load data: HTTP status code 
-        {response.status_code}""")
+    return [url.replace('github.com', 'raw.githubusercontent.com')
+               .replace('/blob/', '/')
+            if 'github.com' in url and '/blob/' in url else url
+            for url in urls]
+
+
+def load_data_from_github(github_url):
+    """Load data from GitHub, one url or a list of export files"""
+    urls = raw_urls(github_url)
+    print(f"Loading data from GitHub: {', '.join(urls)}")
+    # Download the files concurrently, each CSV is parsed while it downloads
+    frames = fetch_many(urls, pd.read_csv)
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 \
+        else frames[0]
+    print(f"""Successfully loaded data: 
+    {df.shape[0]} rows and {df.shape[1]} columns""")
+    return df
 
 
 # data preprocessing
+# The stages pass columns on instead of copying frames: a stage reads the
+# columns it needs and builds its output from references to them plus the
+# columns it derives. Stages never modify their input in place.
 def data_preprocessing(df): 
     "Perform preprocessing, drop null and convert data types"
     print("Data Preprocessing...")
     
-    # creating a copy
-    df1 = df.dropna(subset=['Order_Number'])
-    df2 = df1.copy()
-    df2.columns = df2.columns.str.lower()
-    df2['order_date'] = pd.to_datetime(df2['order_date'], format='%d/%m/%Y')
+    # rows are only copied when some have to be dropped
+    missing = df['Order_Number'].isna()
+    if missing.any():
+        df = df[~missing.to_numpy()]
+    # lower-case names over the same columns, the parsed date is new
+    df2 = pd.DataFrame({c.lower(): df[c] for c in df.columns}, copy=False)
+    # the landing zone hands over dates already parsed
+    if not pd.api.types.is_datetime64_any_dtype(df2['order_date']):
+        df2['order_date'] = pd.to_datetime(df2['order_date'], 
+                                           format='%d/%m/%Y')
     return df2
 
 # process data dimension
-def proc_date_dim(df):
+def proc_date_dim(df, existing=None):
     "Process the date dimension "
     print("Processing date dimension...")
     # create date dimensions
     dates = pd.DataFrame({'date_full': 
                       pd.to_datetime(df['order_date'].unique())})
+    # only dates that are not stored yet are added
+    if existing is not None:
+        dates = dates[~dates['date_full'].isin(existing['date_full'])]
     # Add date attributes
     dates['day_of_week'] = dates['date_full'].dt.dayofweek + 1
     dates['day_name'] = dates['date_full'].dt.day_name()
@@ -68,24 +83,101 @@ def proc_date_dim(df):
     dates['quarter'] = dates['date_full'].dt.quarter
     dates['year'] = dates['date_full'].dt.year
     dates['is_weekend'] = dates['day_of_week'].isin([6, 7])
+    if existing is not None:
+        dates = pd.concat([existing[dates.columns], dates], ignore_index=True)
     
     return dates
 
+# slowly changing dimension, type 2
+# Every member's attributes are hashed in one vectorized pass and compared to
+# the hash stored on its current version. Members whose hash changed get
+# their current version closed (effective_to, is_current=False) and a new
+# version with a new surrogate key; new members get a first version;
+# unchanged members are carried over untouched. effective_to is empty on
+# the current version.
+SCD_COLUMNS = ['effective_from', 'effective_to', 'is_current', 'row_hash', 
+               'create_date', 'update_date']
+
+def hash_rows(df, columns):
+    # 64-bit hash per row, stored signed so it fits a Redshift BIGINT
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    return pd.Series(hashes.to_numpy().view('int64'), index=df.index)
+
+def apply_scd2(incoming, existing, natural_key, attributes, surrogate_key, 
+               run_time=None):
+    run_time = run_time if run_time is not None else pd.Timestamp.now()
+    incoming = incoming.assign(row_hash=hash_rows(incoming, attributes))
+    if existing is None or 'row_hash' not in existing.columns:
+        existing = None
+    if existing is None or existing.empty:
+        next_key = 1
+        versions = incoming
+    else:
+        current = existing.loc[existing['is_current'], 
+                               natural_key + ['row_hash', surrogate_key]]
+        # nullable integers, a float column would round the hashes
+        current = current.astype({'row_hash': 'Int64', surrogate_key: 'Int64'})
+        matched = incoming.merge(current, on=natural_key, how='left', 
+                                 suffixes=('', '_stored'))
+        # new members have no stored hash, changed ones a different hash
+        stored = matched['row_hash_stored']
+        changed = (stored.isna() | (matched['row_hash'] != stored)) \
+            .fillna(True).astype(bool)
+        versions = incoming[changed.to_numpy()]
+        expired = matched.loc[changed & matched[surrogate_key].notna(), 
+                              surrogate_key]
+        existing = existing.copy()
+        closing = existing[surrogate_key].isin(expired)
+        existing.loc[closing, 'effective_to'] = run_time
+        existing.loc[closing, 'is_current'] = False
+        existing.loc[closing, 'update_date'] = run_time
+        next_key = int(existing[surrogate_key].max()) + 1
+    versions = versions.copy()
+    versions[surrogate_key] = range(next_key, next_key + len(versions))
+    versions['effective_from'] = run_time
+    versions['effective_to'] = pd.NaT
+    versions['is_current'] = True
+    versions['create_date'] = run_time
+    versions['update_date'] = run_time
+    print(f"{surrogate_key}: {len(versions)} new or changed members")
+    columns = natural_key[:1] + [surrogate_key] + natural_key[1:] + \
+        attributes + SCD_COLUMNS
+    if existing is None or existing.empty:
+        return versions[columns].reset_index(drop=True)
+    return pd.concat([existing[columns], versions[columns]], 
+                     ignore_index=True)
+
+# dimensions without history: stored members keep their row and key, new
+# members are numbered after the largest stored key
+def upsert_members(members, existing, name_col, key_col):
+    if existing is None or existing.empty:
+        return members
+    added = members[~members[name_col].isin(existing[name_col])].copy()
+    start = int(existing[key_col].max()) + 1
+    added[key_col] = range(start, start + len(added))
+    return pd.concat([existing[members.columns], added], ignore_index=True)
+
+# read the stored version of a dimension, None on the first run
+def read_stored_dim(name):
+    path = f"{name}.parquet"
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    # the micro-batch mode keeps the facts as a folder of part files
+    return pd.read_parquet(name) if os.path.isdir(name) else None
+
 # process customer dimension
-def proc_cust_dim(df):
+def proc_cust_dim(df, existing=None):
     # process the customer dimension"
     print('Processing customer dimension...')
     # extract unique customer names
     customers = pd.DataFrame({'customer_name':
                           df['customer_name'].unique()})
-    # create surrogate keys
-    customers['customer_id'] = range(1, len(customers)+1)
     # add customer attributes
     customers['first_name'] = customers['customer_name'].str.split().str[0]
     customers['last_name'] = customers['customer_name'].str.split().str[-1]
-    # add metadata
-    customers['create_date'] = pd.to_datetime('now')
-    customers['update_date'] = pd.to_datetime('now')
+    # add surrogate keys and history against the stored dimension
+    customers = apply_scd2(customers, existing, ['customer_name'], 
+                           ['first_name', 'last_name'], 'customer_id')
     
     return customers
 
@@ -418,34 +510,29 @@ def proc_geo_dim():
     return geographys
 
 # process product dimension
-def proc_prod_dim(df):
+def proc_prod_dim(df, existing=None):
     # process product table
     print('Processing product dimension...')
-    products = df[['product', 'category', 'brand']].drop_duplicates()
-    # add a surrogate key
-    products['product_id'] = range(1, len(products)+1)
-    # add the standard cost to the product table
-    pc = df[['product', 'category', 'brand', 'cost']].drop_duplicates()
-    # ensure there is only one cost associated with each product
-    pc1 = pc.groupby(['product', 'category', 'brand']).agg(
-        costcnt=('cost', 'nunique') )
-    pc1 = pc1[pc1['costcnt'] == 1]
-    pc = pd.merge(pc, pc1, on=['product', 'category', 'brand'], how='inner')
-    pc = pc.drop(columns=['costcnt'])
-    # merge with product table
-    products = pd.merge(products, pc, 
-                        on=['product', 'category', 'brand'], how='left')
-    products.columns = ['product_name', 'category', 'brand', 'product_id', 
-                        'standard_cost']
+    # one pass over the order lines, products in order of appearance
+    costs = df.groupby(['product', 'category', 'brand'], sort=False, 
+                       dropna=False)['cost'].agg(['nunique', 'first'])
+    # the standard cost is only set when a product has a single cost
+    products = pd.DataFrame({
+        'standard_cost': costs['first'].where(costs['nunique'] == 1)
+    }).reset_index()
+    products.columns = ['product_name', 'category', 'brand', 'standard_cost']
     products.fillna(0, inplace=True)
-    # add metadata
-    products['create_date'] = pd.to_datetime('now')
-    products['update_date'] = pd.to_datetime('now')
+    # a fixed dtype keeps the attribute hash stable between runs
+    products['standard_cost'] = products['standard_cost'].astype('float64')
+    # add surrogate keys and history against the stored dimension
+    products = apply_scd2(products, existing, 
+                          ['product_name', 'category', 'brand'], 
+                          ['standard_cost'], 'product_id')
     
     return products
 
 # process order status dimension
-def proc_ostatus_dim(df):
+def proc_ostatus_dim(df, existing=None):
     print('Processing order status dimension...')
     status = df[['status']].drop_duplicates()
     status['status_id'] = range(1, len(status)+1)
@@ -463,10 +550,10 @@ def proc_ostatus_dim(df):
     status['create_date'] = pd.to_datetime('now')
     status['update_date'] = pd.to_datetime('now')
     
-    return status
+    return upsert_members(status, existing, 'status_name', 'status_id')
 
 # process employee/supervisor dimension
-def proc_emp_dim(df): 
+def proc_emp_dim(df, existing=None): 
     print('Processing employee/supervisor dimension...')
     # add supervisor dimension
     employee = df[['assigned supervisor']].drop_duplicates()
@@ -481,92 +568,372 @@ def proc_emp_dim(df):
     employee['create_date'] = pd.to_datetime('now')
     employee['update_date'] = pd.to_datetime('now')
     
-    return employee
+    return upsert_members(employee, existing, 'employee_name', 'employee_id')
 
 # create the fact table of orders
 def fact_table(df, dates, customers, geographys, 
                products, status, employee):
     print("Creating fact table...")
-    orders = df.copy()
     # create surrogate key mappings from dimension tables
     # for geography, only ensure locations
+    # only the current version of a changing dimension receives new facts
+    if 'is_current' in customers.columns:
+        customers = customers[customers['is_current']]
+    if 'is_current' in products.columns:
+        products = products[products['is_current']]
     customer_key_map = customers.set_index('customer_name')['customer_id'].to_dict()
     geo_subset = geographys[geographys.country=='India']
     geographys_key_map = geo_subset.set_index('state_code')['state_id'].to_dict()
     product_key_map = products.set_index('product_name')['product_id'].to_dict()
     status_key_map = status.set_index('status_name')['status_id'].to_dict()
     employee_key_map = employee.set_index('employee_name')['employee_id'].to_dict()
-    # map the keys
-    orders['customer_id'] = orders['customer_name'].map(customer_key_map)
-    orders['state_id'] = orders['state_code'].map(geographys_key_map)
-    orders['product_id'] = orders['product'].map(product_key_map)
-    orders['status_id'] = orders['status'].map(status_key_map)
-    orders['employee_id'] = orders['assigned supervisor'].map(employee_key_map)
-    # rename some columns
-    orders = orders.rename(columns={
-        'cost': 'unit_cost', 'sales': 'unit_sales' } )
-    # calculate derived columns
-    orders['profit'] = orders['total_sales'] - orders['total_cost']
-    orders['profit_margin'] = orders['profit'] / orders['total_sales']
-    # select necessary columns
-    required_columns = [
-        'order_number', 'order_date', 'customer_id', 'state_id', 
-        'product_id', 'status_id', 'employee_id', 'unit_cost', 
-        'unit_sales', 'quantity', 'total_cost', 'total_sales', 
-        'profit', 'profit_margin'
-    ]
+    # the fact table in its final column order: the measures are the
+    # columns of df, only the keys and the metrics of metrics.py are new
+    orders = pd.DataFrame({
+        'order_number': df['order_number'],
+        'order_date': df['order_date'],
+        # map the keys
+        'customer_id': df['customer_name'].map(customer_key_map),
+        'state_id': df['state_code'].map(geographys_key_map),
+        'product_id': df['product'].map(product_key_map),
+        'status_id': df['status'].map(status_key_map),
+        'employee_id': df['assigned supervisor'].map(employee_key_map),
+        'unit_cost': df['cost'],
+        'unit_sales': df['sales'],
+        'quantity': df['quantity'],
+        'total_cost': df['total_cost'],
+        'total_sales': df['total_sales'],
+        # calculate derived columns
+        **evaluate(FACT_METRICS, df),
+    }, copy=False)
     
-    return orders[required_columns]
+    return orders
+
+# rollup tables for the dashboards, built from the fact table
+# the measures are additive, so a rollup of new orders can be merged into
+# the stored rollup by summing per key
+ROLLUPS = {
+    'agg_daily_product': ['order_date', 'product_id'],
+    'agg_daily_state': ['order_date', 'state_id'],
+    'agg_monthly_supervisor_category': ['order_month', 'employee_id', 
+                                        'category'],
+}
+ROLLUP_MEASURES = ['order_count', 'quantity', 'total_cost', 'total_sales', 
+                   'profit']
+
+def finish_rollup(rollup):
+    # profit margin is not additive, derive it after summing
+    return rollup.assign(**evaluate(ROLLUP_METRICS, rollup))
+
+def proc_rollups(fact_orders, products):
+    print('Processing rollup tables...')
+    # categories as codes, a fact row holds a small integer instead of a
+    # reference to a string; the rollup gets the strings back
+    category_map = products.set_index('product_id')['category']
+    # the derived keys are the only new columns, the fact table is grouped
+    # as it is
+    derived = {
+        'order_month': fact_orders['order_date'].dt.to_period('M')
+                                                .dt.to_timestamp()
+                                                .rename('order_month'),
+        'category': fact_orders['product_id'].map(
+                        category_map.astype('category')).rename('category'),
+    }
+    rollups, sketches = {}, {}
+    for name, keys in ROLLUPS.items():
+        grouped = fact_orders.groupby(
+            [derived[k] if k in derived else fact_orders[k] for k in keys], 
+            dropna=False, observed=True)
+        rollup = grouped[ROLLUP_MEASURES[1:]].sum()
+        rollup.insert(0, 'order_count', grouped.size())
+        rollup = rollup.reset_index()
+        if 'category' in keys:
+            rollup['category'] = rollup['category'].astype(category_map.dtype)
+        rollups[name] = finish_rollup(rollup)
+        # mergeable sketches per day and key, for approximate distinct
+        # counts and percentiles, see sketches.py; sketches of the same
+        # keys reuse the grouping
+        for sketch, sketch_keys in SKETCHES.items():
+            if sketch_keys == keys:
+                sketches[sketch] = sketch_frame(fact_orders, keys, 
+                                                grouped=grouped)
+        # the group codes of one rollup are freed before the next is grouped
+        del grouped
+    for sketch, keys in SKETCHES.items():
+        if sketch not in sketches:
+            sketches[sketch] = sketch_frame(fact_orders, keys)
+    rollups.update(sketches)
+    return rollups
+
+def merge_rollup(existing, delta, name):
+    # add the rollup of the new orders to the stored rollup
+    if name in SKETCHES:
+        return merge_sketch_frames(pd.concat([existing, delta]), 
+                                   SKETCHES[name])
+    keys = ROLLUPS[name]
+    merged = pd.concat([existing[keys + ROLLUP_MEASURES], 
+                        delta[keys + ROLLUP_MEASURES]])
+    merged = merged.groupby(keys, dropna=False)[ROLLUP_MEASURES].sum() \
+                   .reset_index()
+    # keys whose orders were all replaced drop out
+    return finish_rollup(merged[merged['order_count'] != 0])
+
+# membership index of the loaded order numbers
+# a sorted int64 array saved with numpy, a batch is checked against it with
+# one vectorized binary search instead of a join with the stored facts
+ORDER_INDEX_FILE = 'order_index.npy'
+
+def load_order_index(path=ORDER_INDEX_FILE):
+    if not os.path.exists(path):
+        return np.empty(0, dtype='int64')
+    return np.load(path, mmap_mode='r')
+
+# bytes of a frame converted to Arrow and written per row group
+WRITE_BYTES = 1 << 21
+
+def release_memory():
+    # glibc keeps the freed temporaries of a stage in the heap, and Arrow's
+    # pool the buffers of the Parquet writer, where the next stage cannot
+    # always reuse them; hand them back to the system so every stage starts
+    # from the frames that are alive (malloc_trim is a no-op off glibc)
+    import ctypes
+    if 'pyarrow' in sys.modules:
+        sys.modules['pyarrow'].default_memory_pool().release_unused()
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def save_parquet(df, path, compression='snappy', chunk_bytes=WRITE_BYTES):
+    # one row group at a time, so only one slice of the table is ever held
+    # as Arrow columns and encoded pages; the slices are allocated with
+    # malloc, which reuses the freed slice for the next one, where Arrow's
+    # default pool keeps every slice's pages
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    pool = pa.system_memory_pool()
+    # slices of about chunk_bytes, a row of sketches is a few KB, a fact
+    # row a few hundred bytes
+    sample = df.iloc[:1024]
+    row_bytes = sample.memory_usage(index=False, deep=True).sum() / \
+        max(len(sample), 1)
+    chunk_rows = max(1, int(chunk_bytes // max(row_bytes, 1)))
+    # the types come from the first slice, a column that is null there
+    # takes the type of its first value
+    schema = pa.Schema.from_pandas(df.iloc[:chunk_rows], preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            values = df[field.name].dropna()
+            if len(values):
+                schema = schema.set(i, field.with_type(pa.Schema.from_pandas(
+                    values.iloc[:1].to_frame(), preserve_index=False)[0].type))
+    with pq.ParquetWriter(path, schema, compression=compression,
+                          memory_pool=pool) as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            part = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(part[field.name], type=field.type, 
+                          from_pandas=True, memory_pool=pool)
+                 for field in schema], schema=schema))
+
+def save_order_index(index, path=ORDER_INDEX_FILE):
+    # write then rename, a failed run never leaves a partial index
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, np.asarray(index, dtype='int64'))
+    os.replace(tmp_path, path)
+
+def contains_orders(index, order_numbers):
+    order_numbers = np.asarray(order_numbers, dtype='int64')
+    if len(index) == 0:
+        return np.zeros(len(order_numbers), dtype=bool)
+    pos = np.searchsorted(index, order_numbers)
+    found = np.asarray(index)[np.minimum(pos, len(index) - 1)]
+    return (pos < len(index)) & (found == order_numbers)
+
+# split a batch of facts into new orders and orders that were loaded before
+# stored is the fact table loaded before, None on the first run
+# with append_only the facts returned are only the rows to append, and
+# stored only needs the stored versions of the orders the batch replaces
+def ingest_facts(fact_orders, products, index, on_duplicate='skip', 
+                 stored=None, append_only=False):
+    # the last row wins for an order repeated inside the batch
+    fact_orders = fact_orders.drop_duplicates('order_number', keep='last')
+    loaded = contains_orders(index, fact_orders['order_number'])
+    new_facts = fact_orders[~loaded]
+    duplicates = fact_orders[loaded]
+    print(f"{len(new_facts)} new orders, {len(duplicates)} already loaded "
+          f"({on_duplicate})")
+    added, replaced = new_facts, None
+    if on_duplicate == 'update' and len(duplicates):
+        added = pd.concat([new_facts, duplicates], ignore_index=True)
+        if stored is not None:
+            is_replaced = stored['order_number'].isin(duplicates['order_number'])
+            replaced = stored[is_replaced]
+            stored = stored[~is_replaced]
+    facts = added if stored is None or append_only else \
+        pd.concat([stored, added], ignore_index=True)
+    # rollup delta: the added orders minus the versions they replace
+    deltas = proc_rollups(added, products)
+    if replaced is not None and len(replaced):
+        for name, retract in proc_rollups(replaced, products).items():
+            if name in SKETCHES:
+                # sketches cannot remove the replaced values
+                continue
+            retract[ROLLUP_MEASURES] = -retract[ROLLUP_MEASURES]
+            deltas[name] = pd.concat([deltas[name], retract], 
+                                     ignore_index=True)
+    index = np.union1d(index, new_facts['order_number'].astype('int64'))
+    return facts, deltas, index
 
 # main ETL function
-def run_etl_github(github_url): 
-    print("Starting ETL process...")
+# with incremental=True the facts of this run are appended to the stored
+# facts: orders that were loaded before are skipped, or replace the stored
+# order with on_duplicate='update', and the rollups are merged with the
+# rollup of the changes only
+def extract_data(github_url, use_cache=True, landing_zone=None,
+                 database=None):
+    """Load and preprocess the raw data, returns (df, raw data profile)
+
+    With landing_zone the typed Parquet of landing_zone.py is read instead
+    of the CSV at github_url, with database (a db_source.DatabaseSource)
+    the orders table of the database.
+    """
+    if database is not None:
+        df = database.read_orders()
+        return data_preprocessing(df), profile_frame(df, 'raw')
+    if landing_zone is not None:
+        df = read_landing(landing_zone)
+        return data_preprocessing(df), profile_frame(df, 'raw')
+    if use_cache:
+        # unchanged sources are neither downloaded nor preprocessed again
+        return cached_extract(raw_urls(github_url), data_preprocessing,
+                              lambda raw: profile_frame(raw, 'raw'))
     # load data from github link
     df = load_data_from_github(github_url)
+    # profile the raw data before rows are dropped
+    raw_report = profile_frame(df, 'raw')
     # preprocessing 
-    df = data_preprocessing(df)
+    return data_preprocessing(df), raw_report
+
+
+def transform_data(df, raw_report, incremental=False, on_duplicate='skip',
+                   checkpoints=True):
+    """Build the star schema from preprocessed data and save it locally
+
+    With checkpoints, stages whose inputs did not change since a failed
+    run are loaded instead of run again, see checkpoints.py.
+    """
     print(df.columns)
+    stages = Checkpoints(enabled=checkpoints)
+
+    def stored(name):
+        # the stored tables are fingerprinted by their files, not their rows
+        table = read_stored_dim(name)
+        if table is not None:
+            path = f"{name}.parquet"
+            stages.remember(table, file_fingerprint(
+                path if os.path.exists(path) else name))
+        return table
+
     # transform and create dimensions
-    dim_date = proc_date_dim(df)
-    dim_cust = proc_cust_dim(df)
-    dim_geo = proc_geo_dim()
-    dim_prod = proc_prod_dim(df)
-    dim_ostatus = proc_ostatus_dim(df)
-    dim_emp = proc_emp_dim(df)
+    # stored members keep their keys, so stored facts stay valid
+    dim_date = stages.run('dim_date', proc_date_dim, df, 
+                          stored('dim_date'))
+    dim_cust = stages.run('dim_cust', proc_cust_dim, df, 
+                          stored('dim_cust'))
+    dim_geo = stored('dim_geo')
+    if dim_geo is None:
+        dim_geo = stages.run('dim_geo', proc_geo_dim)
+    dim_prod = stages.run('dim_prod', proc_prod_dim, df, 
+                          stored('dim_prod'))
+    dim_ostatus = stages.run('dim_ostatus', proc_ostatus_dim, df, 
+                             stored('dim_ostatus'))
+    dim_emp = stages.run('dim_emp', proc_emp_dim, df, 
+                         stored('dim_emp'))
     # transform fact table, orders
-    fact_orders = fact_table(df, dim_date, dim_cust, dim_geo, 
-               dim_prod, dim_ostatus, dim_emp)
+    fact_orders = stages.run('fact_orders', fact_table, df, dim_date, 
+                             dim_cust, dim_geo, dim_prod, dim_ostatus, 
+                             dim_emp)
+    # the facts of this run, profiled for the data quality report
+    run_facts = fact_orders
+    # pre-aggregate the fact table for the dashboards
+    if incremental:
+        index = load_order_index()
+        if os.path.exists(ORDER_INDEX_FILE):
+            stages.remember(index, file_fingerprint(ORDER_INDEX_FILE))
+        fact_orders, rollups, order_index = stages.run(
+            'ingest_facts', ingest_facts, fact_orders, dim_prod, 
+            index, on_duplicate, stored('fact_orders'))
+        for name in rollups:
+            if os.path.exists(f"{name}.parquet"):
+                rollups[name] = merge_rollup(
+                    pd.read_parquet(f"{name}.parquet"), rollups[name], name)
+    else:
+        rollups = stages.run('rollups', proc_rollups, fact_orders, dim_prod)
+        order_index = np.unique(fact_orders['order_number'].astype('int64'))
     # name the files to be saved
     files = [dim_date, dim_cust, dim_geo, dim_prod, dim_ostatus, 
-             dim_emp, fact_orders]
+             dim_emp, fact_orders] + list(rollups.values())
     file_names = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 
-                  'dim_ostatus', 'dim_emp', 'fact_orders']
+                  'dim_ostatus', 'dim_emp', 'fact_orders'] + list(rollups)
     # save the files locally to parquet files
     comp = 'snappy'       
     try: 
+        # every file is written aside first and renamed once all are
+        # written, so a failed save leaves the stored tables, and with them
+        # the checkpoint keys of the next run, unchanged
+        staged = []
         for i in range(len(files)):
+            release_memory()
             parquet_file_path = f"{file_names[i]}.parquet"
             csv_file_path = f"{file_names[i]}.csv"
-            files[i].to_parquet(parquet_file_path, compression = comp)
-            files[i].to_csv(csv_file_path, index = False)
+            staged.append((f".{parquet_file_path}.tmp", parquet_file_path))
+            save_parquet(files[i], staged[-1][0], compression = comp)
+            # binary sketches have no CSV form
+            if file_names[i] not in SKETCHES:
+                staged.append((f".{csv_file_path}.tmp", csv_file_path))
+                files[i].to_csv(staged[-1][0], index = False)
+        for tmp, path in staged:
+            os.replace(tmp, path)
+        # the index is saved last, it only lists orders that were written
+        save_order_index(order_index)
         print("ETL files saved successfully!")
+        release_memory()
+        # file statistics for readers that skip files
+        record_frames({name: (f"{name}.parquet", df) 
+                       for name, df in zip(file_names, files)})
+        # data quality report: the raw input was profiled when it was read,
+        # the dimensions are built from its checked columns, so only the
+        # facts of this run take one more pass
+        release_memory()
+        reports = [raw_report, profile_frame(run_facts, 'fact_orders')]
+        write_report(summarize(reports, raw_report['rows'] - len(df)), 
+                     'dq_report.json')
     except Exception as e:
         print(f"Error saving the files: {e}")
+        for tmp, _ in staged:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        # scheduled runs need to see the failure in the exit code, the
+        # checkpoints are kept for the rerun
+        raise
+    stages.complete()
+    return file_names
+
+
+def run_etl_github(github_url, incremental=False, on_duplicate='skip',
+                   use_cache=True, landing_zone=None, checkpoints=True,
+                   database=None): 
+    print("Starting ETL process...")
+    df, raw_report = extract_data(github_url, use_cache, landing_zone,
+                                  database)
+    return transform_data(df, raw_report, incremental, on_duplicate, 
+                          checkpoints)
 
 # based on github location, save the ETL files locally
 
 
-# usage
+# usage, see etl_cli.py for the options
 if __name__ == "__main__":
-    # Replace with your actual file path and connection string
-    data_source = input(
-        """Please enter the data source ("github or "database"): """)
-    if data_source=='github':
-        github_url = input(
-            """Please enter the GitHub link: """)
-        run_etl_github(github_url)
-    elif data_source=='database': 
-        db_connection = input(
-            """DB connection not supported. Please use github link.""")
-    else: 
-        raise Exception('Failed to initalize.')
\ No newline at end of file
+    from etl_cli import main
+    raise SystemExit(main(['run'] + sys.argv[1:]))
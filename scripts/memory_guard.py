@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Memory regression guard for the local pipeline.
+# The raw export is repeated --scale times (with new order numbers) into a
+# CSV file, and a fresh interpreter loads it and runs it through the path
+# of a local run: the raw profile, data_preprocessing and transform_data
+# with its checkpoints, saved tables, catalog and report. The peak resident
+# set size of the run, loaded input included, is compared to the size of
+# the CSV file, as is the part of the peak above the loaded input (what the
+# run adds); the guard exits with 1 when either ratio, or the peak bytes
+# per input row, is over budget, so it can run next to the other checks
+# before a merge.
+# The loaded frame alone takes about 1.9x the CSV size (pandas object
+# strings), so the 1.5x target applies to the run, and the total and per
+# row budgets are the loaded frame plus that target.
+# The counters come from /proc, so the guard runs on Linux.
+#   python memory_guard.py --raw ../data/raw/Online-eCommerce.csv
+
+# measured at the default scale: 3.2x, 1.3x above the loaded input and
+# 400 bytes per row; the run needed 5.7x (3.8x above the loaded input)
+# before the saves were written in slices and freed memory was handed
+# back between them. About 0.6x of it is the fixed cost of pyarrow and
+# its Parquet writer, which larger inputs amortize
+MAX_RATIO = 3.4
+MAX_STAGE_RATIO = 1.5
+MAX_BYTES_PER_ROW = 420
+SCALE = 50
+
+
+def _status(field, pid='self'):
+    # resident memory counters of a process in bytes, Linux only
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def current_rss(pid='self'):
+    return _status('VmRSS', pid)
+
+
+def reset_peak_rss(pid='self'):
+    # writing 5 to clear_refs resets the peak (VmHWM) to the current RSS
+    with open(f'/proc/{pid}/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def peak_rss(pid='self'):
+    return _status('VmHWM', pid)
+
+
+def make_input(raw_path, scale, out_path):
+    "Repeat the raw export scale times with unique order numbers"
+    import pandas as pd
+    raw = pd.read_csv(raw_path)
+    step = int(raw['Order_Number'].max()) + 1
+    parts = [raw.assign(Order_Number=raw['Order_Number'] + i * step)
+             for i in range(scale)]
+    pd.concat(parts, ignore_index=True).to_csv(out_path, index=False)
+
+
+def measure(csv_path):
+    "Run in a fresh interpreter: peak memory of a local pipeline run"
+    import gc
+    import pandas as pd
+    import local_etl_test as etl
+    from data_quality import profile_frame
+    baseline = current_rss()
+    input_bytes = os.path.getsize(csv_path)
+    raw = pd.read_csv(csv_path)
+    rows = len(raw)
+    gc.collect()
+    loaded = current_rss()
+    # the parser's own peak is not part of the stages
+    reset_peak_rss()
+    # the path of a run: profile, preprocess, then transform_data with its
+    # checkpoints, staged saves, catalog and report, into the working folder
+    raw_report = profile_frame(raw, 'raw')
+    df = etl.data_preprocessing(raw)
+    del raw
+    etl.transform_data(df, raw_report)
+    peak = peak_rss()
+    used = peak - baseline
+    return {'rows': rows, 'input_bytes': input_bytes, 'peak_bytes': used,
+            'ratio': round(used / input_bytes, 3),
+            'stage_ratio': round((peak - loaded) / input_bytes, 3),
+            'bytes_per_row': round(used / rows, 1)}
+
+
+def run_guard(raw_path, scale=SCALE, max_ratio=MAX_RATIO,
+              max_bytes_per_row=MAX_BYTES_PER_ROW,
+              max_stage_ratio=MAX_STAGE_RATIO):
+    "Measure in a subprocess and compare to the budget, returns the result"
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'orders.csv')
+        make_input(raw_path, scale, csv_path)
+        out = subprocess.run(
+            [sys.executable, __file__, '--measure', csv_path],
+            cwd=tmp, capture_output=True, text=True, check=True,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+                [os.path.dirname(os.path.abspath(__file__))] +
+                [os.environ.get('PYTHONPATH', '')])))
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['passed'] = result['ratio'] <= max_ratio and \
+        result['stage_ratio'] <= max_stage_ratio and \
+        result['bytes_per_row'] <= max_bytes_per_row
+    print(f"{result['rows']} rows, input {result['input_bytes'] / 1e6:.1f} MB,"
+          f" peak {result['peak_bytes'] / 1e6:.1f} MB above baseline: "
+          f"{result['ratio']}x the input ({result['stage_ratio']}x above the "
+          f"loaded input), {result['bytes_per_row']} bytes per row (budget "
+          f"{max_ratio}x, {max_stage_ratio}x, {max_bytes_per_row} bytes)")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fail when the local pipeline needs too much memory")
+    parser.add_argument('--raw', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'raw',
+        'Online-eCommerce.csv'))
+    parser.add_argument('--scale', type=int, default=SCALE)
+    parser.add_argument('--max-ratio', type=float, default=MAX_RATIO)
+    parser.add_argument('--max-stage-ratio', type=float,
+                        default=MAX_STAGE_RATIO)
+    parser.add_argument('--max-bytes-per-row', type=float,
+                        default=MAX_BYTES_PER_ROW)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.measure:
+        # quiet the stage progress output, only the result goes to stdout
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        result = measure(args.measure)
+        sys.stdout = stdout
+        print(json.dumps(result))
+        return 0
+    if not os.path.exists('/proc/self/clear_refs'):
+        parser.error("the memory guard needs Linux /proc counters")
+    result = run_guard(args.raw, args.scale, args.max_ratio,
+                       args.max_bytes_per_row, args.max_stage_ratio)
+    return 0 if result['passed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
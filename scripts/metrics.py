@@ -0,0 +1,239 @@
+import ast
+
+# Derived metrics shared by the local (pandas) and the Glue (PySpark)
+# pipelines.
+# A metric is an expression over table columns and the metrics defined
+# before it, written once here and compiled for each engine: into NumPy
+# array operations over the input columns (every metric in one evaluation,
+# each input column converted once, intermediate metrics reused), or into
+# Spark Column expressions for a single select. Adding a metric adds an
+# expression to that evaluation, not another pass over the table.
+#
+# Expressions use + - * /, comparisons, & | ~, numbers and these functions:
+#   div(a, b, default)    a / b, default where b is 0
+#   coalesce(a, b, ...)   first non-null value
+#   if_(cond, a, b)       a where cond holds, else b (also for a null cond)
+#   abs(a), least(a, b), greatest(a, b)
+# Nulls propagate through arithmetic like in SQL, and a plain a / b is null
+# where b is 0, in both engines.
+# The Glue job imports this file through --extra-py-files.
+#   FACT_METRICS['cost_ratio'] = 'div(total_cost, total_sales, 0)'
+
+FACT_METRICS = {
+    'profit': 'total_sales - total_cost',
+    'profit_margin': 'div(profit, total_sales, 0)',
+}
+# computed on the summed measures, the ratios are not additive
+ROLLUP_METRICS = {
+    'profit_margin': 'div(profit, total_sales, 0)',
+}
+
+_FUNCTIONS = {'div': 3, 'coalesce': None, 'if_': 3, 'abs': 1, 'least': 2,
+              'greatest': 2}
+_BINARY = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+           ast.BitAnd: '&', ast.BitOr: '|'}
+_COMPARE = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+            ast.Eq: '==', ast.NotEq: '!='}
+
+
+# parsing
+def _parse(name, text):
+    "Expression tree of one metric, as nested tuples"
+    def build(node):
+        if isinstance(node, ast.Expression):
+            return build(node.body)
+        if isinstance(node, ast.Name):
+            return ('col', node.id)
+        if isinstance(node, ast.Constant) and \
+                isinstance(node.value, (int, float)):
+            return ('lit', float(node.value))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return ('-', ('lit', 0.0), build(node.operand))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            return ('~', build(node.operand))
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            return (_BINARY[type(node.op)], build(node.left),
+                    build(node.right))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and \
+                type(node.ops[0]) in _COMPARE:
+            return (_COMPARE[type(node.ops[0])], build(node.left),
+                    build(node.comparators[0]))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in _FUNCTIONS and not node.keywords:
+            arity = _FUNCTIONS[node.func.id]
+            if arity is not None and len(node.args) != arity:
+                raise ValueError(f"{name}: {node.func.id}() takes {arity} "
+                                 f"arguments")
+            return (node.func.id,) + tuple(build(a) for a in node.args)
+        raise ValueError(f"{name}: unsupported expression "
+                         f"'{ast.unparse(node)}'")
+    return build(ast.parse(text, mode='eval'))
+
+
+def compile_metrics(metrics, columns):
+    """Check the definitions, returns {metric: expression tree}.
+
+    A metric may use the given input columns and the metrics before it.
+    """
+    trees, known = {}, set(columns)
+
+    def names(tree):
+        if tree[0] == 'col':
+            yield tree[1]
+        elif tree[0] != 'lit':
+            for arg in tree[1:]:
+                yield from names(arg)
+
+    for name, text in metrics.items():
+        tree = _parse(name, text)
+        unknown = sorted(set(names(tree)) - known - set(trees))
+        if unknown:
+            raise ValueError(f"{name}: unknown column(s) {', '.join(unknown)}")
+        trees[name] = tree
+    return trees
+
+
+def input_columns(metrics, columns):
+    "Input columns the metrics read"
+    trees = compile_metrics(metrics, columns)
+    used = set()
+
+    def walk(tree):
+        if tree[0] == 'col':
+            if tree[1] not in trees:
+                used.add(tree[1])
+        elif tree[0] != 'lit':
+            for arg in tree[1:]:
+                walk(arg)
+
+    for tree in trees.values():
+        walk(tree)
+    return [c for c in columns if c in used]
+
+
+# NumPy
+def evaluate(metrics, df):
+    """Compute the metrics over a frame, returns {metric: Series}.
+
+    Every input column is read once as a float array; the results share
+    the index of df and can go straight into a DataFrame.
+    """
+    import numpy as np
+    import pandas as pd
+    trees = compile_metrics(metrics, df.columns)
+    values = {c: df[c].to_numpy(dtype='float64', na_value=np.nan)
+              for c in input_columns(metrics, list(df.columns))}
+
+    def run(tree):
+        op = tree[0]
+        if op == 'col':
+            return values[tree[1]]
+        if op == 'lit':
+            return tree[1]
+        args = [run(a) for a in tree[1:]]
+        if op == '+':
+            return args[0] + args[1]
+        if op == '-':
+            return args[0] - args[1]
+        if op == '*':
+            return args[0] * args[1]
+        if op in ('/', 'div'):
+            default = args[2] if op == 'div' else np.nan
+            a, b = np.broadcast_arrays(args[0], args[1])
+            out = np.array(np.broadcast_to(default, a.shape), dtype='float64')
+            # nulls stay null, only a zero divisor takes the default
+            np.divide(a, b, out=out, where=(b != 0))
+            return out
+        if op == 'coalesce':
+            out = args[-1]
+            for a in reversed(args[:-1]):
+                out = np.where(np.isnan(a), out, a)
+            return out
+        if op == 'if_':
+            return np.where(args[0], args[1], args[2])
+        if op == 'abs':
+            return np.abs(args[0])
+        if op == 'least':
+            return np.fmin(args[0], args[1])
+        if op == 'greatest':
+            return np.fmax(args[0], args[1])
+        if op == '~':
+            return ~args[0]
+        if op == '&':
+            return args[0] & args[1]
+        if op == '|':
+            return args[0] | args[1]
+        a, b = args
+        return {'<': lambda: a < b, '<=': lambda: a <= b,
+                '>': lambda: a > b, '>=': lambda: a >= b,
+                '==': lambda: a == b, '!=': lambda: a != b}[op]()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, tree in trees.items():
+            result = run(tree)
+            values[name] = np.broadcast_to(result, len(df)) \
+                if np.ndim(result) == 0 else result
+    return {name: pd.Series(values[name], index=df.index, name=name)
+            for name in trees}
+
+
+# PySpark
+def spark_columns(metrics, columns):
+    """The metrics as Spark Columns, for one select next to the inputs.
+
+    Metrics that use other metrics get their expressions inlined, Catalyst
+    evaluates the shared parts once.
+    """
+    from pyspark.sql import functions as F
+    trees = compile_metrics(metrics, columns)
+    built = {}
+
+    def build(tree):
+        op = tree[0]
+        if op == 'col':
+            return built[tree[1]] if tree[1] in built else \
+                F.col(f"`{tree[1]}`").cast('double')
+        if op == 'lit':
+            return F.lit(tree[1])
+        args = [build(a) for a in tree[1:]]
+        if op == '+':
+            return args[0] + args[1]
+        if op == '-':
+            return args[0] - args[1]
+        if op == '*':
+            return args[0] * args[1]
+        if op == '/':
+            return F.when(args[1] != 0, args[0] / args[1])
+        if op == 'div':
+            return F.when(args[1] == 0, args[2]).otherwise(args[0] / args[1])
+        if op == 'coalesce':
+            return F.coalesce(*args)
+        if op == 'if_':
+            return F.when(args[0], args[1]).otherwise(args[2])
+        if op == 'abs':
+            return F.abs(args[0])
+        if op == 'least':
+            return F.least(*args)
+        if op == 'greatest':
+            return F.greatest(*args)
+        if op == '~':
+            return ~args[0]
+        if op == '&':
+            return args[0] & args[1]
+        if op == '|':
+            return args[0] | args[1]
+        a, b = args
+        return {'<': lambda: a < b, '<=': lambda: a <= b,
+                '>': lambda: a > b, '>=': lambda: a >= b,
+                '==': lambda: a == b, '!=': lambda: a != b}[op]()
+
+    for name, tree in trees.items():
+        built[name] = build(tree)
+    return [built[name].alias(name) for name in trees]
+
+
+def with_metrics(df, metrics):
+    "A Spark DataFrame with the metrics added (or replaced) in one select"
+    names = set(metrics)
+    return df.select(*[f"`{c}`" for c in df.columns if c not in names],
+                     *spark_columns(metrics, df.columns))
@@ -0,0 +1,262 @@
+import argparse
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+from sketches import SKETCHES, estimate_frame, merge_sketch_frames
+from stats_catalog import load_catalog, prune_files
+
+# In-process query layer over the processed star schema.
+# The fact table is scanned lazily: only the columns a query needs are read,
+# and filters are pushed down into the Parquet reader so row groups that
+# cannot match are skipped; before that, the statistics catalog
+# (_stats_catalog.json, see stats_catalog.py) drops the files whose key
+# ranges cannot match at all. Filters on dimension attributes are first
+# resolved to fact keys through in-memory dimension indexes. Results are kept
+# in an LRU cache keyed on the query and the data version, which changes
+# whenever an output file is rewritten.
+# Distinct customers and percentiles can also be answered approximately
+# from the sketch tables (see sketches.py), without reading the facts.
+
+FACT_TABLE = 'fact_orders'
+# dimension table: (fact foreign key, dimension primary key)
+DIMENSIONS = {
+    'dim_date': ('order_date', 'date_full'),
+    'dim_cust': ('customer_id', 'customer_id'),
+    'dim_geo': ('state_id', 'state_id'),
+    'dim_prod': ('product_id', 'product_id'),
+    'dim_ostatus': ('status_id', 'status_id'),
+    'dim_emp': ('employee_id', 'employee_id'),
+}
+AGGREGATES = ('sum', 'mean', 'min', 'max', 'count')
+
+
+def _file_signature(path):
+    "(name, size, mtime) of a Parquet file or of every file in a folder"
+    path = Path(path)
+    files = sorted(p for p in path.rglob('*') if p.is_file()) \
+        if path.is_dir() else [path]
+    return tuple((str(p), p.stat().st_size, p.stat().st_mtime_ns)
+                 for p in files if p.exists())
+
+
+class StarSchemaQuery:
+    "Query the star schema written by the local pipeline or the Glue job"
+
+    def __init__(self, folder, cache_size=128):
+        self.folder = Path(folder)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._indexes = {}
+        self._catalog = None
+        self._version = None
+
+    def _path(self, table):
+        path = self.folder / f"{table}.parquet"
+        # the Glue job writes one folder per table
+        return path if path.exists() else self.folder / table
+
+    def data_version(self):
+        "Fingerprint of all output files, checked on every query"
+        version = hash(tuple(_file_signature(self._path(t))
+                             for t in [FACT_TABLE] + list(DIMENSIONS) +
+                             list(SKETCHES)))
+        if version != self._version:
+            # the outputs were rewritten, drop everything built on them
+            self._version = version
+            self._cache.clear()
+            self._indexes.clear()
+            self._catalog = None
+        return version
+
+    def _files(self, table):
+        "Data files of a table, a single file or the files of its folder"
+        path = self._path(table)
+        if not path.is_dir():
+            return [path]
+        return sorted(p for p in path.rglob('*.parquet')
+                      if not p.name.startswith(('.', '_')))
+
+    def _prune(self, table, files, filters):
+        """The files that may match the filters, per the catalog.
+
+        All files when the catalog does not describe the files on disk.
+        """
+        if self._catalog is None:
+            self._catalog = load_catalog(self.folder)
+        kept = prune_files(self._catalog, table, filters)
+        if kept is None:
+            return files
+        # the Glue job records S3 urls, the files are matched by name
+        listed = {p.rsplit('/', 1)[-1]
+                  for p in self._catalog['tables'][table]['files']}
+        if {p.name for p in files} != listed:
+            return files
+        kept = {p.rsplit('/', 1)[-1] for p in kept}
+        return [p for p in files if p.name in kept]
+
+    def _read(self, table, columns=None, filters=()):
+        "Rows of a table, reading only the files the catalog cannot rule out"
+        import pyarrow.parquet as pq
+        files = self._files(table)
+        kept = self._prune(table, files, filters)
+        if len(kept) == len(files):
+            return pd.read_parquet(self._path(table), columns=columns,
+                                   filters=filters or None)
+        if not kept:
+            # nothing can match, an empty frame of the table's columns
+            empty = pq.read_schema(files[0]).empty_table()
+            return (empty.select(columns) if columns else empty).to_pandas()
+        return pq.read_table([str(p) for p in kept], columns=columns,
+                             filters=filters or None).to_pandas()
+
+    def dimension(self, table):
+        "Dimension table indexed by its primary key, built once per version"
+        if table not in self._indexes:
+            key = DIMENSIONS[table][1]
+            dim = pd.read_parquet(self._path(table))
+            self._indexes[table] = dim.drop_duplicates(key).set_index(key)
+        return self._indexes[table]
+
+    def _owner(self, column):
+        """(dimension, attribute) of a column, None for fact columns.
+
+        Attributes found in several dimensions (create_date, ...) can be
+        qualified with the table name, e.g. 'dim_prod.create_date'.
+        """
+        if '.' in column:
+            table, attribute = column.split('.', 1)
+            return table, attribute
+        for table in DIMENSIONS:
+            if column in self.dimension(table).columns:
+                return table, column
+        return None
+
+    def _fact_filters(self, filters):
+        "Turn dimension attribute filters into fact key filters"
+        pushed = []
+        for column, op, value in filters:
+            owner = self._owner(column)
+            if owner is None:
+                pushed.append((column, op, value))
+                continue
+            table, attribute = owner
+            dim = self.dimension(table).reset_index()
+            values = dim[attribute]
+            mask = {
+                '==': lambda: values == value,
+                '!=': lambda: values != value,
+                '<': lambda: values < value,
+                '<=': lambda: values <= value,
+                '>': lambda: values > value,
+                '>=': lambda: values >= value,
+                'in': lambda: values.isin(value),
+                'not in': lambda: ~values.isin(value),
+            }[op]()
+            fact_key, dim_key = DIMENSIONS[table]
+            pushed.append((fact_key, 'in', dim.loc[mask, dim_key].tolist()))
+        return pushed
+
+    def query(self, measures, group_by=(), filters=(), agg='sum'):
+        """Aggregate fact measures by fact or dimension columns.
+
+        filters are (column, op, value) tuples on fact or dimension columns,
+        e.g. [('category', '==', 'SSD'), ('order_date', '>=', start)].
+        """
+        if agg not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate: {agg}")
+        measures, group_by = list(measures), list(group_by)
+        filters = [tuple(f) for f in filters]
+        key = (self.data_version(), tuple(measures), tuple(group_by),
+               repr(filters), agg)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        # columns of the fact table this query touches
+        owners = {c: self._owner(c) for c in group_by}
+        fact_columns = set(measures)
+        fact_columns.update(c if o is None else DIMENSIONS[o[0]][0]
+                            for c, o in owners.items())
+        pushed = self._fact_filters(filters)
+        fact = self._read(FACT_TABLE, sorted(fact_columns), pushed)
+        # resolve dimension attributes through the key indexes
+        for column, owner in owners.items():
+            if owner is not None:
+                table, attribute = owner
+                fact[column] = fact[DIMENSIONS[table][0]].map(
+                    self.dimension(table)[attribute])
+        if group_by:
+            result = fact.groupby(group_by, dropna=False)[measures] \
+                         .agg(agg).reset_index()
+        else:
+            result = fact[measures].agg(agg).to_frame().T
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result.copy()
+
+    def approximate(self, table, group_by=(), filters=(), 
+                    quantiles=(0.5, 0.9)):
+        """Distinct customers and percentiles from a sketch table.
+
+        group_by and filters take the keys of the table (order_date,
+        product_id, state_id) or attributes of their dimensions, like
+        query(). The sketches of every group are merged and estimated, e.g.
+        approximate('sketch_daily_state', ['state_name', 'month_name']).
+        """
+        group_by = list(group_by)
+        filters = [tuple(f) for f in filters]
+        key = (self.data_version(), table, tuple(group_by), repr(filters), 
+               tuple(quantiles))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        pushed = self._fact_filters(filters)
+        sketches = self._read(table, filters=pushed)
+        for column in group_by:
+            owner = self._owner(column)
+            if owner is not None:
+                table_name, attribute = owner
+                sketches[column] = sketches[DIMENSIONS[table_name][0]].map(
+                    self.dimension(table_name)[attribute])
+        # one group of everything when nothing is grouped
+        groups = group_by or ['_all']
+        merged = merge_sketch_frames(sketches.assign(_all=0), groups)
+        result = pd.concat([merged[group_by], estimate_frame(merged, 
+                                                             quantiles)], 
+                           axis=1)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result.copy()
+
+    def timed_query(self, *args, **kwargs):
+        "Run a query and print how long it took"
+        start = time.perf_counter()
+        result = self.query(*args, **kwargs)
+        print(f"Query returned {len(result)} rows in "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Aggregate the processed star schema")
+    parser.add_argument('folder', nargs='?', default='.',
+                        help="folder of the processed Parquet tables")
+    parser.add_argument('--measures', nargs='+',
+                        default=['total_sales', 'profit'])
+    parser.add_argument('--group-by', nargs='*', default=['category', 'year'])
+    parser.add_argument('--agg', choices=AGGREGATES, default='sum')
+    args = parser.parse_args(argv)
+    star = StarSchemaQuery(args.folder)
+    print(star.timed_query(args.measures, args.group_by, agg=args.agg))
+    # the same query again is served from the cache
+    print(star.timed_query(args.measures, args.group_by, agg=args.agg))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
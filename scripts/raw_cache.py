@@ -0,0 +1,222 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
+from pathlib import Path
+
+import requests
+
+# Local cache of downloaded and preprocessed raw data.
+# Every source url remembers the ETag/Last-Modified it was last served with
+# and the hash of its content. A rerun revalidates the sources with a
+# conditional GET; when none of them changed, the preprocessed frame is
+# loaded from an uncompressed Arrow IPC (Feather) file through a memory map,
+# so numeric columns are handed to pandas without a copy. A changed source,
+# or one without validators, is downloaded again, and the preprocessing is
+# still skipped when its content hash matches a cached entry.
+# Entries are keyed on the content hashes and the source code of the
+# preprocessing function, and evicted least recently used first once the
+# cache grows past max_bytes.
+
+CACHE_DIR = os.environ.get('ETL_CACHE_DIR', '.etl_cache')
+MAX_BYTES = 2 * 1024 ** 3
+INDEX_FILE = 'index.json'
+TIMEOUT = 30
+
+
+# index
+def load_index(cache_dir=CACHE_DIR):
+    "Return {'sources': {url: validators}, 'entries': {key: metadata}}"
+    path = Path(cache_dir) / INDEX_FILE
+    if not path.exists():
+        return {'sources': {}, 'entries': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(index, cache_dir=CACHE_DIR):
+    # write then rename, a crash never leaves a half written index
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    path = Path(cache_dir) / INDEX_FILE
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp, path)
+
+
+def cache_key(digests, preprocess):
+    "Key of a preprocessed frame: source content and preprocessing code"
+    h = hashlib.sha256()
+    for digest in digests:
+        h.update(digest.encode())
+    h.update(inspect.getsource(preprocess).encode())
+    return h.hexdigest()
+
+
+# revalidation
+def revalidate(url, source, timeout=TIMEOUT):
+    """Conditional GET of a source, True when it is unchanged.
+
+    source holds the ETag/Last-Modified of the cached copy; a source cached
+    without validators always counts as changed.
+    """
+    headers = {}
+    if source.get('etag'):
+        headers['If-None-Match'] = source['etag']
+    if source.get('last_modified'):
+        headers['If-Modified-Since'] = source['last_modified']
+    if not headers:
+        return False
+    # stream=True, the body of a changed source is downloaded by fetch_many
+    with requests.get(url, headers=headers, stream=True,
+                      timeout=timeout) as response:
+        return response.status_code == 304
+
+
+# Arrow IPC files
+def write_frame(df, path):
+    "Write a frame as an uncompressed Feather file, index included"
+    import pyarrow as pa
+    from pyarrow import feather
+    # compressed buffers cannot be memory mapped without decompressing
+    feather.write_feather(pa.Table.from_pandas(df, preserve_index=True),
+                          path, compression='uncompressed')
+
+
+def read_frame(path):
+    "Memory map a Feather file, numeric columns are not copied"
+    from pyarrow import feather
+    table = feather.read_table(path, memory_map=True)
+    # one block per column keeps the numeric columns as views on the map
+    return table.to_pandas(split_blocks=True)
+
+
+# eviction
+def evict(index, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, keep=()):
+    "Drop least recently used entries until the cache fits in max_bytes"
+    entries = index['entries']
+    total = sum(e['size'] for e in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        entry = entries.pop(key)
+        (Path(cache_dir) / entry['file']).unlink(missing_ok=True)
+        total -= entry['size']
+        print(f"Evicted cache entry {key[:12]} ({entry['size']} bytes)")
+    return index
+
+
+def clear(cache_dir=CACHE_DIR):
+    "Remove every cached frame and the index"
+    index = load_index(cache_dir)
+    for entry in index['entries'].values():
+        (Path(cache_dir) / entry['file']).unlink(missing_ok=True)
+    save_index({'sources': {}, 'entries': {}}, cache_dir)
+    print(f"Cleared {len(index['entries'])} cache entries")
+
+
+# cached extract
+def cached_extract(urls, preprocess, profile=None, cache_dir=CACHE_DIR,
+                   max_bytes=MAX_BYTES, timeout=TIMEOUT):
+    """Preprocessed frame of the sources, from the cache when possible.
+
+    profile is called with the raw frame on a miss, its result is stored
+    with the entry and returned on every hit. Returns (df, profile result).
+    """
+    from fetch_sources import fetch_many
+    import pandas as pd
+    urls = list(urls)
+    index = load_index(cache_dir)
+    sources = index['sources']
+    known = [sources.get(url, {}) for url in urls]
+    key = None
+    try:
+        if all(s.get('digest') and revalidate(url, s, timeout)
+               for url, s in zip(urls, known)):
+            key = cache_key([s['digest'] for s in known], preprocess)
+    except requests.RequestException as e:
+        print(f"Revalidation failed ({e}), downloading again")
+    if key is None or key not in index['entries']:
+        def parse(f):
+            df = pd.read_csv(f)
+            # the whole file went through the pipe, its hash is complete
+            source = {'etag': f.raw.validators.get('ETag'),
+                      'last_modified': f.raw.validators.get('Last-Modified'),
+                      'digest': f.raw.digest.hexdigest()}
+            return df, source
+
+        parsed = fetch_many(urls, parse, digest='sha256', timeout=timeout)
+        for url, (_, source) in zip(urls, parsed):
+            sources[url] = source
+        digests = [source['digest'] for _, source in parsed]
+        key = cache_key(digests, preprocess)
+        if key not in index['entries']:
+            frames = [df for df, _ in parsed]
+            raw = pd.concat(frames, ignore_index=True) if len(frames) > 1 \
+                else frames[0]
+            extra = profile(raw) if profile else None
+            df = preprocess(raw)
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            name = f"{key}.feather"
+            write_frame(df, Path(cache_dir) / name)
+            index['entries'][key] = {
+                'urls': urls, 'file': name,
+                'size': (Path(cache_dir) / name).stat().st_size,
+                'created': time.time(), 'last_used': time.time(),
+                'profile': extra}
+            evict(index, cache_dir, max_bytes, keep={key})
+            save_index(index, cache_dir)
+            print(f"Cached preprocessed data as {key[:12]}")
+            return df, extra
+        print("Content unchanged, preprocessing skipped")
+    else:
+        print("Sources not modified, download skipped")
+    entry = index['entries'][key]
+    entry['last_used'] = time.time()
+    save_index(index, cache_dir)
+    start = time.perf_counter()
+    df = read_frame(Path(cache_dir) / entry['file'])
+    print(f"Loaded {df.shape[0]} rows from cache entry {key[:12]} in "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    return df, entry['profile']
+
+
+# command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Inspect or clear the local raw data cache")
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="List the cached entries")
+    commands.add_parser('clear', help="Remove every cached entry")
+    prune = commands.add_parser('evict',
+                                help="Evict entries down to a size limit")
+    prune.add_argument('--max-mb', type=float, default=MAX_BYTES / 1024 ** 2)
+    args = parser.parse_args(argv)
+    if args.command == 'list':
+        index = load_index(args.cache_dir)
+        entries = index['entries']
+        for key in sorted(entries, key=lambda k: entries[k]['last_used'],
+                          reverse=True):
+            e = entries[key]
+            used = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(e['last_used']))
+            print(f"{key[:12]}  {e['size'] / 1024 ** 2:8.1f} MB  "
+                  f"last used {used}  {', '.join(e['urls'])}")
+        total = sum(e['size'] for e in entries.values())
+        print(f"{len(entries)} entries, {total / 1024 ** 2:.1f} MB")
+    elif args.command == 'clear':
+        clear(args.cache_dir)
+    else:
+        index = evict(load_index(args.cache_dir), args.cache_dir,
+                      int(args.max_mb * 1024 ** 2))
+        save_index(index, args.cache_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
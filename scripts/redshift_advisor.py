@@ -0,0 +1,209 @@
+import argparse
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from load_to_redshift import DDL_FILE, LOAD_ORDER, read_table_layouts
+
+# Offline advisor for the Redshift physical design.
+# It reads the processed Parquet tables, simulates how each candidate
+# distribution key spreads the rows over N slices, and recommends a
+# DISTSTYLE/DISTKEY, a SORTKEY and column encodings per table. The result is
+# written as DDL next to a JSON report with the projected slice imbalance.
+
+# dimensions up to this many rows are copied to every node
+ALL_MAX_ROWS = 1_000_000
+# max/mean rows per slice above which a distribution key is rejected
+MAX_SKEW = 1.25
+# columns the dashboards filter on, most used first
+FILTER_COLUMNS = ['order_date', 'product_id', 'state_id']
+# below this many distinct values a string column is dictionary encoded
+BYTEDICT_MAX_DISTINCT = 256
+
+
+# current design from the DDL
+def read_physical_design(ddl_file=DDL_FILE):
+    "Return {table: {'diststyle', 'distkey', 'sortkey'}} from the DDL"
+    sql = Path(ddl_file).read_text()
+    design = {}
+    pattern = (r'CREATE TABLE (\w+) \(.*?\n\)\s*DISTSTYLE (\w+)\s*'
+               r'(?:DISTKEY \((\w+)\)\s*)?(?:SORTKEY \(([^)]*)\))?')
+    for name, style, distkey, sortkey in re.findall(pattern, sql, re.S):
+        design[name] = {
+            'diststyle': style,
+            'distkey': distkey or None,
+            'sortkey': [c.strip() for c in sortkey.split(',') if c.strip()],
+        }
+    return design
+
+
+# distribution
+def slice_rows(series, slices):
+    "Rows per slice when distributing on series, with a stable hash"
+    hashes = pd.util.hash_pandas_object(series, index=False).to_numpy()
+    return np.bincount((hashes % np.uint64(slices)).astype(np.int64),
+                       minlength=slices)
+
+
+def key_stats(series, slices):
+    "Cardinality and simulated slice imbalance of one distribution key"
+    rows = slice_rows(series, slices)
+    mean = rows.mean() if len(rows) else 0
+    counts = series.value_counts(dropna=False)
+    return {
+        'cardinality': int(series.nunique(dropna=True)),
+        'nulls': int(series.isna().sum()),
+        'top_value_share': round(float(counts.iloc[0] / len(series)), 4)
+                           if len(series) else 0.0,
+        'max_slice_rows': int(rows.max()) if len(rows) else 0,
+        'min_slice_rows': int(rows.min()) if len(rows) else 0,
+        'skew': round(float(rows.max() / mean), 4) if mean else 0.0,
+    }
+
+
+def foreign_keys(layout):
+    "Columns of a table that reference another table"
+    return [c for c, d in layout['definitions'].items() if 'REFERENCES' in d]
+
+
+def recommend_distribution(table, df, layout, slices, large_dims=()):
+    "Pick DISTSTYLE ALL, KEY or EVEN and report every candidate"
+    candidates = {}
+    fks = foreign_keys(layout)
+    # a table that references nothing is a dimension
+    if not fks:
+        if len(df) <= ALL_MAX_ROWS:
+            return {'diststyle': 'ALL', 'distkey': None, 'candidates': {}}
+        keys = preferred = [layout['primary_key']]
+    else:
+        # only keys joining to a dimension that is not copied to every node
+        # are worth a KEY distribution, they keep that join on one slice;
+        # the others are reported for reference
+        preferred = [c for c in fks
+                     if re.search(r'REFERENCES (\w+)', layout['definitions'][c])
+                     .group(1) in large_dims]
+        keys = fks + [layout['primary_key']]
+    for col in keys:
+        if col in df.columns:
+            candidates[col] = key_stats(df[col], slices)
+    accepted = sorted((c for c in preferred
+                       if c in candidates and candidates[c]['skew'] <= MAX_SKEW),
+                      key=lambda c: candidates[c]['skew'])
+    if accepted:
+        return {'diststyle': 'KEY', 'distkey': accepted[0],
+                'candidates': candidates}
+    return {'diststyle': 'EVEN', 'distkey': None, 'candidates': candidates}
+
+
+# sort keys and encodings
+def recommend_sortkey(table, df, layout):
+    "Fact tables sort on the dashboard filters, dimensions on their key"
+    keys = [c for c in FILTER_COLUMNS if c in df.columns]
+    if foreign_keys(layout) and keys:
+        return keys[:2]
+    return [layout['primary_key']]
+
+
+def recommend_encoding(column, definition, series, sortkey):
+    "Column compression encoding from the declared type and the data"
+    sql_type = definition.split()[0].upper()
+    # the leading sort key column is scanned for zone maps, keep it raw
+    if sortkey and column == sortkey[0]:
+        return 'RAW'
+    if sql_type == 'BOOLEAN':
+        return 'RAW'
+    if sql_type in ('SMALLINT', 'INTEGER', 'BIGINT', 'DATE', 'TIMESTAMP') or \
+            sql_type.startswith('DECIMAL'):
+        return 'AZ64'
+    if sql_type.startswith('VARCHAR') or sql_type.startswith('CHAR'):
+        if series is not None and \
+                series.nunique(dropna=True) < BYTEDICT_MAX_DISTINCT:
+            return 'BYTEDICT'
+        return 'ZSTD'
+    return 'ZSTD'
+
+
+# DDL output
+def table_ddl(table, layout, design):
+    lines = []
+    for column in layout['columns']:
+        lines.append(f"    {column} {layout['definitions'][column]} "
+                     f"ENCODE {design['encodings'][column]}")
+    ddl = f"CREATE TABLE {table} (\n" + ',\n'.join(lines) + "\n)\n"
+    ddl += f"DISTSTYLE {design['diststyle']}\n"
+    if design['distkey']:
+        ddl += f"DISTKEY ({design['distkey']})\n"
+    ddl += f"SORTKEY ({', '.join(design['sortkey'])});\n"
+    return ddl
+
+
+def advise(parquet_dir, slices=4, ddl_file=DDL_FILE):
+    "Recommend a physical design for every processed table"
+    layouts = read_table_layouts(ddl_file)
+    current = read_physical_design(ddl_file)
+    frames = {}
+    for table in LOAD_ORDER:
+        path = Path(parquet_dir) / f"{table}.parquet"
+        if table in layouts and path.exists():
+            frames[table] = pd.read_parquet(path)
+    large_dims = {t for t, df in frames.items()
+                  if not foreign_keys(layouts[t]) and len(df) > ALL_MAX_ROWS}
+    report = {'slices': slices, 'tables': {}}
+    for table, df in frames.items():
+        layout = layouts[table]
+        design = recommend_distribution(table, df, layout, slices, large_dims)
+        design['sortkey'] = recommend_sortkey(table, df, layout)
+        design['encodings'] = {
+            c: recommend_encoding(c, layout['definitions'][c], df.get(c),
+                                  design['sortkey'])
+            for c in layout['columns']}
+        distkey = design['distkey']
+        design['projected_skew'] = \
+            design['candidates'][distkey]['skew'] if distkey else 1.0
+        cur = current.get(table, {})
+        if cur.get('distkey') and cur['distkey'] in df.columns:
+            cur['projected_skew'] = key_stats(df[cur['distkey']],
+                                              slices)['skew']
+        design['current'] = cur
+        design['rows'] = len(df)
+        design['ddl'] = table_ddl(table, layout, design)
+        report['tables'][table] = design
+        print(f"{table}: {len(df)} rows, current {cur.get('diststyle')} "
+              f"{cur.get('distkey') or ''}, recommended "
+              f"{design['diststyle']} {distkey or ''} "
+              f"(projected skew {design['projected_skew']})")
+    return report
+
+
+def write_advice(report, out_dir='.'):
+    "Write the recommended DDL and the JSON report"
+    out_dir = Path(out_dir)
+    ddl = '\n'.join(t['ddl'] for t in report['tables'].values())
+    (out_dir / 'redshift_recommended_tables.sql').write_text(
+        f"-- Recommended for {report['slices']} slices\n\n" + ddl)
+    with open(out_dir / 'redshift_advice.json', 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Advice saved to {out_dir}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recommend the Redshift distribution, sort keys and "
+                    "encodings of the processed tables")
+    parser.add_argument('parquet_dir', nargs='?', default='.',
+                        help="folder of the processed Parquet tables")
+    parser.add_argument('--slices', type=int, default=4,
+                        help="number of cluster slices")
+    parser.add_argument('--ddl-file', default=DDL_FILE)
+    parser.add_argument('--out-dir', default='.')
+    args = parser.parse_args(argv)
+    write_advice(advise(args.parquet_dir, args.slices, args.ddl_file),
+                 args.out_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
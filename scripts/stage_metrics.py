@@ -0,0 +1,195 @@
+import argparse
+import json
+from contextlib import contextmanager
+
+# Spark stage metrics per pipeline stage of the Glue job.
+# tagged() puts the Spark jobs started in a block into a job group named
+# after the pipeline stage (proc_cust_dim, fact_table, save dim_prod, ...).
+# collect_stage_metrics() then reads the task metrics Spark's own status
+# listener already sums per stage, and reports them per Spark stage and per
+# job group: tasks, input and output rows, shuffle bytes, spill, GC and run
+# time. A Python listener would get a py4j callback for every task end
+# event; the status listener runs in the JVM and costs nothing extra.
+# The DataFrames are lazy, so the group of a function holds the jobs it
+# runs itself (counts, key ranges, hot key samples); the joins and
+# aggregations of a table run in the jobs of its "save <table>" group.
+# A stage shared by several jobs counts for the job that ran it first.
+# Spark keeps the last spark.ui.retainedStages (1000) stages, older ones
+# are reported as untracked.
+# The Glue job imports this file through --extra-py-files.
+#   python stage_metrics.py --out stage_metrics.json   # local-mode check
+
+GROUP_KEY = 'spark.jobGroup.id'
+DESCRIPTION_KEY = 'spark.job.description'
+# report name: StageData field
+STAGE_METRICS = {
+    'input_bytes': 'inputBytes',
+    'input_rows': 'inputRecords',
+    'output_bytes': 'outputBytes',
+    'output_rows': 'outputRecords',
+    'shuffle_read_bytes': 'shuffleReadBytes',
+    'shuffle_read_rows': 'shuffleReadRecords',
+    'shuffle_write_bytes': 'shuffleWriteBytes',
+    'shuffle_write_rows': 'shuffleWriteRecords',
+    'memory_spill_bytes': 'memoryBytesSpilled',
+    'disk_spill_bytes': 'diskBytesSpilled',
+    'gc_ms': 'jvmGcTime',
+    'run_ms': 'executorRunTime',
+    'cpu_ms': 'executorCpuTime',
+}
+UNTAGGED = 'untagged'
+
+
+@contextmanager
+def tagged(sc, name):
+    """Run the Spark jobs started in this block under the job group name.
+
+    The group is a local property of the calling thread, the previous one
+    is restored on exit.
+    """
+    previous = {key: sc.getLocalProperty(key)
+                for key in (GROUP_KEY, DESCRIPTION_KEY)}
+    sc.setLocalProperty(GROUP_KEY, name)
+    sc.setLocalProperty(DESCRIPTION_KEY, name)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            sc.setLocalProperty(key, value)
+
+
+def _each(seq):
+    # a Scala collection, through its iterator
+    it = seq.iterator()
+    while it.hasNext():
+        yield it.next()
+
+
+def _option(opt):
+    return opt.get() if opt.isDefined() else None
+
+
+def _stage_metrics(stage):
+    from py4j.protocol import Py4JError
+    metrics = {}
+    for name, field in STAGE_METRICS.items():
+        try:
+            value = getattr(stage, field)()
+        except Py4JError:
+            # a field this Spark version does not have
+            value = None
+        if value is not None and name == 'cpu_ms':
+            # Spark reports the CPU time in nanoseconds
+            value = value / 1e6
+        metrics[name] = value
+    return metrics
+
+
+def _add(total, metrics):
+    for name, value in metrics.items():
+        if value is not None:
+            total[name] = (total.get(name) or 0) + value
+
+
+def collect_stage_metrics(sc, wait_seconds=10):
+    """Task metrics of every Spark stage of the application so far.
+
+    Returns {'groups': {group: totals}, 'stages': [...], 'untracked_stages'}.
+    The groups are in the order of their first job.
+    """
+    from py4j.protocol import Py4JError, Py4JJavaError
+    jsc = sc._jsc.sc()
+    try:
+        # the listener is asynchronous, let it take in the last events
+        jsc.listenerBus().waitUntilEmpty(int(wait_seconds * 1000))
+    except Py4JError:
+        pass
+    store = jsc.statusStore()
+    owner = {}
+    for job in sorted(_each(store.jobsList(None)), key=lambda j: j.jobId()):
+        group = _option(job.jobGroup()) or UNTAGGED
+        for stage_id in _each(job.stageIds()):
+            owner.setdefault(stage_id, (job.jobId(), group))
+    stages, groups, untracked = [], {}, 0
+    for stage_id in sorted(owner):
+        job_id, group = owner[stage_id]
+        try:
+            stage = store.lastStageAttempt(stage_id)
+        except Py4JJavaError:
+            # no longer retained by Spark
+            untracked += 1
+            continue
+        status = stage.status().toString()
+        if status == 'SKIPPED':
+            # its output was reused, an earlier stage did the work
+            continue
+        metrics = _stage_metrics(stage)
+        stages.append(dict(stage_id=stage_id, job_id=job_id, group=group,
+                           name=stage.name(), status=status,
+                           attempts=stage.attemptId() + 1,
+                           tasks=stage.numTasks(),
+                           failed_tasks=stage.numFailedTasks(), **metrics))
+        total = groups.setdefault(group, {'jobs': set(), 'stages': 0,
+                                          'tasks': 0, 'failed_tasks': 0})
+        total['jobs'].add(job_id)
+        total['stages'] += 1
+        total['tasks'] += stage.numTasks()
+        total['failed_tasks'] += stage.numFailedTasks()
+        _add(total, metrics)
+    for total in groups.values():
+        total['jobs'] = len(total['jobs'])
+    return {'groups': groups, 'stages': stages,
+            'untracked_stages': untracked}
+
+
+def heaviest(report, by='run_ms', top=5):
+    "The groups with the most of one metric, for the job log"
+    ranked = sorted(report['groups'].items(),
+                    key=lambda g: g[1].get(by) or 0, reverse=True)
+    return [(group, total.get(by) or 0) for group, total in ranked[:top]]
+
+
+# local-mode check of the tagging and the collection
+def _local_check(out, cores=2):
+    from pyspark import SparkContext
+    from pyspark.conf import SparkConf
+    from pyspark.sql import SparkSession, functions as F
+    conf = SparkConf().setMaster(f"local[{cores}]") \
+        .setAppName('stage_metrics') \
+        .set('spark.sql.shuffle.partitions', str(cores * 2)) \
+        .set('spark.ui.enabled', 'false')
+    sc = SparkContext(conf=conf)
+    spark = SparkSession(sc)
+    try:
+        with tagged(sc, 'generate'):
+            df = spark.range(0, 200000).withColumn('key', F.col('id') % 97)
+            rows = df.count()
+        with tagged(sc, 'aggregate'):
+            # one shuffle
+            totals = df.groupBy('key').agg(F.sum('id').alias('total'))
+            keys = totals.count()
+        report = collect_stage_metrics(sc)
+    finally:
+        sc.stop()
+    aggregate = report['groups'].get('aggregate', {})
+    if rows != 200000 or keys != 97 or \
+            not aggregate.get('shuffle_write_bytes'):
+        raise RuntimeError(f"Unexpected stage metrics: {report['groups']}")
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Stage metrics of {len(report['stages'])} stages in "
+          f"{len(report['groups'])} groups written to {out}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check the stage metrics collection on local-mode Spark")
+    parser.add_argument('--out', default='stage_metrics.json')
+    parser.add_argument('--cores', type=int, default=2)
+    args = parser.parse_args(argv)
+    _local_check(args.out, args.cores)
+
+
+if __name__ == '__main__':
+    main()
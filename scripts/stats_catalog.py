@@ -0,0 +1,315 @@
+import json
+import os
+import time
+from pathlib import Path
+
+# Statistics catalog of the output files, shared by the local (pandas) and
+# the Glue (PySpark) pipelines.
+# After a run writes its tables, the catalog records for every table its
+# data version, and for every file of it the row count, the byte size and
+# the min, max and null count of the key columns. Readers can then skip
+# files whose ranges cannot match a filter, and notice rewritten tables,
+# from this one small JSON file without opening any Parquet file.
+# The catalog is rewritten as a whole: locally through a temporary file and
+# a rename, on S3 with a single PUT, so readers see the old or the new one.
+# The Glue job imports this file through --extra-py-files.
+
+CATALOG_FILE = '_stats_catalog.json'
+# columns with min/max/null statistics, where a table has them
+STATS_COLUMNS = ['order_number', 'order_date', 'date_full', 'order_month',
+                 'customer_id', 'state_id', 'product_id', 'status_id',
+                 'employee_id', 'category']
+
+
+def empty_catalog():
+    return {'version': 0, 'tables': {}}
+
+
+def _value(value):
+    # JSON friendly min/max, dates as ISO strings
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def update_table(catalog, table, files, mode='overwrite'):
+    """Record the files of one table and bump its data version.
+
+    files maps a file path to {'rows', 'bytes', 'columns'}. overwrite
+    replaces the file list, append adds to it. The tables of one write share
+    the next catalog version, see commit().
+    """
+    entry = catalog['tables'].get(table, {'version': 0, 'files': {}})
+    known = entry['files'] if mode == 'append' else {}
+    known.update(files)
+    catalog['tables'][table] = {
+        'version': entry['version'] + 1,
+        'catalog_version': catalog['version'] + 1,
+        'updated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'rows': sum(f['rows'] for f in known.values()),
+        'bytes': sum(f['bytes'] for f in known.values()),
+        'files': known,
+    }
+    return catalog
+
+
+def commit(catalog):
+    "Close one write, every table it updated carries the new version"
+    catalog['version'] += 1
+    print(f"Statistics catalog updated to version {catalog['version']}")
+    return catalog
+
+
+def _overlaps(stats, op, value):
+    "False only when no row of the file can match the filter"
+    low, high = stats.get('min'), stats.get('max')
+    if low is None or high is None:
+        # no statistics, or only nulls, which match no filter
+        return stats.get('nulls') is None
+    if isinstance(low, str) and not isinstance(value, str):
+        # dates are stored as ISO strings
+        import pandas as pd
+        low, high = pd.Timestamp(low), pd.Timestamp(high)
+        value = [pd.Timestamp(v) for v in value] \
+            if op in ('in', 'not in') else pd.Timestamp(value)
+    try:
+        if op == '==':
+            return low <= value <= high
+        if op == 'in':
+            return any(low <= v <= high for v in value)
+        if op == '<':
+            return low < value
+        if op == '<=':
+            return low <= value
+        if op == '>':
+            return high > value
+        if op == '>=':
+            return high >= value
+    except TypeError:
+        return True
+    return True
+
+
+def prune_files(catalog, table, filters=()):
+    """Files of a table that may hold rows matching every filter.
+
+    filters are (column, op, value) tuples like the Parquet reader's;
+    columns without statistics never prune. Returns None for a table that
+    is not in the catalog.
+    """
+    entry = catalog['tables'].get(table)
+    if entry is None:
+        return None
+    kept = []
+    for path, stats in entry['files'].items():
+        columns = stats.get('columns', {})
+        if all(_overlaps(columns[c], op, v) for c, op, v in filters
+               if c in columns):
+            kept.append(path)
+    return kept
+
+
+# pandas
+def frame_stats(df, columns=STATS_COLUMNS):
+    "Row count and min/max/null count of the key columns of a frame"
+    stats = {}
+    for col in columns:
+        if col not in df.columns:
+            continue
+        values = df[col].dropna()
+        stats[col] = {
+            'min': _value(values.min()) if len(values) else None,
+            'max': _value(values.max()) if len(values) else None,
+            'nulls': int(len(df) - len(values)),
+        }
+    return {'rows': int(len(df)), 'columns': stats}
+
+
+def load_catalog(folder='.'):
+    path = Path(folder) / CATALOG_FILE
+    if not path.exists():
+        return empty_catalog()
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_catalog(catalog, folder='.'):
+    path = Path(folder) / CATALOG_FILE
+    tmp = path.with_name(f".{CATALOG_FILE}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(tmp, path)
+
+
+def record_frames(tables, folder='.', modes=None):
+    """Catalog tables written from memory, tables maps name: (path, df).
+
+    A table written as several files maps to a list of (path, df). The
+    statistics come from the frames that were written, the files are not
+    read again. modes maps a table to 'append' to add its files.
+    """
+    catalog = load_catalog(folder)
+    for name, written in tables.items():
+        files = {}
+        for path, df in (written if isinstance(written, list) else [written]):
+            stats = frame_stats(df)
+            stats['bytes'] = os.path.getsize(path)
+            files[str(Path(path).name)] = stats
+        update_table(catalog, name, files, (modes or {}).get(name, 'overwrite'))
+    save_catalog(commit(catalog), folder)
+    return catalog
+
+
+# PySpark
+def _filesystem(spark, path):
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(path)
+    return path, path.getFileSystem(
+        spark.sparkContext._jsc.hadoopConfiguration())
+
+
+def list_files(spark, path, suffix='.parquet'):
+    "{path: size} of the data files of a table folder"
+    path, fs = _filesystem(spark, path)
+    if not fs.exists(path):
+        return {}
+    files = {}
+    status = fs.listFiles(path, True)
+    while status.hasNext():
+        s = status.next()
+        name = s.getPath().getName()
+        if name.endswith(suffix) and not name.startswith(('_', '.')):
+            files[s.getPath().toString()] = s.getLen()
+    return files
+
+
+def load_catalog_spark(spark, catalog_path):
+    path, fs = _filesystem(spark, catalog_path)
+    if not fs.exists(path):
+        return empty_catalog()
+    stream = fs.open(path)
+    try:
+        reader = spark.sparkContext._jvm.java.io.BufferedReader(
+            spark.sparkContext._jvm.java.io.InputStreamReader(stream))
+        lines = []
+        line = reader.readLine()
+        while line is not None:
+            lines.append(line)
+            line = reader.readLine()
+    finally:
+        stream.close()
+    return json.loads('\n'.join(lines))
+
+
+def save_catalog_spark(spark, catalog, catalog_path):
+    # one object written in one PUT, never seen half written
+    path, fs = _filesystem(spark, catalog_path)
+    stream = fs.create(path, True)
+    try:
+        stream.write(bytearray(json.dumps(catalog, indent=2).encode()))
+    finally:
+        stream.close()
+
+
+def _footer_path(path):
+    "(pyarrow filesystem, path) of a path as Hadoop lists it"
+    from pyarrow import fs
+    if path.startswith('file:'):
+        return fs.LocalFileSystem(), '/' + path[len('file:'):].lstrip('/')
+    return fs.FileSystem.from_uri(path)
+
+
+def footer_stats(path, columns=STATS_COLUMNS):
+    """Stats of a Parquet file from its footer, nothing else is read.
+
+    Columns whose row groups have no min/max get none, so they never prune.
+    """
+    import pyarrow.parquet as pq
+    filesystem, inner = _footer_path(path)
+    meta = pq.read_metadata(inner, filesystem=filesystem)
+    names = [meta.schema.column(i).path for i in range(meta.num_columns)]
+    stats = {}
+    for col in columns:
+        if col not in names:
+            continue
+        j = names.index(col)
+        low = high = None
+        nulls = 0
+        for i in range(meta.num_row_groups):
+            group = meta.row_group(i)
+            chunk = group.column(j).statistics
+            if chunk is not None and chunk.has_null_count and \
+                    chunk.null_count == group.num_rows:
+                # only nulls, no range to add
+                nulls += chunk.null_count
+                continue
+            if chunk is None or not chunk.has_null_count or \
+                    not chunk.has_min_max:
+                low = high = nulls = None
+                break
+            nulls += chunk.null_count
+            low = chunk.min if low is None else min(low, chunk.min)
+            high = chunk.max if high is None else max(high, chunk.max)
+        stats[col] = {'min': _value(low), 'max': _value(high),
+                      'nulls': nulls}
+    return {'rows': int(meta.num_rows), 'columns': stats}
+
+
+def file_stats_spark(spark, files, columns=STATS_COLUMNS):
+    "{path: stats} of Parquet files, one job over the key columns only"
+    from pyspark.sql import functions as F
+    df = spark.read.parquet(*files)
+    present = [c for c in columns if c in df.columns]
+    exprs = [F.count(F.lit(1)).alias('rows')]
+    for col in present:
+        exprs += [F.min(col).alias(f"{col}|min"), F.max(col).alias(f"{col}|max"),
+                  F.sum(F.col(col).isNull().cast('long')).alias(f"{col}|nulls")]
+    rows = df.groupBy(F.input_file_name().alias('file')).agg(*exprs).collect()
+    stats = {}
+    for r in rows:
+        stats[r['file']] = {
+            'rows': int(r['rows']),
+            'columns': {col: {'min': _value(r[f"{col}|min"]),
+                              'max': _value(r[f"{col}|max"]),
+                              'nulls': int(r[f"{col}|nulls"] or 0)}
+                        for col in present}}
+    return stats
+
+
+def record_tables_spark(spark, catalog_path, paths, modes=None):
+    """Catalog the tables written to paths, {name: folder}.
+
+    The statistics of the files the catalog does not list yet come from
+    their Parquet footers, a few KB per file; the files are scanned only
+    where the footers cannot be read.
+    """
+    catalog = load_catalog_spark(spark, catalog_path)
+    for name, folder in paths.items():
+        mode = (modes or {}).get(name, 'overwrite')
+        files = list_files(spark, folder)
+        known = catalog['tables'].get(name, {}).get('files', {})
+        new = [p for p in files if p not in known or mode == 'overwrite']
+        stats, unread = {}, []
+        for p in new:
+            try:
+                stats[p] = footer_stats(p)
+            except (ImportError, OSError):
+                unread.append(p)
+        if unread:
+            stats.update(file_stats_spark(spark, unread))
+        # input_file_name and the listing may format the same path apart
+        by_name = {p.rsplit('/', 1)[-1]: s for p, s in stats.items()}
+        recorded = {}
+        for p in new:
+            s = stats.get(p) or by_name.get(p.rsplit('/', 1)[-1]) or \
+                {'rows': 0, 'columns': {}}
+            recorded[p] = dict(s, bytes=files[p])
+        update_table(catalog, name, recorded, mode)
+    save_catalog_spark(spark, commit(catalog), catalog_path)
+    return catalog
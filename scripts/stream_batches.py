@@ -0,0 +1,320 @@
+import os
+import queue
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from sketches import SKETCHES
+from stats_catalog import (commit, footer_stats, load_catalog, prune_files,
+                           record_frames, save_catalog, update_table)
+from local_etl_test import (contains_orders, data_preprocessing, fact_table,
+                            ingest_facts, load_order_index, merge_rollup,
+                            proc_cust_dim,
+                            proc_date_dim, proc_emp_dim, proc_geo_dim,
+                            proc_ostatus_dim, proc_prod_dim, ROLLUPS)
+
+# Micro-batch mode of the local pipeline.
+# A long-running loop watches a landing directory (or an in-process queue
+# standing in for a message queue) and runs every batch of new order files
+# through preprocessing, the dimension upserts and the fact append. The
+# dimensions, the order index and the rollups stay in memory between
+# batches, the facts do not: they are a fact_orders folder that every batch
+# adds one part file to, so a batch only costs the work on its own rows plus
+# one write of the changed tables. Orders replaced with on_duplicate='update'
+# are looked up in the parts the catalog cannot rule out, and only those
+# parts are rewritten. A fact_orders.parquet written by a batch run is the
+# whole table, it becomes the first part of the folder.
+# A batch is cut when the oldest waiting file is batch_interval seconds old,
+# or when max_files files or max_bytes bytes are waiting. Its outputs are
+# all written to temporary files first and then renamed over the old ones,
+# the order index last, so readers never see a half written table and a
+# failed batch leaves both the outputs and the in-memory state untouched.
+# Processed files move to landing/processed, failed ones to landing/failed.
+
+BATCH_INTERVAL = 30.0
+MAX_FILES = 100
+MAX_BYTES = 64 * 1024 * 1024
+POLL_INTERVAL = 1.0
+# a landing file is picked up once it was not modified for this long
+SETTLE_SECONDS = 1.0
+
+DIMENSIONS = ['dim_date', 'dim_cust', 'dim_geo', 'dim_prod', 'dim_ostatus',
+              'dim_emp']
+FACT_TABLE = 'fact_orders'
+
+
+# sources
+class LandingDirectory:
+    "New CSV files dropped in a folder"
+
+    def __init__(self, path, pattern='*.csv', settle_seconds=SETTLE_SECONDS):
+        self.path = Path(path)
+        self.pattern = pattern
+        self.settle_seconds = settle_seconds
+        for sub in ('processed', 'failed'):
+            (self.path / sub).mkdir(parents=True, exist_ok=True)
+
+    def poll(self):
+        "Files ready to be processed as (key, size in bytes, item)"
+        ready = []
+        now = time.time()
+        for path in sorted(self.path.glob(self.pattern),
+                           key=lambda p: p.stat().st_mtime):
+            stat = path.stat()
+            # still being written by the upstream
+            if now - stat.st_mtime < self.settle_seconds:
+                continue
+            ready.append((str(path), stat.st_size, path))
+        return ready
+
+    def read(self, items):
+        return pd.concat([pd.read_csv(p) for p in items], ignore_index=True)
+
+    def done(self, items, ok):
+        target = self.path / ('processed' if ok else 'failed')
+        for path in items:
+            shutil.move(str(path), str(target / path.name))
+
+
+class QueueSource:
+    "Raw order frames put on a queue.Queue, a local stand-in for a broker"
+
+    def __init__(self, frames=None):
+        self.frames = frames if frames is not None else queue.Queue()
+        self._received = 0
+
+    def poll(self):
+        ready = []
+        while True:
+            try:
+                frame = self.frames.get_nowait()
+            except queue.Empty:
+                return ready
+            self._received += 1
+            ready.append((self._received,
+                          int(frame.memory_usage(deep=True).sum()), frame))
+
+    def read(self, items):
+        return pd.concat(items, ignore_index=True)
+
+    def done(self, items, ok):
+        if not ok:
+            print(f"Dropped {len(items)} queued frames")
+
+
+# state kept between batches
+class MicroBatchState:
+    "Tables of the star schema held in memory and committed per batch"
+
+    def __init__(self, output_dir='.'):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._adopt_fact_file()
+        self.tables = {name: self._read(name) for name in
+                       DIMENSIONS + list(ROLLUPS) + list(SKETCHES)}
+        parts = self._parts()
+        self._next_part = int(parts[-1].stem.split('-')[1]) + 1 if parts else 0
+        if self.tables['dim_geo'] is None:
+            self.tables['dim_geo'] = proc_geo_dim()
+        # a private copy, the file behind the memory map is replaced
+        self.index = np.array(load_order_index(self._index_path()))
+
+    def _path(self, name):
+        return self.output_dir / f"{name}.parquet"
+
+    def _index_path(self):
+        return str(self.output_dir / 'order_index.npy')
+
+    def _fact_dir(self):
+        return self.output_dir / FACT_TABLE
+
+    def _parts(self):
+        return sorted(self._fact_dir().glob('part-*.parquet'))
+
+    def _tmp(self, part):
+        # hidden from readers of the folder until it is renamed
+        return part.with_name(f".{part.name}.tmp")
+
+    def _adopt_fact_file(self):
+        "Move a fact table written by a batch run into the parts folder"
+        path = self._path(FACT_TABLE)
+        if not path.exists():
+            return
+        folder = self._fact_dir()
+        if folder.exists():
+            # the batch run rewrote the whole table after the last batch
+            shutil.rmtree(folder)
+        folder.mkdir()
+        part = folder / 'part-00000.parquet'
+        os.replace(path, part)
+        # the statistics come from the footer, the facts are not read
+        stats = footer_stats(str(part.resolve()))
+        stats['bytes'] = part.stat().st_size
+        catalog = load_catalog(self.output_dir)
+        update_table(catalog, FACT_TABLE, {part.name: stats})
+        save_catalog(commit(catalog), self.output_dir)
+
+    def _read(self, name):
+        path = self._path(name)
+        return pd.read_parquet(path) if path.exists() else None
+
+    def transform(self, raw, on_duplicate='skip'):
+        "Tables changed by one batch of raw orders, and the new order index"
+        t = self.tables
+        df = data_preprocessing(raw)
+        dims = {
+            'dim_date': proc_date_dim(df, t['dim_date']),
+            'dim_cust': proc_cust_dim(df, t['dim_cust']),
+            'dim_geo': t['dim_geo'],
+            'dim_prod': proc_prod_dim(df, t['dim_prod']),
+            'dim_ostatus': proc_ostatus_dim(df, t['dim_ostatus']),
+            'dim_emp': proc_emp_dim(df, t['dim_emp']),
+        }
+        batch = fact_table(df, *(dims[name] for name in DIMENSIONS))
+        stored, rewrites = None, {}
+        if on_duplicate == 'update':
+            orders = batch['order_number']
+            loaded = orders[contains_orders(self.index, orders)]
+            if len(loaded):
+                stored, rewrites = self._stored_orders(set(loaded.tolist()))
+        facts, deltas, index = ingest_facts(batch, dims['dim_prod'],
+                                            self.index, on_duplicate, stored,
+                                            append_only=True)
+        changed = dict(dims)
+        for name, delta in deltas.items():
+            changed[name] = delta if t[name] is None else \
+                merge_rollup(t[name], delta, name)
+        return changed, index, (facts, rewrites)
+
+    def _stored_orders(self, orders):
+        """Stored rows of the given orders, and the parts holding them.
+
+        Returns (rows, {part: its rows without them}); only the parts whose
+        order number range in the catalog may hold the orders are read.
+        """
+        parts = self._parts()
+        kept = prune_files(load_catalog(self.output_dir), FACT_TABLE,
+                           [('order_number', 'in', sorted(orders))])
+        if kept is not None:
+            names = {Path(p).name for p in kept}
+            parts = [p for p in parts if p.name in names]
+        found, rewrites = [], {}
+        for part in parts:
+            old = pd.read_parquet(part)
+            hit = old['order_number'].isin(orders)
+            if hit.any():
+                found.append(old[hit])
+                rewrites[part] = old[~hit]
+        rows = pd.concat(found, ignore_index=True) if found else None
+        return rows, rewrites
+
+    def _stage_facts(self, added, rewrites):
+        "(temporary file, part, rows) of the batch's part and rewritten ones"
+        staged = []
+        folder = self._fact_dir()
+        folder.mkdir(exist_ok=True)
+        if len(added):
+            part = folder / f"part-{self._next_part:05d}.parquet"
+            staged.append((self._tmp(part), part, added))
+        for part, rows in rewrites.items():
+            staged.append((self._tmp(part), part, rows))
+        return staged
+
+    def commit(self, changed, index, fact_changes):
+        "Write every changed table, then swap them in at once"
+        staged = []
+        try:
+            for name, df in changed.items():
+                # tables the batch did not touch, e.g. dim_geo
+                if df is self.tables.get(name) and self._path(name).exists():
+                    continue
+                tmp = self._path(name).with_suffix('.parquet.tmp')
+                staged.append((tmp, self._path(name), df))
+                df.to_parquet(tmp, compression='snappy')
+            parts = self._stage_facts(*fact_changes)
+            staged += parts
+            for tmp, _, df in parts:
+                df.to_parquet(tmp, compression='snappy')
+        except Exception:
+            for tmp, _, _ in staged:
+                tmp.unlink(missing_ok=True)
+            raise
+        # the new part goes in before the parts its orders are removed from,
+        # a reader in between sees an order twice rather than not at all
+        for tmp, path, _ in staged:
+            os.replace(tmp, path)
+        # the index is saved last, it only lists orders that were written
+        tmp_index = f"{self._index_path()}.tmp.npy"
+        np.save(tmp_index, np.asarray(index, dtype='int64'))
+        os.replace(tmp_index, self._index_path())
+        written = {path.stem: (path, df) for _, path, df in staged
+                   if path.parent == self.output_dir}
+        if parts:
+            written[FACT_TABLE] = [(path, df) for _, path, df in parts]
+        record_frames(written, self.output_dir, {FACT_TABLE: 'append'})
+        if len(fact_changes[0]):
+            self._next_part += 1
+        self.tables.update(changed)
+        self.index = index
+
+
+# the loop
+def run_stream(source, output_dir='.', batch_interval=BATCH_INTERVAL,
+               max_files=MAX_FILES, max_bytes=MAX_BYTES,
+               poll_interval=POLL_INTERVAL, on_duplicate='skip',
+               max_batches=None, idle_exit=None):
+    """Process micro-batches from source until stopped.
+
+    max_batches stops after that many batches, idle_exit after that many
+    seconds without a waiting file; both default to running forever.
+    Returns the number of batches committed.
+    """
+    state = MicroBatchState(output_dir)
+    pending = {}
+    committed = 0
+    last_activity = time.time()
+    print(f"Watching for new orders, batch every {batch_interval}s or "
+          f"{max_files} files")
+    try:
+        while max_batches is None or committed < max_batches:
+            now = time.time()
+            for key, size, item in source.poll():
+                if key not in pending:
+                    pending[key] = (item, now, size)
+                    last_activity = now
+            waiting = sorted(pending.items(), key=lambda kv: kv[1][1])
+            due = waiting and (
+                len(waiting) >= max_files or
+                sum(size for _, (_, _, size) in waiting) >= max_bytes or
+                now - waiting[0][1][1] >= batch_interval)
+            if due:
+                batch = waiting[:max_files]
+                items = [item for _, (item, _, _) in batch]
+                oldest = batch[0][1][1]
+                try:
+                    changed, index, facts = state.transform(
+                        source.read(items), on_duplicate)
+                    state.commit(changed, index, facts)
+                except Exception as e:
+                    print(f"Batch of {len(items)} files failed: {e}")
+                    source.done(items, False)
+                else:
+                    source.done(items, True)
+                    committed += 1
+                    print(f"Batch {committed}: {len(items)} files committed "
+                          f"{time.time() - oldest:.1f}s after arrival")
+                for key, _ in batch:
+                    del pending[key]
+                last_activity = time.time()
+                continue
+            if idle_exit is not None and not pending and \
+                    now - last_activity >= idle_exit:
+                print(f"No new files for {idle_exit}s, stopping")
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped, waiting files are left for the next run")
+    return committed
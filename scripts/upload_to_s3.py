@@ -1,22 +1,33 @@
-import boto3
 import json
 from pathlib import Path
 
+# boto3 is imported when a client is created, so importing this module
+# (e.g. for the command line help) stays fast
+
 # define the function to upload the files to s3
-def upload_to_s3(cred_file, file_name, bucket, object_name=None): 
+def upload_to_s3(cred_file, file_name, bucket, object_name=None, 
+                 s3_client=None): 
+    "Upload one file, returns False when the file was not found"
     if object_name is None: 
         object_name = file_name
-    credentials = read_cred(cred_file)
-    s3_client = boto3.client(
-        "s3", 
-        aws_access_key_id=credentials['aws_access_key_id'],
-        aws_secret_access_key=credentials['aws_secret_access_key']
-    )
+    if s3_client is None:
+        s3_client = s3_client_from_cred(cred_file)
     try: 
         s3_client.upload_file(file_name, bucket, object_name)
         print(f"File '{file_name}' uploaded to S3 bucket '{bucket}' successfully.")
+        return True
     except FileNotFoundError: 
         print(f"The file '{file_name}' was not found.")
+        return False
+
+def s3_client_from_cred(cred_file):
+    import boto3
+    credentials = read_cred(cred_file)
+    return boto3.client(
+        "s3", 
+        aws_access_key_id=credentials['aws_access_key_id'],
+        aws_secret_access_key=credentials['aws_secret_access_key']
+    )
 
 # read credential file
 def read_cred(cred_file): 
@@ -28,17 +39,27 @@ def read_cred(cred_file):
             credentials = json.load(f)
         return credentials    
 
+# files uploaded by default
+UPLOAD_FILES = ['dim_date.parquet', 'dim_cust.parquet', 
+                'dim_geo.parquet', 'dim_prod.parquet', 
+                'dim_ostatus.parquet', 'dim_emp.parquet', 
+                'fact_orders.parquet']
+
 # upload the files
-def files_upload(cred_files, bucket, object_name=None):
+def files_upload(cred_files, bucket, object_name=None, file_names=None, 
+                 prefix=''):
+    "Upload the processed files, returns the files that were not found"
     # specify the file names
-    file_names = ['dim_date.parquet', 'dim_cust.parquet', 
-                  'dim_geo.parquet', 'dim_prod.parquet', 
-                  'dim_ostatus.parquet', 'dim_emp.parquet', 
-                  'fact_orders.parquet']
+    file_names = file_names or UPLOAD_FILES
+    # one client for all files
+    s3_client = s3_client_from_cred(cred_files)
+    missing = []
     # upload all files
     for file in file_names: 
-        upload_to_s3(cred_files, file, 
-                     bucket)
+        if not upload_to_s3(cred_files, file, bucket, 
+                            f"{prefix}{Path(file).name}", s3_client):
+            missing.append(file)
+    return missing
 
 # Example usage
 if __name__ == "__main__":
@@ -48,6 +69,7 @@ if __name__ == "__main__":
     #   "aws_access_key_id": "YOUR_ACCESS_KEY",
     #   "aws_secret_access_key": "YOUR_SECRET_KEY"
     # }
-    cred_files = input("Name of AWS credential file: ")
-    bucket = input("S3 bucket name: ")
-    files_upload(cred_files, bucket)
\ No newline at end of file
+    # python upload_to_s3.py --cred-file aws_credentials.json --bucket name
+    import sys
+    from etl_cli import main
+    raise SystemExit(main(['upload'] + sys.argv[1:]))